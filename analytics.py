@@ -0,0 +1,355 @@
+"""
+出席統計
+
+每次結束投票時，在寫入結果的同一交易中（poll.publish_results）增量更新兩種彙總文件：
+- member_stats: 每位成員在群組內的出席/請假次數、連續出席紀錄和每月統計
+- group_stats: 每個群組的投票數、出席/請假總數和每月統計
+
+/stats 指令只需讀取一份以 (group_id, user_id) 索引的彙總文件。
+彙總資料可用 `python analytics.py rebuild [--group 群組ID]` 以聚合管線從投票記錄完整重建。
+連續出席以成員有投票的投票為序列計算，請假即中斷。
+"""
+import argparse
+import logging
+from datetime import datetime
+import startup
+import poll_schema
+import db_policy
+
+logger = logging.getLogger(__name__)
+
+pymongo = startup.lazy_module('pymongo')
+
+DUPLICATE_KEY = 11000
+
+
+def _month(poll):
+    created_at = poll.get('created_at') or datetime.now()
+    return created_at.strftime('%Y-%m')
+
+
+def _count(field, increment):
+    """管線中的累加運算式（欄位不存在時視為0）"""
+    return {"$add": [{"$ifNull": [f"${field}", 0]}, increment]}
+
+
+def _member_update(poll, user_id, option, now):
+    """產生單一成員彙總的管線更新"""
+    month = _month(poll)
+    attended = 1 if option == 'attend' else 0
+    return [
+        {"$set": {
+            "group_id": {"$literal": poll['group_id']},
+            "user_id": {"$literal": user_id},
+            "attend": _count("attend", attended),
+            "absent": _count("absent", 1 - attended),
+            "votes": _count("votes", 1),
+            f"months.{month}.attend": _count(f"months.{month}.attend", attended),
+            f"months.{month}.absent": _count(f"months.{month}.absent", 1 - attended),
+            "current_streak": _count("current_streak", 1) if attended else 0,
+            "last_poll_id": {"$literal": poll['poll_id']},
+            "updated_at": now
+        }},
+        {"$set": {"best_streak": {"$max": [{"$ifNull": ["$best_streak", 0]}, "$current_streak"]}}}
+    ]
+
+
+def record_closed_poll(db, poll, session=None):
+    """投票結束時增量更新彙總文件
+    以 last_poll_id 防止同一投票被重複計入：重試時先略過已計入的文件；
+    交易外同時計入時已計入的文件不會匹配，upsert 會因唯一索引產生重複鍵錯誤而被忽略。
+    參數:
+        db: Database對象
+        poll: 已結束的投票數據
+        session: 可選，交易的session；交易中發生錯誤時拋出例外，結果訊息一起中止並由排程任務重試
+    返回:
+        操作結果
+    """
+    poll_id = poll.get('poll_id')
+    group_id = poll.get('group_id')
+    voters = poll_schema.voters(poll)
+    now = datetime.now()
+
+    stats_db = db.group_db(group_id)
+
+    try:
+        # 重試時略過已計入的文件（交易中的重複鍵錯誤會中止整個交易，不能依靠唯一索引略過）
+        counted = {doc['user_id'] for doc in stats_db[db.member_stats_collection].find(
+            {"group_id": group_id, "user_id": {"$in": list(voters)}, "last_poll_id": poll_id},
+            {"_id": 0, "user_id": 1}, session=session)} if voters else set()
+        pending = {user_id: option for user_id, option in voters.items() if user_id not in counted}
+        if pending:
+            requests = [
+                pymongo.UpdateOne(
+                    {"group_id": group_id, "user_id": user_id, "last_poll_id": {"$ne": poll_id}},
+                    _member_update(poll, user_id, option, now),
+                    upsert=True
+                )
+                for user_id, option in pending.items()
+            ]
+            try:
+                stats_db[db.member_stats_collection].bulk_write(requests, ordered=False, session=session)
+            except pymongo.errors.BulkWriteError as e:
+                if session is not None or any(error.get('code') != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+                    raise
+
+        attend_count = sum(1 for option in voters.values() if option == 'attend')
+        absent_count = len(voters) - attend_count
+        month = _month(poll)
+        group_counted = stats_db[db.group_stats_collection].find_one(
+            {"group_id": group_id, "last_poll_id": poll_id}, {"_id": 1}, session=session)
+        try:
+            if not group_counted:
+                stats_db[db.group_stats_collection].update_one(
+                    {"group_id": group_id, "last_poll_id": {"$ne": poll_id}},
+                    {
+                        "$inc": {
+                            "polls": 1,
+                            "attend": attend_count,
+                            "absent": absent_count,
+                            f"months.{month}.polls": 1,
+                            f"months.{month}.attend": attend_count,
+                            f"months.{month}.absent": absent_count
+                        },
+                        "$set": {"last_poll_id": poll_id, "updated_at": now}
+                    },
+                    upsert=True,
+                    session=session
+                )
+        except pymongo.errors.DuplicateKeyError:
+            if session is not None:
+                raise
+
+        logger.info(f"已更新出席統計: {poll_id}, 成員數: {len(voters)}")
+        return True
+    except Exception as e:
+        if session is not None:
+            raise
+        logger.error(f"更新出席統計時發生錯誤: {e}")
+        return False
+
+
+@db_policy.route('history')
+def get_member_stats(db, group_id, user_id):
+    """讀取成員的出席統計（單次索引查詢）
+    參數:
+        db: Database對象
+        group_id: 群組ID
+        user_id: 用戶ID
+    返回:
+        統計文件，不存在則返回None
+    """
+    try:
+        return db.group_db(group_id)[db.member_stats_collection].find_one(
+            {"group_id": group_id, "user_id": user_id}, {"_id": 0}
+        )
+    except Exception as e:
+        logger.error(f"讀取出席統計時發生錯誤: {e}")
+        return None
+
+
+def format_member_stats(stats, name=None):
+    """將成員統計格式化為文字訊息"""
+    if not stats or not stats.get('votes'):
+        return "目前沒有您的出席記錄"
+
+    rate = stats.get('attend', 0) / stats['votes'] * 100
+    lines = [
+        f"📈 {name or '您'}的出席統計",
+        f"出席: {stats.get('attend', 0)} 次 / 請假: {stats.get('absent', 0)} 次",
+        f"出席率: {rate:.1f}%",
+        f"目前連續出席: {stats.get('current_streak', 0)} 次",
+        f"最長連續出席: {stats.get('best_streak', 0)} 次",
+    ]
+    months = stats.get('months', {})
+    if months:
+        lines.append("")
+        lines.append("最近月份:")
+        for month in sorted(months, reverse=True)[:3]:
+            summary = months[month]
+            lines.append(f"{month}  ✅{summary.get('attend', 0)}  ❌{summary.get('absent', 0)}")
+    return "\n".join(lines)
+
+
+# ===== 完整重建 =====
+
+def _streak_reduce(outcomes):
+    """以 $reduce 依序計算目前與最長連續出席"""
+    return {"$reduce": {
+        "input": outcomes,
+        "initialValue": {"current": 0, "best": 0},
+        "in": {
+            "current": {"$cond": [{"$eq": ["$$this", "attend"]}, {"$add": ["$$value.current", 1]}, 0]},
+            "best": {"$max": [
+                "$$value.best",
+                {"$cond": [{"$eq": ["$$this", "attend"]}, {"$add": ["$$value.current", 1]}, 0]}
+            ]}
+        }
+    }}
+
+
+def _votes_stages(votes_collection):
+    return poll_schema.votes_lookup_stages(votes_collection) if votes_collection else []
+
+
+def member_rebuild_pipeline(match, votes_collection=None):
+    """從投票記錄重建 member_stats 的聚合管線
+    votes_collection: votes 集合模式下的集合名稱，投票記錄從該集合合併
+    """
+    return [
+        {"$match": match},
+        *_votes_stages(votes_collection),
+        # 依建立時間排序：舊式的數字ID和 ULID 混合時 poll_id 的字串順序不是時間順序
+        {"$sort": {"created_at": 1, "poll_id": 1}},
+        {"$project": {
+            "group_id": 1,
+            "poll_id": 1,
+            "month": {"$dateToString": {"format": "%Y-%m", "date": "$created_at"}},
+            "voters": poll_schema.voters_expression()
+        }},
+        {"$unwind": "$voters"},
+        # 先按 (群組, 成員, 月份) 彙總，保留投票順序
+        {"$group": {
+            "_id": {"group_id": "$group_id", "user_id": "$voters.k", "month": "$month"},
+            "attend": {"$sum": {"$cond": [{"$eq": ["$voters.v", "attend"]}, 1, 0]}},
+            "absent": {"$sum": {"$cond": [{"$eq": ["$voters.v", "absent"]}, 1, 0]}},
+            "outcomes": {"$push": "$voters.v"},
+            "last_poll_id": {"$last": "$poll_id"}
+        }},
+        {"$sort": {"_id.month": 1}},
+        {"$group": {
+            "_id": {"group_id": "$_id.group_id", "user_id": "$_id.user_id"},
+            "attend": {"$sum": "$attend"},
+            "absent": {"$sum": "$absent"},
+            "months": {"$push": {"k": "$_id.month", "v": {"attend": "$attend", "absent": "$absent"}}},
+            "outcomes": {"$push": "$outcomes"},
+            "last_poll_id": {"$last": "$last_poll_id"}
+        }},
+        {"$set": {
+            "outcomes": {"$reduce": {"input": "$outcomes", "initialValue": [], "in": {"$concatArrays": ["$$value", "$$this"]}}}
+        }},
+        {"$set": {"streak": _streak_reduce("$outcomes")}},
+        {"$project": {
+            "_id": 0,
+            "group_id": "$_id.group_id",
+            "user_id": "$_id.user_id",
+            "attend": 1,
+            "absent": 1,
+            "votes": {"$add": ["$attend", "$absent"]},
+            "months": {"$arrayToObject": "$months"},
+            "current_streak": "$streak.current",
+            "best_streak": "$streak.best",
+            "last_poll_id": 1,
+            "updated_at": "$$NOW"
+        }}
+    ]
+
+
+def group_rebuild_pipeline(match, votes_collection=None):
+    """從投票記錄重建 group_stats 的聚合管線"""
+    return [
+        {"$match": match},
+        *_votes_stages(votes_collection),
+        {"$sort": {"created_at": 1, "poll_id": 1}},
+        {"$project": {
+            "group_id": 1,
+            "poll_id": 1,
+            "month": {"$dateToString": {"format": "%Y-%m", "date": "$created_at"}},
+            "attend": {"$size": {"$filter": {
+                "input": poll_schema.voters_expression(),
+                "cond": {"$eq": ["$$this.v", "attend"]}
+            }}},
+            "votes": {"$size": poll_schema.voters_expression()}
+        }},
+        {"$group": {
+            "_id": {"group_id": "$group_id", "month": "$month"},
+            "polls": {"$sum": 1},
+            "attend": {"$sum": "$attend"},
+            "absent": {"$sum": {"$subtract": ["$votes", "$attend"]}},
+            "last_poll_id": {"$last": "$poll_id"}
+        }},
+        {"$sort": {"_id.month": 1}},
+        {"$group": {
+            "_id": "$_id.group_id",
+            "polls": {"$sum": "$polls"},
+            "attend": {"$sum": "$attend"},
+            "absent": {"$sum": "$absent"},
+            "months": {"$push": {"k": "$_id.month", "v": {"polls": "$polls", "attend": "$attend", "absent": "$absent"}}},
+            "last_poll_id": {"$last": "$last_poll_id"}
+        }},
+        {"$project": {
+            "_id": 0,
+            "group_id": "$_id",
+            "polls": 1,
+            "attend": 1,
+            "absent": 1,
+            "months": {"$arrayToObject": "$months"},
+            "last_poll_id": 1,
+            "updated_at": "$$NOW"
+        }}
+    ]
+
+
+def rebuild(db, group_id=None):
+    """以聚合管線完整重建彙總文件（在伺服器端計算並以 $merge 寫回）
+    每個分片各自重建其群組的彙總
+    參數:
+        db: Database對象
+        group_id: 可選，只重建指定群組
+    """
+    match = {"status": "closed"}
+    scope = {}
+    if group_id:
+        match["group_id"] = group_id
+        scope["group_id"] = group_id
+
+    votes_collection = db.votes_collection if db.vote_storage == 'collection' else None
+    shards = [db.group_db(group_id)] if group_id else db.router.all_shards()
+    for shard_db in shards:
+        polls = shard_db[db.polls_collection]
+        member_stats = shard_db[db.member_stats_collection]
+        group_stats = shard_db[db.group_stats_collection]
+
+        member_stats.delete_many(scope)
+        polls.aggregate(
+            member_rebuild_pipeline(match, votes_collection) + [{"$merge": {
+                "into": db.member_stats_collection,
+                "on": ["group_id", "user_id"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }}],
+            allowDiskUse=True
+        )
+
+        group_stats.delete_many(scope)
+        polls.aggregate(
+            group_rebuild_pipeline(match, votes_collection) + [{"$merge": {
+                "into": db.group_stats_collection,
+                "on": "group_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }}],
+            allowDiskUse=True
+        )
+    logger.info(f"已重建出席統計: {group_id or '全部群組'}")
+
+
+def main(argv=None):
+    from db import Database
+
+    parser = argparse.ArgumentParser(description="出席統計工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="從投票記錄完整重建彙總")
+    rebuild_parser.add_argument("--group", help="只重建指定群組")
+    args = parser.parse_args(argv)
+
+    db = Database()
+    try:
+        if args.command == "rebuild":
+            rebuild(db, args.group)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
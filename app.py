@@ -1,21 +1,46 @@
+import startup
 import os
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage,
-    PostbackEvent, JoinEvent, SourceGroup, SourceRoom
-)
+import re
+import sys
+import atexit
+import signal
+from flask import Flask, Response, request, abort
 from dotenv import load_dotenv
 import logging
-from poll import create_poll, end_poll, handle_postback
+from poll import create_poll, end_poll, publish_results, show_poll_status, handle_postback, handle_vote_batch, parse_vote_data, submit_vote, VoteEvent, vote_debouncer
+import webhook_fastpath
 import volleyScheduler as scheduler
 from db import Database
+from idgen import id_timestamp
+import analytics
+import metrics
+import outbox
+import delivery
+import quota
+import history_api
+import change_listener
+import profiler
+import tracing
+import async_bridge
+
+# LINE SDK（匯入時會載入整個 linebot.models），延遲載入模式下第一次使用時才匯入
+models = startup.lazy_module('linebot.models')
+linebot_exceptions = startup.lazy_module('linebot.exceptions')
+
+startup.checkpoint("imports")
 
 load_dotenv()
 app = Flask(__name__)
-# 初始化數據庫連接
-db = Database()
+
+def create_database():
+    """建立Database（非同步模式下以motor連接）"""
+    if async_bridge.enabled():
+        from async_mongo import AsyncDatabase
+        return AsyncDatabase()
+    return Database()
+
+# 初始化數據庫連接（延遲載入模式下第一次使用時才連接並建立索引）
+db = startup.lazy_object("database", create_database)
 
 # 設定日誌
 logging.basicConfig(
@@ -37,8 +62,26 @@ LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', None)
 # 您需要獲取目標群組的ID
 TARGET_GROUP_ID = os.environ.get('GROUP_ID')
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+# 開發者用戶ID，可使用管理指令
+DEV_USER_ID = os.environ.get('DEV_USER_ID')
+
+# 批次模式：同一次webhook的多個投票合併寫入
+WEBHOOK_BATCH_MODE = os.environ.get('WEBHOOK_BATCH_MODE', '0') == '1'
+# 快速路徑：投票postback直接解析所需欄位
+WEBHOOK_FAST_PATH = os.environ.get('WEBHOOK_FAST_PATH', '1') == '1'
+
+# /poll 標題結尾的名額設定
+CAPACITY_PATTERN = re.compile(r'\s+名額\s*[:：=]?\s*(\d+)\s*$')
+
+def create_line_bot_api():
+    """建立使用共用連線池和逾時設定的LineBotApi"""
+    import line_client
+    return line_client.create_line_bot_api(LINE_CHANNEL_ACCESS_TOKEN)
+
+# webhook處理和排程器共用
+line_bot_api = startup.lazy_object("line_bot_api", create_line_bot_api)
+
+startup.checkpoint("config")
 
 
 
@@ -50,7 +93,8 @@ def init_scheduler():
         TARGET_GROUP_ID,
         create_poll,
         end_poll,
-        db
+        db,
+        publish_results
     )
     scheduler.start_scheduler()
     logger.info("排程器已初始化並啟動")
@@ -61,24 +105,92 @@ def callback():
     # 獲取Line傳來的簽名與請求內容
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    
+    if not process_webhook(body, signature):
+        abort(400)
+    return 'OK'
+
+@app.route("/api/<path:path>", methods=['GET'])
+def api(path):
+    """唯讀查詢API：投票列表、投票結果和群組成員（見 history_api.py）"""
+    status, headers, body = history_api.handle(db, request.method, "/api/" + path, request.args, request.headers)
+    return Response(body, status=status, headers=headers)
+
+@profiler.profiled("callback")
+@tracing.traced("webhook.callback")
+def process_webhook(body, signature):
+    """驗證簽名並處理一次webhook（Flask和ASGI模式共用）
+    參數:
+        body: 請求內容
+        signature: X-Line-Signature標頭
+    返回:
+        簽名是否有效
+    """
     # 記錄接收到的請求
     logger.info("Request body: " + body)
 
+    # 快速路徑：只含投票postback的請求不經過SDK的模型轉換
+    if WEBHOOK_FAST_PATH:
+        if not webhook_fastpath.verify_signature(body, signature, LINE_CHANNEL_SECRET):
+            logger.error("簽名驗證失敗")
+            return False
+        vote_events = webhook_fastpath.parse_vote_events(body)
+        if vote_events is not None:
+            if WEBHOOK_BATCH_MODE:
+                handle_vote_batch(vote_events, line_bot_api, db)
+            else:
+                for vote_event in vote_events:
+                    submit_vote(vote_event, line_bot_api, db)
+            startup.mark_first_webhook()
+            return True
+
     try:
         # 驗證簽名並處理webhook事件
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+        if WEBHOOK_BATCH_MODE:
+            handle_batch(body, signature)
+        else:
+            handler.handle(body, signature)
+    except linebot_exceptions.InvalidSignatureError:
         logger.error("簽名驗證失敗")
-        abort(400)
+        return False
     
-    return 'OK'
+    startup.mark_first_webhook()
+    return True
+
+def handle_batch(body, signature):
+    """批次處理一次webhook傳來的所有事件
+    投票事件依投票分組後一次寫入，其他事件按原本的處理函數逐一分派
+    """
+    events = handler.parser.parse(body, signature)
+
+    vote_events = []
+    for event in events:
+        parsed = None
+        if isinstance(event, models.PostbackEvent):
+            parsed = parse_vote_data(event.postback.data)
+        if parsed:
+            poll_id, vote = parsed
+            vote_events.append(VoteEvent(poll_id, vote, event.source.user_id, event.reply_token,
+                                         event.source.type == 'user'))
+        else:
+            dispatch_event(event)
+
+    if vote_events:
+        handle_vote_batch(vote_events, line_bot_api, db)
+
+def dispatch_event(event):
+    """將單一事件交給對應的處理函數（與handler註冊的對應關係一致）"""
+    if isinstance(event, models.MessageEvent) and isinstance(event.message, models.TextMessage):
+        handle_text_message(event)
+    elif isinstance(event, models.PostbackEvent):
+        handle_postback_func(event)
+    elif isinstance(event, models.JoinEvent):
+        handle_join(event)
 
-@handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     """處理文字消息事件"""
     text = event.message.text
     user_id = event.source.user_id
+    delivery.received(event.reply_token)
 
     # 記錄用戶ID
     logger.info(f"收到用戶 {user_id} 的消息: {text}")
@@ -95,14 +207,17 @@ def handle_text_message(event):
         command = text.split(' ')[0].lower()
         
         if command == '/poll':
-            # 格式: /createpoll 投票標題
+            # 格式: /poll 投票標題 [名額:人數]
             if len(text.split(' ', 1)) > 1:
-                title = text.split(' ', 1)[1]
-                create_poll(db=db, title=title, group_id=group_id, line_bot_api=line_bot_api)
+                title, capacity = parse_poll_title(text.split(' ', 1)[1])
+                # 在群組中下指令時，投票訊息以回覆發送到該群組
+                reply_token = event.reply_token if source_type == 'group' else None
+                create_poll(db=db, title=title, group_id=group_id, line_bot_api=line_bot_api, capacity=capacity,
+                            reply_token=reply_token)
             else:
                 line_bot_api.reply_message(
                     event.reply_token,
-                    TextSendMessage(text="請提供投票標題，格式：/poll 投票標題")
+                    models.TextSendMessage(text="請提供投票標題，格式：/poll 投票標題 [名額:人數]")
                 )
         
         elif command == '/endpoll':
@@ -112,55 +227,150 @@ def handle_text_message(event):
                 end_poll(event=event, poll_id=poll_id, line_bot_api=line_bot_api, db=db)
             else:
                 # 如果沒有提供ID，嘗試找出最新的投票
-                relevant_polls = []
-                active_polls = db.get_active_polls()
-                for poll in active_polls:
-                    if poll.get('group_id') == group_id:
-                        relevant_polls.append((poll.get('poll_id')))
+                relevant_polls = [poll.get('poll_id') for poll in db.get_active_polls(group_id)]
                 logger.info(f"找到的活動投票: {relevant_polls}")
                 if relevant_polls:
-                    # 按時間排序，選最新的結束
-                    newest_poll = sorted(relevant_polls)
-                    end_poll(event, newest_poll[0], line_bot_api, db)
+                    # 按ID中的時間選最新的結束（兼容舊的秒級時間戳ID）
+                    newest_poll = max(relevant_polls, key=lambda pid: id_timestamp(pid) or 0)
+                    end_poll(event, newest_poll, line_bot_api, db)
                 else:
                     line_bot_api.reply_message(
                         event.reply_token,
-                        TextSendMessage(text="沒有找到活動的投票。請提供投票ID，格式：/endpoll 投票ID")
+                        models.TextSendMessage(text="沒有找到活動的投票。請提供投票ID，格式：/endpoll 投票ID")
                     )
 
+        elif command == '/status':
+            # 格式: /status [投票ID]，查看投票目前的結果（不結束投票）
+            if len(text.split(' ', 1)) > 1:
+                poll_id = text.split(' ', 1)[1]
+            else:
+                active_polls = db.get_active_polls(group_id)
+                poll_id = active_polls[0].get('poll_id') if active_polls else None
+            if poll_id:
+                show_poll_status(event, poll_id, line_bot_api, db)
+            else:
+                line_bot_api.reply_message(
+                    event.reply_token,
+                    models.TextSendMessage(text="沒有找到活動的投票。請提供投票ID，格式：/status 投票ID")
+                )
+
+        elif command == '/stats':
+            # 從彙總文件讀取出席統計
+            stats = analytics.get_member_stats(db, group_id, user_id)
+            line_bot_api.reply_message(
+                event.reply_token,
+                models.TextSendMessage(text=analytics.format_member_stats(stats))
+            )
+
+        elif command == '/metrics' and user_id == DEV_USER_ID:
+            # 開發者專用：查看行程內的指標
+            line_bot_api.reply_message(
+                event.reply_token,
+                models.TextSendMessage(text=metrics.format_snapshot())
+            )
+
+        elif command == '/profile' and user_id == DEV_USER_ID:
+            # 開發者專用：切換請求分析，格式：/profile on [抽樣比例] [門檻ms] | off | dump | status
+            line_bot_api.reply_message(
+                event.reply_token,
+                models.TextSendMessage(text=profiler.handle_command(text.split()[1:]))
+            )
+
+        elif command == '/quota' and user_id == DEV_USER_ID:
+            # 開發者專用：查看訊息額度的用量、推估和預算模式
+            line_bot_api.reply_message(
+                event.reply_token,
+                models.TextSendMessage(text=quota.report())
+            )
+
+        elif command == '/jobs' and user_id == DEV_USER_ID:
+            # 開發者專用：查看排程任務最近一次的執行狀態
+            line_bot_api.reply_message(
+                event.reply_token,
+                models.TextSendMessage(text=scheduler.job_status())
+            )
+
+        elif command == '/startup' and user_id == DEV_USER_ID:
+            # 開發者專用：查看啟動時間分析
+            line_bot_api.reply_message(
+                event.reply_token,
+                models.TextSendMessage(text=startup.report())
+            )
+
         elif command == '/help':
             help_message = (
                 "📋 投票系統使用說明：\n"
-                "- /createpoll 標題 - 創建新投票\n"
+                "- /poll 標題 [名額:人數] - 創建新投票，額滿後依序候補\n"
                 "- /endpoll 投票ID - 結束投票並顯示結果\n"
+                "- /status 投票ID - 查看投票目前的結果\n"
+                "- /stats - 查看自己的出席統計\n"
                 "- /help - 顯示此幫助信息"
             )
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text=help_message)
+                models.TextSendMessage(text=help_message)
             )
         else:
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="無效的指令。使用 /help 來獲取幫助信息")
+                models.TextSendMessage(text="無效的指令。使用 /help 來獲取幫助信息")
             )  
     
-@handler.add(PostbackEvent)
+def parse_poll_title(text):
+    """從 /poll 的參數取出標題和名額（結尾的「名額:12」，冒號可省略）
+    返回:
+        (標題, 名額或None)
+    """
+    match = CAPACITY_PATTERN.search(text)
+    if not match or int(match.group(1)) <= 0:
+        return text, None
+    return text[:match.start()].strip() or text, int(match.group(1))
+
 def handle_postback_func(event):
    handle_postback(event=event,line_bot_api=line_bot_api,db=db)
 
-@handler.add(JoinEvent)
 def handle_join(event):
     """處理機器人被加入群組或聊天室的事件"""
-    if isinstance(event.source, SourceGroup):
+    if isinstance(event.source, models.SourceGroup):
         group_id = event.source.group_id
         logger.info(f"被加入群組 {group_id}")
 
-if __name__ == "__main__":
-    
+def create_webhook_handler():
+    """建立SDK的WebhookHandler並註冊事件處理函數"""
+    from linebot import WebhookHandler
+    webhook_handler = WebhookHandler(LINE_CHANNEL_SECRET)
+    webhook_handler.add(models.MessageEvent, message=models.TextMessage)(handle_text_message)
+    webhook_handler.add(models.PostbackEvent)(handle_postback_func)
+    webhook_handler.add(models.JoinEvent)(handle_join)
+    return webhook_handler
+
+# 非投票事件才需要SDK的handler
+handler = startup.lazy_object("webhook_handler", create_webhook_handler)
+
+# 行程結束時（gunicorn 重啟工作程序、SIGTERM）立即處理合併視窗中等待的投票；
+# ASGI 模式在 lifespan shutdown 時處理，這裡再執行時已沒有等待的投票
+atexit.register(vote_debouncer.flush_all)
+
+def start_background_tasks():
+    """啟動排程器、發件匣投遞和變更監聽（Flask和ASGI模式共用）"""
     # 初始化並啟動排程器
     init_scheduler()
 
+    # 啟動發件匣投遞執行緒（會先補送上次中止前未送達的訊息）
+    outbox.start_worker(db, line_bot_api)
+
+    # 監聽其他副本的寫入，使本行程的快取失效
+    change_listener.start(db)
+
+    logger.info("啟動時間分析:\n" + startup.report())
+
+if __name__ == "__main__":
+
+    # SIGTERM 預設直接結束行程、不執行 atexit；改為正常結束才會處理等待中的投票
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    start_background_tasks()
+
     # 設定服務器端口
     port = int(os.environ.get('PORT', 7988))
     
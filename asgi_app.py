@@ -0,0 +1,125 @@
+"""
+ASGI 進入點（非同步模式）
+
+與 Flask 模式執行相同的處理邏輯（app.process_webhook → create_poll、handle_postback、end_poll 等），
+但 MongoDB 經由 motor、LINE API 經由 httpx 存取，每個 webhook 在事件迴圈上的一個 greenlet 中處理（見 async_bridge）。
+等待 LINE 或 MongoDB 時不佔用執行緒，同時處理的請求數只受 ASYNC_MAX_CONCURRENCY 限制。
+排程器在事件迴圈上執行；發件匣投遞和 change stream 監聽仍是背景執行緒，經由事件迴圈存取資料庫。
+
+用法:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 7988
+"""
+import asyncio
+import importlib
+import logging
+import os
+from urllib.parse import parse_qsl
+import async_bridge
+import history_api
+
+logger = logging.getLogger(__name__)
+
+# 同時處理的webhook上限，超過時在此等待
+MAX_CONCURRENCY = int(os.environ.get('ASYNC_MAX_CONCURRENCY', '500'))
+
+
+async def _read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+async def _respond(send, status, body, headers=None):
+    headers = headers or {"Content-Type": "text/plain; charset=utf-8"}
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]})
+    await send({"type": "http.response.body", "body": body})
+
+
+class WebhookApp:
+    """處理 POST /callback 和唯讀查詢API（/api/...）的 ASGI 應用"""
+
+    def __init__(self):
+        self.bot = None
+        self._slots = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        if scope["path"].startswith("/api/"):
+            await self._api(scope, send)
+            return
+        if scope["path"] != "/callback":
+            await _respond(send, 404, b"Not Found")
+            return
+        if scope["method"] != "POST":
+            await _respond(send, 405, b"Method Not Allowed")
+            return
+
+        body = await _read_body(receive)
+        signature = dict(scope["headers"]).get(b"x-line-signature")
+        if signature is None:
+            await _respond(send, 400, b"Bad Request")
+            return
+
+        try:
+            async with self._slots:
+                valid = await async_bridge.run_sync(self.bot.process_webhook, body.decode("utf-8"), signature.decode("latin-1"))
+        except Exception:
+            logger.exception("處理webhook時發生錯誤")
+            await _respond(send, 500, b"Internal Server Error")
+            return
+        if valid:
+            await _respond(send, 200, b"OK")
+        else:
+            await _respond(send, 400, b"Bad Request")
+
+    async def _api(self, scope, send):
+        args = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        async with self._slots:
+            status, response_headers, body = await async_bridge.run_sync(
+                history_api.handle, self.bot.db, scope["method"], scope["path"], args, headers)
+        await _respond(send, status, body, response_headers)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.exception("非同步模式啟動失敗")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        async_bridge.enable(asyncio.get_running_loop())
+        self._slots = asyncio.Semaphore(MAX_CONCURRENCY)
+        # app 模組在匯入時建立 Database 和 LineBotApi（連線、建立索引），需在 greenlet 中匯入才能等待 motor
+        self.bot = await async_bridge.run_sync(importlib.import_module, "app")
+        await async_bridge.run_sync(self.bot.start_background_tasks)
+        logger.info(f"非同步模式已啟動，同時處理上限: {MAX_CONCURRENCY}")
+
+    async def shutdown(self):
+        import poll
+        import line_client
+        # 合併視窗中尚未寫入的投票立即處理
+        await async_bridge.run_sync(poll.vote_debouncer.flush_all)
+        await line_client.close_async_client()
+        await async_bridge.run_sync(self.bot.db.close)
+
+
+app = WebhookApp()
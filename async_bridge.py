@@ -0,0 +1,121 @@
+"""
+非同步模式的同步/非同步橋接
+
+asgi_app 在事件迴圈上執行與 Flask 模式相同的同步處理邏輯（create_poll、handle_postback、end_poll 等）。
+每個請求以 run_sync 在一個 greenlet 中執行同步函數；同步程式碼經由 call 呼叫非同步驅動
+（motor、httpx）時，greenlet 切換回事件迴圈等待結果，等待期間事件迴圈處理其他請求。
+因此同時處理的請求數不受執行緒數限制，一個請求只佔用一個 greenlet。
+
+不在事件迴圈執行緒上的呼叫（發件匣、change stream、合併視窗的執行緒）改為把協程提交到事件迴圈並阻塞等待。
+在事件迴圈上但不在 greenlet 中的呼叫無法等待，會拋出 RuntimeError。
+"""
+import asyncio
+import contextvars
+import inspect
+import sys
+import threading
+
+_loop = None
+_loop_thread = None
+_tasks = set()
+# 只有非同步模式需要 greenlet，啟用時才匯入
+_Worker = None
+getcurrent = None
+
+
+def enable(loop):
+    """啟用非同步模式，之後的 call 都在此事件迴圈上執行"""
+    global _loop, _loop_thread, _Worker, getcurrent
+    from greenlet import greenlet, getcurrent
+
+    class Worker(greenlet):
+        """執行同步函數的 greenlet，parent 是驅動它的協程所在的 greenlet"""
+
+    _Worker = Worker
+    _loop = loop
+    _loop_thread = threading.get_ident()
+
+
+def enabled():
+    """是否為非同步模式（asgi_app 啟動後）"""
+    return _loop is not None
+
+
+def loop():
+    return _loop
+
+
+def on_loop_thread():
+    """目前是否在事件迴圈的執行緒上（包括其中的 greenlet）"""
+    return _loop is not None and threading.get_ident() == _loop_thread
+
+
+async def run_sync(func, *args, **kwargs):
+    """在 greenlet 中執行同步函數，函數內的 call 在此協程中等待
+    參數:
+        func: 同步函數
+    返回:
+        函數的返回值
+    """
+    worker = _Worker(func, getcurrent())
+    # 每個 greenlet 有自己的 contextvars，從目前的任務複製（追蹤區段、資料庫路由）
+    worker.gr_context = contextvars.copy_context()
+    result = worker.switch(*args, **kwargs)
+    while not worker.dead:
+        try:
+            value = await result
+        except BaseException:
+            result = worker.throw(*sys.exc_info())
+        else:
+            result = worker.switch(value)
+    return result
+
+
+def call(func, *args, **kwargs):
+    """從同步程式碼呼叫非同步驅動的方法，返回 awaitable 時等待其結果
+    其他執行緒中的呼叫在事件迴圈上執行（motor、httpx 的對象不是執行緒安全的）
+    參數:
+        func: motor 或 httpx 的方法
+    返回:
+        方法的返回值，或 awaitable 的結果
+    """
+    current = getcurrent() if getcurrent else None
+    if _Worker is not None and isinstance(current, _Worker):
+        result = func(*args, **kwargs)
+        if inspect.isawaitable(result):
+            return current.parent.switch(result)
+        return result
+    if _loop is None:
+        raise RuntimeError("非同步模式尚未啟用")
+    if threading.get_ident() == _loop_thread:
+        raise RuntimeError("事件迴圈上的同步程式碼必須經由 run_sync 執行")
+
+    async def invoke():
+        result = func(*args, **kwargs)
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    return asyncio.run_coroutine_threadsafe(invoke(), _loop).result()
+
+
+def _start(func, args):
+    task = _loop.create_task(run_sync(func, *args))
+    # 事件迴圈只保留任務的弱參考，執行完畢前由此保存
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def call_later(delay, func, *args):
+    """delay 秒後在事件迴圈上以新的 greenlet 執行同步函數（可從任何執行緒呼叫）"""
+    def schedule():
+        _loop.call_later(delay, _start, func, args)
+    _loop.call_soon_threadsafe(schedule)
+
+
+def spawn(func, *args):
+    """在事件迴圈上以新的 greenlet 執行同步函數（可從任何執行緒呼叫），不等待結果
+    返回:
+        concurrent.futures.Future
+    """
+    return asyncio.run_coroutine_threadsafe(run_sync(func, *args), _loop)
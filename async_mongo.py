@@ -0,0 +1,142 @@
+"""
+以 motor 取代 pymongo 的 Database（非同步模式）
+
+Database 和其他模組照常以 pymongo 的同步介面操作（client[...]、find、find_one_and_update、bulk_write、
+start_session、watch 等），這裡的外觀類別把每個呼叫轉給 motor，並經由 async_bridge.call 等待結果。
+在 run_sync 的 greenlet 中等待時事件迴圈繼續處理其他請求；其他執行緒中的呼叫則阻塞該執行緒。
+pymongo 的類型（UpdateOne、ReturnDocument、例外）與 motor 共用，不需要轉換。
+"""
+import logging
+import async_bridge
+from db import Database
+
+# 第一次建立連線時才匯入motor
+motor_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+# 迭代游標時每次取回的文件數
+CURSOR_BATCH = 200
+
+
+def _unwrap(value):
+    """把外觀對象換回 motor 對象（例如以 session= 傳入的 session）"""
+    if isinstance(value, (_Facade, _Session)):
+        return value._target
+    return value
+
+
+def _adapt(value):
+    """把 motor 返回的對象包成對應的外觀"""
+    if isinstance(value, motor_asyncio.AsyncIOMotorClient):
+        return _Client(value)
+    if isinstance(value, (motor_asyncio.AsyncIOMotorDatabase, motor_asyncio.AsyncIOMotorCollection)):
+        return _Facade(value)
+    if isinstance(value, motor_asyncio.AsyncIOMotorChangeStream):
+        return _ChangeStream(value)
+    if isinstance(value, (motor_asyncio.AsyncIOMotorCursor, motor_asyncio.AsyncIOMotorCommandCursor,
+                          motor_asyncio.AsyncIOMotorLatentCommandCursor)):
+        return _Cursor(value)
+    return value
+
+
+class _Facade:
+    """motor 的 Database、Collection 的同步外觀"""
+    __slots__ = ("_target",)
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getitem__(self, name):
+        return _Facade(self._target[name])
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        # motor 的 Database 和 Collection 以屬性存取子集合，它們也是 callable
+        if not callable(attr) or isinstance(attr, (motor_asyncio.AsyncIOMotorDatabase, motor_asyncio.AsyncIOMotorCollection)):
+            return _adapt(attr)
+
+        def method(*args, **kwargs):
+            args = [_unwrap(arg) for arg in args]
+            kwargs = {key: _unwrap(value) for key, value in kwargs.items()}
+            return _adapt(async_bridge.call(attr, *args, **kwargs))
+
+        return method
+
+    def __eq__(self, other):
+        return isinstance(other, _Facade) and self._target == other._target
+
+    def __hash__(self):
+        return id(self._target)
+
+
+class _Client(_Facade):
+    """AsyncIOMotorClient 的同步外觀"""
+    __slots__ = ()
+
+    def start_session(self, **kwargs):
+        return _Session(self._target, kwargs)
+
+    def close(self):
+        self._target.close()
+
+
+class _Cursor(_Facade):
+    """游標：sort、limit 等設定照常鏈接，迭代時分批取回"""
+    __slots__ = ()
+
+    def __iter__(self):
+        while True:
+            batch = async_bridge.call(self._target.to_list, CURSOR_BATCH)
+            if not batch:
+                return
+            yield from batch
+
+
+class _ChangeStream(_Facade):
+    """change stream：支援 with、try_next、next 和 resume_token"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        async_bridge.call(self._target.close)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return async_bridge.call(self._target.next)
+
+
+class _Session:
+    """ClientSession 的同步外觀，with_transaction 的 callback 在新的 greenlet 中執行"""
+
+    def __init__(self, client, options):
+        self._client = client
+        self._options = options
+        self._target = None
+
+    def __enter__(self):
+        self._target = async_bridge.call(self._client.start_session, **self._options)
+        return self
+
+    def __exit__(self, *exc_info):
+        async_bridge.call(self._target.end_session)
+
+    def with_transaction(self, callback, **kwargs):
+        async def run(_session):
+            return await async_bridge.run_sync(callback, self)
+        return async_bridge.call(self._target.with_transaction, run, **kwargs)
+
+
+class AsyncDatabase(Database):
+    """以 motor 連接 MongoDB 的 Database，其餘方法與 Database 相同"""
+
+    def create_client(self):
+        global motor_asyncio
+        import motor.motor_asyncio
+        motor_asyncio = motor.motor_asyncio
+        logger.info("非同步模式：以motor連接MongoDB")
+        return _Client(async_bridge.call(motor_asyncio.AsyncIOMotorClient, self.mongo_uri, io_loop=async_bridge.loop()))
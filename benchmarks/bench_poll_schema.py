@@ -0,0 +1,120 @@
+"""
+比較投票文件 v1 與 v2 結構：文件大小和每票的更新延遲
+
+文件大小以 BSON 編碼計算，不需要資料庫。
+指定 --mongo 時在 MONGODB_URI 的暫存資料庫中測量每票的更新延遲：
+    v1: 讀取投票 + $pull + $addToSet + $set（原本的 add_vote）
+    v2: 一次 find_one_and_update 管線更新（現在的 add_vote）
+用法（在專案根目錄執行）:
+    python benchmarks/bench_poll_schema.py [--voters 10 30 100] [--mongo] [--rounds 300]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bson
+import pymongo
+import poll_schema
+
+
+def user_id(i):
+    return f"U{i:032x}"
+
+
+def make_v1(voter_count):
+    voters = {user_id(i): random.choice(poll_schema.OPTIONS) for i in range(voter_count)}
+    return {
+        "poll_id": "01JABCDEFGHJKMNPQRSTVWXYZ0",
+        "title": "週三晚上 19:00 排球",
+        "group_id": "C" + "0" * 32,
+        "created_at": datetime.now(),
+        "updated_at": datetime.now(),
+        "status": "active",
+        "version": 0,
+        "options": {option: [u for u, o in voters.items() if o == option] for option in poll_schema.OPTIONS},
+        "voters": voters,
+    }
+
+
+def make_v2(voter_count):
+    v1 = make_v1(voter_count)
+    v2 = {k: v for k, v in v1.items() if k not in ("options", "voters")}
+    v2.update(poll_schema.new_poll_fields())
+    for u, option in v1["voters"].items():
+        v2["v"][u] = poll_schema.OPTIONS.index(option)
+        v2["counts"][option] += 1
+    return v2
+
+
+def vote_v1(polls, poll_id, uid, option):
+    poll = polls.find_one({"poll_id": poll_id})
+    prev = poll.get("voters", {}).get(uid)
+    if prev:
+        polls.update_one({"poll_id": poll_id}, {"$pull": {f"options.{prev}": uid}})
+    polls.update_one({"poll_id": poll_id}, {"$addToSet": {f"options.{option}": uid}})
+    polls.update_one({"poll_id": poll_id}, {"$set": {f"voters.{uid}": option, "updated_at": datetime.now()},
+                                            "$inc": {"version": 1}})
+
+
+def vote_v2(polls, poll_id, uid, option):
+    polls.find_one_and_update(
+        {"poll_id": poll_id},
+        poll_schema.vote_pipeline(uid, option, datetime.now()),
+        projection=poll_schema.previous_option_projection(uid),
+        return_document=pymongo.ReturnDocument.BEFORE
+    )
+
+
+def bench_latency(polls, make, vote, voter_count, rounds):
+    polls.delete_many({})
+    doc = make(voter_count)
+    polls.insert_one(doc)
+    samples = []
+    for i in range(rounds):
+        uid = user_id(random.randrange(voter_count * 2))
+        start = time.perf_counter()
+        vote(polls, doc["poll_id"], uid, random.choice(poll_schema.OPTIONS))
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.mean(samples), samples[int(len(samples) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voters", type=int, nargs="+", default=[10, 30, 100])
+    parser.add_argument("--mongo", action="store_true", help="測量每票的更新延遲（需要可連線的MongoDB）")
+    parser.add_argument("--rounds", type=int, default=300)
+    args = parser.parse_args()
+
+    random.seed(1)
+    print(f"{'投票者':>6} {'v1 位元組':>10} {'v2 位元組':>10} {'縮小':>7}")
+    for count in args.voters:
+        v1 = len(bson.encode(make_v1(count)))
+        v2 = len(bson.encode(make_v2(count)))
+        print(f"{count:>6} {v1:>10} {v2:>10} {1 - v2 / v1:>6.1%}")
+
+    if not args.mongo:
+        return
+
+    client = pymongo.MongoClient(os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    database = client["bench_poll_schema"]
+    try:
+        print()
+        print(f"{'投票者':>6} {'v1 平均ms':>10} {'v1 p95':>8} {'v2 平均ms':>10} {'v2 p95':>8}")
+        for count in args.voters:
+            v1_avg, v1_p95 = bench_latency(database["polls_v1"], make_v1, vote_v1, count, args.rounds)
+            v2_avg, v2_p95 = bench_latency(database["polls_v2"], make_v2, vote_v2, count, args.rounds)
+            print(f"{count:>6} {v1_avg:>10.2f} {v1_p95:>8.2f} {v2_avg:>10.2f} {v2_p95:>8.2f}")
+    finally:
+        client.drop_database("bench_poll_schema")
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
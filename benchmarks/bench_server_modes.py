@@ -0,0 +1,208 @@
+"""
+以相同的webhook負載比較同步模式（Flask + gunicorn 執行緒）和非同步模式（asgi_app + uvicorn）
+
+本程式在行程內啟動模擬的 LINE API（每個請求延遲 --line-latency 毫秒），
+再依序以子行程啟動兩種模式的伺服器，送出相同數量、相同並行度的已簽名投票webhook，
+記錄吞吐量、延遲百分位數和錯誤數，最後檢查投票文件的票數與投票人數一致。
+需要可連線的MongoDB（MONGODB_URI），使用暫存資料庫 bench_server_modes。
+用法（在專案根目錄執行）:
+    python benchmarks/bench_server_modes.py [--requests 2000] [--concurrency 200] [--threads 8] [--line-latency 80]
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['MONGODB_DB'] = 'bench_server_modes'
+os.environ.pop('MONGODB_SHARDS', None)
+
+import httpx
+import uvicorn
+from db import Database
+import poll_schema
+
+SECRET = "benchmark-secret"
+POLL_ID = "01JBENCHSERVERMODES0000000"
+GROUP_ID = "C" + "0" * 32
+
+line_calls = Counter()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_stub(latency):
+    """模擬的 LINE API：get_profile 返回名稱，額度端點返回不限量，其他端點返回 {}"""
+    async def stub(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        line_calls[scope["path"].split("/")[3] if scope["path"].count("/") >= 3 else scope["path"]] += 1
+        await asyncio.sleep(latency)
+        if "/profile/" in scope["path"]:
+            body = json.dumps({"displayName": "bench", "userId": scope["path"].rsplit("/", 1)[-1]}).encode()
+        elif scope["path"] == "/v2/bot/message/quota":
+            body = json.dumps({"type": "none"}).encode()
+        elif scope["path"] == "/v2/bot/message/quota/consumption":
+            body = json.dumps({"totalUsage": 0}).encode()
+        elif scope["path"].endswith("/members/count"):
+            body = json.dumps({"count": 1}).encode()
+        else:
+            body = b"{}"
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+    return stub
+
+
+def start_stub(port, latency):
+    server = uvicorn.Server(uvicorn.Config(make_stub(latency), host="127.0.0.1", port=port,
+                                           log_level="warning", lifespan="off"))
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+
+def user_id(i):
+    return f"U{i:032x}"
+
+
+def make_request(i, users):
+    event = {
+        "type": "postback",
+        "mode": "active",
+        "timestamp": 1700000000000 + i,
+        "webhookEventId": f"01H{i:023d}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"reply-token-{i}",
+        "source": {"type": "group", "groupId": GROUP_ID, "userId": user_id(i % users)},
+        "postback": {"data": f"vote_{POLL_ID}_{random.choice(['attend', 'absent'])}"},
+    }
+    body = json.dumps({"destination": "U" + "f" * 32, "events": [event]})
+    signature = base64.b64encode(hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def reset_poll(db):
+    db.db[db.polls_collection].delete_many({})
+    db.db[db.members_collection].delete_many({})
+    db.save_poll({"poll_id": POLL_ID, "title": "bench", "group_id": GROUP_ID, "created_at": datetime.now(),
+                  "status": "active", "version": 0, **poll_schema.new_poll_fields()})
+
+
+def server_command(mode, port, threads):
+    if mode == "sync":
+        return ["gunicorn", "-w", "1", "-k", "gthread", "--threads", str(threads),
+                "-b", f"127.0.0.1:{port}", "app:app"]
+    return ["uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+
+
+async def wait_ready(client, url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"伺服器未在 {timeout} 秒內啟動: {url}")
+
+
+async def drive(url, requests, concurrency):
+    latencies = []
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        await wait_ready(client, url)
+
+        async def send(body, signature):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, content=body, headers={"X-Line-Signature": signature,
+                                                                              "Content-Type": "application/json"})
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(body, signature) for body, signature in requests))
+        elapsed = time.perf_counter() - start
+    return elapsed, sorted(latencies), statuses
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+def run_mode(mode, args, db, stub_port, requests):
+    reset_poll(db)
+    line_calls.clear()
+    port = free_port()
+    env = dict(os.environ, LINE_API_ENDPOINT=f"http://127.0.0.1:{stub_port}", LINE_CHANNEL_SECRET=SECRET,
+               LINE_CHANNEL_ACCESS_TOKEN="benchmark", VOTE_DEBOUNCE_SECONDS="0", WEBHOOK_FAST_PATH="1",
+               LINE_HTTP_POOL_SIZE=str(args.threads))
+    env.pop("DEV_USER_ID", None)
+    process = subprocess.Popen(server_command(mode, port, args.threads), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        elapsed, latencies, statuses = asyncio.run(drive(f"http://127.0.0.1:{port}/callback", requests, args.concurrency))
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    counts = poll_schema.counts(db.get_poll(POLL_ID))
+    voters = min(args.users, len(requests))
+    ok = statuses.get(200, 0)
+    print(f"{mode:>5}: {ok / elapsed:7.0f} 請求/秒, p50 {percentile(latencies, 0.5):6.0f}ms, "
+          f"p95 {percentile(latencies, 0.95):6.0f}ms, p99 {percentile(latencies, 0.99):6.0f}ms, "
+          f"狀態 {dict(statuses)}, LINE呼叫 {sum(line_calls.values())}")
+    if ok == len(requests):
+        assert sum(counts.values()) == voters, (counts, voters)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8, help="同步模式的工作執行緒數")
+    parser.add_argument("--line-latency", type=float, default=80, help="模擬LINE API的延遲（毫秒）")
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"], choices=["sync", "async"])
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = start_stub(stub_port, args.line_latency / 1000)
+    random.seed(0)
+    requests = [make_request(i, args.users) for i in range(args.requests)]
+
+    db = Database()
+    try:
+        print(f"{args.requests} 個投票webhook，並行 {args.concurrency}，LINE延遲 {args.line_latency:.0f}ms，"
+              f"同步模式 {args.threads} 執行緒")
+        for mode in args.modes:
+            run_mode(mode, args, db, stub_port, requests)
+    finally:
+        stub.should_exit = True
+        db.client.drop_database('bench_server_modes')
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
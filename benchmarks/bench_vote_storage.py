@@ -0,0 +1,74 @@
+"""
+比較兩種投票儲存模式在同一投票上併發投票的吞吐量
+
+document:   每一票都更新同一份投票文件（MongoDB 在該文件上序列化寫入）
+collection: 每一票 upsert votes 集合中各自的文件
+
+使用 MONGODB_URI 上的暫存資料庫，以多個執行緒模擬投票開放時的大量點擊，
+每位投票者投 --votes 次（含改票），最後檢查兩種模式的結算結果一致。
+用法（在專案根目錄執行，需要可連線的MongoDB）:
+    python benchmarks/bench_vote_storage.py [--voters 200] [--threads 1 8 32] [--votes 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['MONGODB_DB'] = 'bench_vote_storage'
+os.environ.pop('MONGODB_SHARDS', None)
+
+from db import Database
+import poll_schema
+
+POLL_ID = "01JBENCHVOTESTORAGE0000000"
+
+
+def run(db, mode, voters, threads, votes_per_voter):
+    db.vote_storage = mode
+    for name in (db.polls_collection, db.votes_collection):
+        db.db[name].delete_many({})
+    poll = {"poll_id": POLL_ID, "title": "bench", "group_id": "C" + "0" * 32,
+            "created_at": datetime.now(), "status": "active", "version": 0, **poll_schema.new_poll_fields()}
+    db.save_poll(poll)
+
+    rng = random.Random(1)
+    taps = [(f"U{i:032x}", rng.choice(poll_schema.OPTIONS)) for i in range(voters) for _ in range(votes_per_voter)]
+    rng.shuffle(taps)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda tap: db.add_vote(POLL_ID, tap[0], tap[1], poll=poll), taps))
+    elapsed = time.perf_counter() - start
+
+    result = db.load_votes(db.get_poll(POLL_ID))
+    return len(taps) / elapsed, poll_schema.total_votes(result), poll_schema.counts(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voters", type=int, default=200)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--votes", type=int, default=3, help="每位投票者的點擊次數")
+    args = parser.parse_args()
+
+    db = Database()
+    try:
+        print(f"{'執行緒':>6} {'document 票/秒':>16} {'collection 票/秒':>18}")
+        for threads in args.threads:
+            doc_rate, doc_total, doc_counts = run(db, 'document', args.voters, threads, args.votes)
+            col_rate, col_total, col_counts = run(db, 'collection', args.voters, threads, args.votes)
+            assert doc_total == col_total == args.voters, (doc_total, col_total)
+            assert sum(doc_counts.values()) == sum(col_counts.values()) == args.voters
+            print(f"{threads:>6} {doc_rate:>16.0f} {col_rate:>18.0f}")
+    finally:
+        db.client.drop_database('bench_vote_storage')
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
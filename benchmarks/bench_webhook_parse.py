@@ -0,0 +1,87 @@
+"""
+比較 webhook 解析與分派的成本：line-bot-sdk 完整路徑 vs 投票快速路徑
+
+不連線資料庫也不呼叫 LINE API，分派函數只取出投票欄位。
+用法（在專案根目錄執行）:
+    python benchmarks/bench_webhook_parse.py [--events 1 5 20] [--rounds 2000]
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot import WebhookHandler
+from linebot.models import PostbackEvent
+from poll import parse_vote_data
+import webhook_fastpath
+
+SECRET = "benchmark-secret"
+
+
+def make_body(event_count):
+    events = []
+    for i in range(event_count):
+        events.append({
+            "type": "postback",
+            "mode": "active",
+            "timestamp": 1700000000000 + i,
+            "webhookEventId": f"01H0000000000000000000{i:04d}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"reply-token-{i}",
+            "source": {"type": "group", "groupId": "C" + "0" * 32, "userId": f"U{i:032x}"},
+            "postback": {"data": f"vote_01JABCDEFGHJKMNPQRSTVWXYZ_{'attend' if i % 2 else 'absent'}"}
+        })
+    body = json.dumps({"destination": "U" + "f" * 32, "events": events})
+    signature = base64.b64encode(hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def bench_sdk(body, signature, rounds):
+    handler = WebhookHandler(SECRET)
+    sink = []
+
+    @handler.add(PostbackEvent)
+    def on_postback(event):
+        sink.append((parse_vote_data(event.postback.data), event.source.user_id, event.reply_token))
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        handler.handle(body, signature)
+    return time.perf_counter() - start
+
+
+def bench_fast(body, signature, rounds):
+    sink = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if not webhook_fastpath.verify_signature(body, signature, SECRET):
+            raise RuntimeError("signature")
+        for vote_event in webhook_fastpath.parse_vote_events(body):
+            sink.append(vote_event)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'events':>6} {'sdk us/event':>14} {'fast us/event':>14} {'speedup':>8}")
+    for count in args.events:
+        body, signature = make_body(count)
+        sdk = bench_sdk(body, signature, args.rounds)
+        fast = bench_fast(body, signature, args.rounds)
+        per_sdk = sdk / (args.rounds * count) * 1e6
+        per_fast = fast / (args.rounds * count) * 1e6
+        print(f"{count:>6} {per_sdk:>14.1f} {per_fast:>14.1f} {per_sdk / per_fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+有名額投票的併發壓力測試
+
+使用 MONGODB_URI 上的暫存資料庫，以多個執行緒模擬投票開放瞬間的大量點擊：
+1. 搶位：所有用戶以 Barrier 同時點擊出席，檢查恰好 capacity 人出席、其餘依序候補且順位不重複
+2. 混戰：用戶隨機出席、請假、重複點擊，同時進行
+每一輪之後檢查投票文件的不變量：
+- 出席人數不超過名額；有人候補時名額必須是滿的
+- 票數與投票記錄一致；候補名單沒有重複，也不與投票記錄重疊
+- 遞補通知的人數等於因取消而遞補的次數
+用法（在專案根目錄執行，需要可連線的MongoDB）:
+    python benchmarks/stress_capacity.py [--capacity 12] [--users 60] [--threads 32] [--rounds 5] [--taps 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['MONGODB_DB'] = 'stress_capacity'
+os.environ.pop('MONGODB_SHARDS', None)
+
+from db import Database
+import poll_schema
+
+POLL_ID = "01JSTRESSCAPACITY000000000"
+
+
+def user_id(i):
+    return f"U{i:032x}"
+
+
+def reset_poll(db, capacity):
+    db.db[db.polls_collection].delete_many({})
+    db.save_poll({"poll_id": POLL_ID, "title": "stress", "group_id": "C" + "0" * 32, "created_at": datetime.now(),
+                  "status": "active", "version": 0, "capacity": capacity, "waitlist": [],
+                  **poll_schema.new_poll_fields()})
+
+
+def check_invariants(poll):
+    capacity = poll["capacity"]
+    voters = poll_schema.voters(poll)
+    counts = poll_schema.counts(poll)
+    queue = poll_schema.waitlist(poll)
+    expected = Counter(voters.values())
+    assert counts == {option: expected.get(option, 0) for option in poll_schema.OPTIONS}, (counts, expected)
+    assert counts["attend"] <= capacity, f"超額: {counts['attend']} > {capacity}"
+    assert len(set(queue)) == len(queue), "候補名單重複"
+    assert not set(queue) & set(voters), "候補者同時有投票記錄"
+    if queue:
+        assert counts["attend"] == capacity, "有人候補但名額未滿"
+    return counts, len(queue)
+
+
+def rush(db, capacity, users, threads):
+    """所有用戶同時點擊出席"""
+    reset_poll(db, capacity)
+    barrier = threading.Barrier(min(users, threads))
+
+    def tap(i):
+        try:
+            barrier.wait(timeout=5)
+        except threading.BrokenBarrierError:
+            pass
+        return db.add_capacity_vote(POLL_ID, user_id(i), 'attend')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(tap, range(users)))
+    elapsed = time.perf_counter() - start
+
+    assert all(success for success, _ in results)
+    statuses = Counter(result.status for _, result in results)
+    positions = sorted(result.position for _, result in results if result.status == 'waitlist')
+    assert statuses['attend'] == min(capacity, users), statuses
+    assert positions == list(range(1, users - statuses['attend'] + 1)), positions
+
+    counts, waiting = check_invariants(db.get_poll(POLL_ID))
+    print(f"搶位: {users} 人 / {threads} 執行緒, {elapsed * 1000:.0f}ms, 出席 {counts['attend']}, 候補 {waiting}")
+
+
+def melee(db, capacity, users, threads, taps, seed):
+    """隨機出席、請假和重複點擊"""
+    reset_poll(db, capacity)
+    rng = random.Random(seed)
+    plan = [(user_id(rng.randrange(users)), rng.choice(['attend', 'attend', 'absent'])) for _ in range(taps)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda tap: db.add_capacity_vote(POLL_ID, *tap), plan))
+    elapsed = time.perf_counter() - start
+
+    assert all(success for success, _ in results)
+    promoted = sum(1 for _, result in results if result.promoted)
+    poll = db.get_poll(POLL_ID)
+    counts, waiting = check_invariants(poll)
+    # 每一票都使版本號遞增一次，沒有遺失的更新
+    assert poll["version"] == taps, (poll["version"], taps)
+    print(f"混戰: {taps} 次點擊 / {threads} 執行緒, {taps / elapsed:.0f} 票/秒, "
+          f"出席 {counts['attend']}, 請假 {counts['absent']}, 候補 {waiting}, 遞補 {promoted} 次")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--capacity", type=int, default=12)
+    parser.add_argument("--users", type=int, default=60)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--taps", type=int, default=2000)
+    args = parser.parse_args()
+
+    db = Database()
+    try:
+        for round_no in range(args.rounds):
+            rush(db, args.capacity, args.users, args.threads)
+            melee(db, args.capacity, args.users, args.threads, args.taps, seed=round_no)
+        print("所有不變量皆成立")
+    finally:
+        db.client.drop_database('stress_capacity')
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+跨副本的快取失效
+
+以 MongoDB change stream 監聽 polls、members 和 shard_routes 的變更，並通知本行程內的快取：
+- 快取以 subscribe(集合, on_change, on_reset) 註冊；on_change 收到精簡後的變更事件，
+  on_reset 在無法確定錯過了哪些事件時清空整個快取
+- 每個資料庫（分片和主資料庫）一個監聽執行緒，斷線後以最後的 resume token 繼續，
+  重連前先清空快取，因此斷線期間的讀取最多過期到重連完成為止
+- 無法繼續（oplog 已覆蓋 token）時清空快取並從目前位置重新開始
+- 單機伺服器不支援 change stream，此時不啟動，快取只依賴各自的版本號和過期時間
+"""
+import os
+import threading
+import time
+import logging
+from collections import defaultdict
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_SECONDS = float(os.environ.get('CHANGE_STREAM_RECONNECT_SECONDS', '2'))
+# 沒有變更時 getMore 最長等待時間，同時也是停止監聽的反應時間
+MAX_AWAIT_MS = 1000
+
+_subscribers = defaultdict(list)
+_subscribers_lock = threading.Lock()
+_listeners = []
+
+
+def subscribe(collection, on_change, on_reset=None):
+    """註冊快取的失效回呼
+    參數:
+        collection: 集合名稱
+        on_change: on_change(event)，event 含 operation、_id 及文件的 poll_id、group_id、user_id（如有），
+                   更新事件另有 fields（變動的頂層欄位名稱，其他事件為 None）
+        on_reset: 可選，清空整個快取
+    """
+    with _subscribers_lock:
+        _subscribers[collection].append((on_change, on_reset))
+
+
+def _callbacks(collection):
+    with _subscribers_lock:
+        return list(_subscribers.get(collection, []))
+
+
+def _reset(collections):
+    for collection in collections:
+        for _, on_reset in _callbacks(collection):
+            if on_reset:
+                try:
+                    on_reset()
+                except Exception as e:
+                    logger.error(f"清空快取時發生錯誤: {collection}, {e}")
+    metrics.incr("change_stream.resets")
+
+
+def _dispatch(change):
+    collection = change["ns"]["coll"]
+    document = change.get("fullDocument") or {}
+    fields = None
+    description = change.get("updateDescription")
+    if description is not None:
+        changed = list(description.get("updatedFields", {})) + list(description.get("removedFields", []))
+        fields = sorted({name.split(".", 1)[0] for name in changed})
+    event = {
+        "operation": change["operationType"],
+        "_id": change.get("documentKey", {}).get("_id"),
+        "poll_id": document.get("poll_id"),
+        "group_id": document.get("group_id"),
+        "user_id": document.get("user_id"),
+        "fields": fields,
+    }
+    for on_change, on_reset in _callbacks(collection):
+        try:
+            # 刪除事件沒有文件內容，無法判斷影響哪些項目
+            if event["operation"] == "delete" and on_reset:
+                on_reset()
+            else:
+                on_change(event)
+        except Exception as e:
+            logger.error(f"處理變更事件時發生錯誤: {collection}, {e}")
+
+    metrics.incr("change_stream.events")
+    cluster_time = change.get("clusterTime")
+    if cluster_time is not None:
+        metrics.observe("change_stream.lag", max(0.0, time.time() - cluster_time.time))
+
+
+class ChangeListener(threading.Thread):
+    """監聽一個資料庫中指定集合的變更"""
+
+    def __init__(self, database, collections):
+        super().__init__(name=f"change-listener-{database.name}", daemon=True)
+        self.database = database
+        self.collections = list(collections)
+        self.resume_token = None
+        self._stopping = threading.Event()
+
+    def _pipeline(self):
+        return [
+            {"$match": {
+                "ns.coll": {"$in": self.collections},
+                "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+            }},
+            # 只取回失效判斷需要的欄位
+            {"$project": {
+                "ns": 1, "operationType": 1, "documentKey": 1, "clusterTime": 1,
+                "fullDocument.poll_id": 1, "fullDocument.group_id": 1, "fullDocument.user_id": 1,
+                "updateDescription.updatedFields": 1, "updateDescription.removedFields": 1,
+            }},
+        ]
+
+    def _watch(self):
+        from pymongo.errors import OperationFailure
+
+        try:
+            return self.database.watch(self._pipeline(), full_document="updateLookup",
+                                       resume_after=self.resume_token, max_await_time_ms=MAX_AWAIT_MS)
+        except OperationFailure as e:
+            if self.resume_token is None:
+                raise
+            # resume token 已不在 oplog 中，錯過的事件無法取回
+            logger.warning(f"無法從 resume token 繼續監聽 {self.database.name}: {e}")
+            self.resume_token = None
+            _reset(self.collections)
+            return self.database.watch(self._pipeline(), full_document="updateLookup", max_await_time_ms=MAX_AWAIT_MS)
+
+    def run(self):
+        logger.info(f"開始監聽變更: {self.database.name} {self.collections}")
+        while not self._stopping.is_set():
+            try:
+                with self._watch() as stream:
+                    while not self._stopping.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            _dispatch(change)
+                        self.resume_token = stream.resume_token
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                logger.error(f"監聽變更時發生錯誤: {self.database.name}, {e}")
+                metrics.incr("change_stream.reconnects")
+                # 斷線期間的變更在重連後會補收，但在此之前讀到的快取可能已過期
+                _reset(self.collections)
+                self._stopping.wait(RECONNECT_SECONDS)
+
+    def stop(self):
+        self._stopping.set()
+
+
+def start(db):
+    """為每個分片和主資料庫啟動監聽執行緒
+    參數:
+        db: Database對象
+    返回:
+        已啟動的監聽執行緒列表；單機伺服器返回空列表
+    """
+    if _listeners:
+        return _listeners
+    if not db.supports_transactions():
+        logger.info("伺服器不支援 change stream（非副本集），不啟動跨副本快取失效")
+        return []
+
+    collections_by_db = defaultdict(set)
+    for shard_db in db.router.all_shards():
+        collections_by_db[shard_db.name].update([db.polls_collection, db.members_collection])
+    collections_by_db[db.db.name].add(db.router.routes.name)
+
+    for name, collections in collections_by_db.items():
+        listener = ChangeListener(db.client[name], sorted(collections))
+        listener.start()
+        _listeners.append(listener)
+    return _listeners
+
+
+def stop():
+    for listener in _listeners:
+        listener.stop()
+    _listeners.clear()
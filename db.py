@@ -1,7 +1,17 @@
-import pymongo
 import os
+import heapq
 from datetime import datetime
 import logging
+import startup
+from sharding import ShardRouter
+import poll_schema
+import db_policy
+from db_policy import route
+import poll_cache
+from idgen import id_timestamp
+
+# 延遲載入模式下第一次連接時才匯入pymongo
+pymongo = startup.lazy_module('pymongo')
 
 # 設定日誌
 logging.basicConfig(
@@ -14,18 +24,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 查詢API的覆蓋索引：驗證快取時只讀取索引中的 (鍵, updated_at)，不讀取文件
+# 投票列表依 (created_at, poll_id) 排序：舊式的數字ID和 ULID 混合時 poll_id 的字串順序不是時間順序
+POLL_LIST_INDEX = [("group_id", 1), ("created_at", 1), ("poll_id", 1), ("status", 1), ("updated_at", 1)]
+POLL_VERSION_INDEX = [("poll_id", 1), ("updated_at", 1)]
+MEMBER_LIST_INDEX = [("group_id", 1), ("user_id", 1), ("updated_at", 1)]
+VOTE_VERSION_INDEX = [("poll_id", 1), ("updated_at", 1)]
+
+# 投票寫入只匹配進行中的投票，投票不存在或已結束時 add_vote、add_capacity_vote 返回 (False, VOTE_CLOSED)
+VOTE_CLOSED = 'closed'
+
 # MongoDB連接設定
 class Database:
     def __init__(self):
         # 從環境變量獲取MongoDB連接字串，或使用默認值
         self.mongo_uri = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
         self.db_name = os.environ.get('MONGODB_DB', 'line_poll_db')
+        # 分片資料庫（以逗號分隔），預設只有主資料庫；路由表建立後以路由表為準
+        self.shard_names = [name.strip() for name in os.environ.get('MONGODB_SHARDS', self.db_name).split(',') if name.strip()]
         self.client = None
         self.db = None
+        self.router = None
         
         # 集合名稱
         self.polls_collection = 'polls'
         self.members_collection = 'members'
+        self.member_stats_collection = 'member_stats'
+        self.group_stats_collection = 'group_stats'
+        self.outbox_collection = 'outbox'
+        self.votes_collection = 'votes'
+        # 投票儲存模式：'document' 記錄在投票文件中；'collection' 每一票是 votes 集合中的一份文件
+        self.vote_storage = os.environ.get('VOTE_STORAGE', 'document')
+        self._supports_transactions = None
+        # (分片, 路由) -> 套用路由設定的資料庫對象
+        self._route_dbs = {}
         
         # 連接數據庫
         self.connect()
@@ -33,30 +65,138 @@ class Database:
     def connect(self):
         """連接到MongoDB數據庫"""
         try:
-            self.client = pymongo.MongoClient(self.mongo_uri)
+            self.client = self.create_client()
             self.db = self.client[self.db_name]
             logger.info(f"成功連接到MongoDB: {self.db_name}")
             
+            # 群組到分片的路由
+            self.router = ShardRouter(self.client, self.db, self.shard_names)
+
             # 創建索引（如果尚未存在）
-            self.db[self.polls_collection].create_index("poll_id", unique=True)
-            self.db[self.members_collection].create_index([("group_id", 1), ("user_id", 1),("user_name",1)], unique=True)
+            for shard in self.router.shard_names():
+                self.ensure_shard_indexes(shard)
+            # 發件匣和投票目錄只在主資料庫
+            self.db[self.outbox_collection].create_index("key", unique=True)
+            self.db[self.outbox_collection].create_index([("status", 1), ("next_attempt_at", 1)])
+            self.router.directory.create_index("poll_id", unique=True)
             
         except Exception as e:
             logger.error(f"連接MongoDB時發生錯誤: {e}")
             raise
     
+    def create_client(self):
+        """建立MongoDB客戶端（非同步模式的 AsyncDatabase 改以motor建立）"""
+        return pymongo.MongoClient(self.mongo_uri)
+
+    def ensure_shard_indexes(self, shard):
+        """在分片資料庫上建立群組資料的索引"""
+        shard_db = self.client[shard]
+        shard_db[self.polls_collection].create_index("poll_id", unique=True)
+        shard_db[self.members_collection].create_index([("group_id", 1), ("user_id", 1),("user_name",1)], unique=True)
+        # 匯出歷史記錄時依 (狀態, 群組, 投票ID) 順序掃描
+        shard_db[self.polls_collection].create_index([("status", 1), ("group_id", 1), ("poll_id", 1)])
+        # 出席統計彙總
+        shard_db[self.member_stats_collection].create_index([("group_id", 1), ("user_id", 1)], unique=True)
+        shard_db[self.group_stats_collection].create_index("group_id", unique=True)
+        # votes 集合模式：每位用戶在每個投票中一份文件
+        shard_db[self.votes_collection].create_index([("poll_id", 1), ("user_id", 1)], unique=True)
+        # 查詢API的分頁和 ETag 驗證
+        shard_db[self.polls_collection].create_index(POLL_LIST_INDEX)
+        shard_db[self.polls_collection].create_index(POLL_VERSION_INDEX)
+        # 結果尚未寫入發件匣的投票（只有少數文件有此欄位）
+        shard_db[self.polls_collection].create_index("results_pending", sparse=True)
+        shard_db[self.members_collection].create_index(MEMBER_LIST_INDEX)
+        shard_db[self.votes_collection].create_index(VOTE_VERSION_INDEX)
+
+    def _with_route(self, shard_db):
+        """套用目前路由的讀寫設定（單機伺服器不套用）"""
+        route_name = db_policy.current_route()
+        if route_name == db_policy.DEFAULT or not self.supports_transactions():
+            return shard_db
+        key = (shard_db.name, route_name)
+        routed = self._route_dbs.get(key)
+        if routed is None:
+            routed = self._route_dbs[key] = shard_db.with_options(**db_policy.options(route_name))
+        return routed
+
+    def group_db(self, group_id):
+        """群組所在的分片資料庫"""
+        return self._with_route(self.router.shard_db(group_id))
+
+    def shards(self):
+        """所有分片資料庫"""
+        return [self._with_route(shard_db) for shard_db in self.router.all_shards()]
+
+    def poll_db(self, poll_id):
+        """投票所在的分片資料庫
+        只有一個分片時直接返回；否則查詢投票目錄，目錄中沒有的舊投票逐一查詢各分片
+        返回:
+            分片資料庫，找不到投票則返回None
+        """
+        if not self.router.sharded:
+            return self.group_db(None)
+        found, group_id = self.router.group_for_poll(poll_id)
+        if found:
+            return self.group_db(group_id)
+        for shard_db in self.shards():
+            poll = shard_db[self.polls_collection].find_one({"poll_id": poll_id}, {"_id": 0, "group_id": 1})
+            if poll:
+                self.router.remember_poll(poll_id, poll.get('group_id'))
+                return self.group_db(poll.get('group_id'))
+        return None
+
+    def _polls_by_shard(self, poll_ids):
+        """將投票ID按所在分片分組
+        返回:
+            [(分片資料庫, [poll_id])]
+        """
+        shards = {}
+        for poll_id in poll_ids:
+            shard_db = self.poll_db(poll_id)
+            if shard_db is not None:
+                shards.setdefault(shard_db.name, (shard_db, []))[1].append(poll_id)
+        return list(shards.values())
+
     def close(self):
         """關閉數據庫連接"""
         if self.client:
             self.client.close()
             logger.info("已關閉MongoDB連接")
     
+    def supports_transactions(self):
+        """伺服器是否支援多文件交易（副本集或分片叢集）"""
+        if self._supports_transactions is None:
+            try:
+                hello = self.client.admin.command('hello')
+                self._supports_transactions = bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+            except Exception as e:
+                logger.error(f"檢查交易支援時發生錯誤: {e}")
+                self._supports_transactions = False
+        return self._supports_transactions
+
+    def run_transaction(self, callback, route_name='lifecycle'):
+        """在交易中執行 callback(session)
+        單機伺服器不支援交易，此時以 session=None 依序執行，
+        呼叫方需安排寫入順序使中途失敗可以補救（例如先保存投票再寫入發件匣，或標記待補發的狀態）
+        參數:
+            callback: 接受session參數的函數，失敗時應拋出例外
+            route_name: 交易提交時使用的路由設定，預設為多數確認
+        返回:
+            callback的返回值
+        """
+        if not self.supports_transactions():
+            return callback(None)
+        with self.client.start_session() as session:
+            return session.with_transaction(callback, **db_policy.transaction_options(route_name))
+
     # ===== 投票相關操作 =====
     
-    def save_poll(self, poll_data):
+    @route('lifecycle')
+    def save_poll(self, poll_data, session=None):
         """保存或更新投票數據
         參數:
             poll_data: 包含投票數據的字典，必須包含'poll_id'字段
+            session: 可選，交易的session
         返回:
             操作結果
         """
@@ -69,11 +209,16 @@ class Database:
             # 添加時間戳
             poll_data['updated_at'] = datetime.now()
             
+            # 記錄投票所屬的群組，投票操作只帶poll_id時據此找到分片
+            group_id = poll_data.get('group_id')
+            self.router.record_poll(poll_id, group_id, session=session)
+
             # 使用upsert模式，如果不存在則插入，存在則更新
-            result = self.db[self.polls_collection].update_one(
+            result = self.group_db(group_id)[self.polls_collection].update_one(
                 {"poll_id": poll_id},
                 {"$set": poll_data},
-                upsert=True
+                upsert=True,
+                session=session
             )
             
             logger.info(f"保存投票成功: {poll_id}")
@@ -82,38 +227,114 @@ class Database:
             logger.error(f"保存投票時發生錯誤: {e}")
             return False
     
-    def get_poll(self, poll_id):
+    @route('default')
+    def get_poll(self, poll_id, session=None):
         """獲取指定ID的投票數據
         參數:
             poll_id: 投票ID
+            session: 可選，交易的session
         返回:
             投票數據字典，不存在則返回None
         """
         try:
-            poll = self.db[self.polls_collection].find_one({"poll_id": poll_id})
+            shard_db = self.poll_db(poll_id)
+            if shard_db is None:
+                return None
+            poll = shard_db[self.polls_collection].find_one({"poll_id": poll_id}, session=session)
             return poll
         except Exception as e:
             logger.error(f"獲取投票時發生錯誤: {e}")
             return None
     
+    @route('default')
+    def get_poll_meta(self, poll_id):
+        """只讀取投票的基本欄位（poll_cache.META_FIELDS），不含投票記錄
+        返回:
+            (查詢是否成功, 基本資料或None)
+        """
+        try:
+            shard_db = self.poll_db(poll_id)
+            if shard_db is None:
+                return True, None
+            projection = {"_id": 0, **{field: 1 for field in poll_cache.META_FIELDS}}
+            return True, shard_db[self.polls_collection].find_one({"poll_id": poll_id}, projection)
+        except Exception as e:
+            logger.error(f"獲取投票基本資料時發生錯誤: {e}")
+            return False, None
+
+    @route('default')
+    def load_votes(self, poll, session=None):
+        """取得包含所有投票記錄的投票數據
+        votes 集合模式下以 (poll_id, user_id) 索引讀取該投票的所有票並合併；文件模式直接返回
+        參數:
+            poll: get_poll 取得的投票數據
+            session: 可選，交易的session
+        返回:
+            投票數據
+        """
+        if poll is None or self.vote_storage != 'collection':
+            return poll
+        votes = self.group_db(poll.get('group_id'))[self.votes_collection].find(
+            {"poll_id": poll['poll_id']}, {"_id": 0, "user_id": 1, "code": 1, "updated_at": 1}, session=session
+        )
+        return poll_schema.with_votes(poll, votes)
+
+    @route('default')
+    def get_previous_votes(self, polls, keys):
+        """查詢用戶在投票中目前的選擇
+        參數:
+            polls: {poll_id: 投票數據}
+            keys: (poll_id, user_id) 列表
+        返回:
+            {(poll_id, user_id): option}
+        """
+        if self.vote_storage != 'collection':
+            return {
+                (poll_id, user_id): poll_schema.voters(polls[poll_id]).get(user_id)
+                for poll_id, user_id in keys if poll_id in polls
+            }
+        previous = {}
+        by_poll = {}
+        for poll_id, user_id in keys:
+            by_poll.setdefault(poll_id, []).append(user_id)
+        for poll_id, user_ids in by_poll.items():
+            poll = polls.get(poll_id)
+            if not poll:
+                continue
+            # 切換模式前記錄在投票文件中的票
+            for user_id in user_ids:
+                previous[(poll_id, user_id)] = poll_schema.voters(poll).get(user_id)
+            cursor = self.group_db(poll.get('group_id'))[self.votes_collection].find(
+                {"poll_id": poll_id, "user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "code": 1}
+            )
+            for vote in cursor:
+                previous[(poll_id, vote['user_id'])] = poll_schema.OPTIONS[vote['code']]
+        return previous
+
+    @route('default')
     def get_active_polls(self, group_id=None):
         """獲取所有活動中的投票
         參數:
             group_id: 可選，群組ID
         返回:
-            活動投票列表
+            活動投票列表，最新的投票在前
         """
         try:
             query = {"status": "active"}
             if group_id:
                 query["group_id"] = group_id
                 
-            polls = list(self.db[self.polls_collection].find(query))
+            # 依ID中的建立時間倒序（最新的在前）。舊式的秒級時間戳ID（"17…"）按字串排序會排在
+            # ULID（"01J…"）之前，因此不能依 poll_id 排序；活動中的投票不多，在記憶體中排序
+            shards = [self.group_db(group_id)] if group_id else self.shards()
+            polls = [poll for shard_db in shards for poll in shard_db[self.polls_collection].find(query)]
+            polls.sort(key=lambda poll: (id_timestamp(poll['poll_id']) or 0, poll['poll_id']), reverse=True)
             return polls
         except Exception as e:
             logger.error(f"獲取活動投票時發生錯誤: {e}")
             return []
     
+    @route('history')
     def get_closed_polls(self, group_id=None):
         """獲取所有已結束的投票
         參數:
@@ -126,12 +347,75 @@ class Database:
             if group_id:
                 query["group_id"] = group_id
                 
-            polls = list(self.db[self.polls_collection].find(query))
+            shards = [self.group_db(group_id)] if group_id else self.shards()
+            polls = [poll for shard_db in shards for poll in shard_db[self.polls_collection].find(query)]
             return polls
         except Exception as e:
             logger.error(f"獲取已結束投票時發生錯誤: {e}")
             return []
 
+    @route('default')
+    def get_polls(self, poll_ids):
+        """一次查詢多個投票
+        參數:
+            poll_ids: 投票ID列表
+        返回:
+            {poll_id: 投票數據} 字典
+        """
+        try:
+            polls = {}
+            for shard_db, shard_poll_ids in self._polls_by_shard(poll_ids):
+                for poll in shard_db[self.polls_collection].find({"poll_id": {"$in": shard_poll_ids}}):
+                    polls[poll["poll_id"]] = poll
+            return polls
+        except Exception as e:
+            logger.error(f"批次獲取投票時發生錯誤: {e}")
+            return {}
+
+    @route('history')
+    def iter_closed_polls(self, group_id=None, since=None, until=None, after=None, batch_size=200):
+        """以伺服器端游標逐筆讀取已結束的投票（不會一次載入全部）
+        依 (group_id, poll_id) 排序，可從上次中斷的位置繼續
+        參數:
+            group_id: 可選，群組ID
+            since: 可選，創建時間下限（datetime，含）
+            until: 可選，創建時間上限（datetime，不含）
+            after: 可選，(group_id, poll_id) 元組，只返回排在其後的投票
+            batch_size: 每批從伺服器取回的文件數
+        返回:
+            投票數據的產生器
+        """
+        query = {"status": "closed"}
+        if group_id:
+            query["group_id"] = group_id
+        if since or until:
+            query["created_at"] = {}
+            if since:
+                query["created_at"]["$gte"] = since
+            if until:
+                query["created_at"]["$lt"] = until
+        if after:
+            last_group_id, last_poll_id = after
+            query["$or"] = [
+                {"group_id": {"$gt": last_group_id}},
+                {"group_id": last_group_id, "poll_id": {"$gt": last_poll_id}}
+            ]
+
+        projection = {"_id": 0, "poll_id": 1, "title": 1, "group_id": 1,
+                      "created_at": 1, "updated_at": 1, "voters": 1, "schema": 1, "v": 1}
+        sort = [("group_id", pymongo.ASCENDING), ("poll_id", pymongo.ASCENDING)]
+        shards = [self.group_db(group_id)] if group_id else self.shards()
+        cursors = [shard_db[self.polls_collection].find(query, projection, batch_size=batch_size).sort(sort)
+                   for shard_db in shards]
+        try:
+            # 每個分片的游標已排序，合併後維持整體順序
+            for poll in heapq.merge(*cursors, key=lambda poll: (poll.get('group_id') or '', poll['poll_id'])):
+                yield poll
+        finally:
+            for cursor in cursors:
+                cursor.close()
+
+    @route('lifecycle')
     def delete_poll(self, poll_id):
         """刪除指定ID的投票
         參數:
@@ -140,80 +424,288 @@ class Database:
             操作結果
         """
         try:
-            result = self.db[self.polls_collection].delete_one({"poll_id": poll_id})
+            shard_db = self.poll_db(poll_id)
+            if shard_db is None:
+                return False
+            result = shard_db[self.polls_collection].delete_one({"poll_id": poll_id})
+            shard_db[self.votes_collection].delete_many({"poll_id": poll_id})
+            poll_cache.invalidate(poll_id)
             logger.info(f"刪除投票: {poll_id}, 刪除數量: {result.deleted_count}")
             return result.deleted_count > 0
         except Exception as e:
             logger.error(f"刪除投票時發生錯誤: {e}")
             return False
     
-    def update_poll_status(self, poll_id, status):
+    @route('lifecycle')
+    def update_poll_status(self, poll_id, status, session=None):
         """更新投票狀態
+        改為 'closed' 時同時標記 results_pending，結果寫入發件匣後由 mark_results_published 清除
         參數:
             poll_id: 投票ID
             status: 新狀態，如'active'、'closed'
+            session: 可選，交易的session；交易中不移除 poll_cache，由呼叫者在提交後移除
+                     （提交前移除時，同時未命中的讀取會把舊狀態重新放回快取）
         返回:
-            操作結果
+            操作結果；交易中發生錯誤時拋出例外
         """
         try:
-            result = self.db[self.polls_collection].update_one(
+            shard_db = self.poll_db(poll_id)
+            if shard_db is None:
+                return False
+            fields = {"status": status, "updated_at": datetime.now()}
+            if status == 'closed':
+                fields["results_pending"] = True
+            result = shard_db[self.polls_collection].update_one(
                 {"poll_id": poll_id},
-                {"$set": {"status": status, "updated_at": datetime.now()}}
+                {"$set": fields},
+                session=session
             )
+            if session is None:
+                poll_cache.invalidate(poll_id)
             logger.info(f"更新投票狀態: {poll_id} -> {status}")
             return result.modified_count > 0
         except Exception as e:
+            if session is not None:
+                # 交易中需拋出，交易才會中止（暫時性錯誤由 with_transaction 重試），不會只提交發件匣的訊息
+                raise
             logger.error(f"更新投票狀態時發生錯誤: {e}")
             return False
+
+    @route('lifecycle')
+    def mark_results_published(self, poll_id, session=None):
+        """結果已寫入發件匣，清除 results_pending（不改變 updated_at，結果的冪等鍵不變）"""
+        shard_db = self.poll_db(poll_id)
+        if shard_db is None:
+            return False
+        result = shard_db[self.polls_collection].update_one(
+            {"poll_id": poll_id}, {"$unset": {"results_pending": ""}}, session=session
+        )
+        return result.modified_count > 0
+
+    @route('default')
+    def get_unpublished_polls(self, before):
+        """已結束但結果尚未寫入發件匣的投票（結束投票中途失敗，單機伺服器上沒有交易）
+        參數:
+            before: 只返回在此時間之前結束的投票，不與進行中的結束投票重疊
+        返回:
+            投票ID列表
+        """
+        try:
+            return [poll['poll_id'] for shard_db in self.shards()
+                    for poll in shard_db[self.polls_collection].find(
+                        {"results_pending": True, "updated_at": {"$lt": before}}, {"_id": 0, "poll_id": 1})]
+        except Exception as e:
+            logger.error(f"查詢未發送結果的投票時發生錯誤: {e}")
+            return []
     
-    def add_vote(self, poll_id, user_id, option):
+    @route('vote')
+    def add_vote(self, poll_id, user_id, option, poll=None):
         """添加投票選擇
+        以一次管線更新記錄選擇並調整票數（舊結構的文件同時轉換為 v2），
+        並從更新前的文件讀回用戶先前的選擇
         參數:
             poll_id: 投票ID
             user_id: 用戶ID
             option: 選擇的選項
+            poll: 可選，已讀取的投票數據或 poll_cache 的基本資料（votes 集合模式下用於取得群組）
         返回:
-            操作結果和先前的選擇（如果有）
+            操作結果和先前的選擇（如果有）；投票不存在或已結束時為 (False, VOTE_CLOSED)
         """
+        if self.vote_storage == 'collection':
+            return self._upsert_vote(poll or self.get_poll(poll_id), user_id, option)
         try:
-            # 獲取投票數據
-            poll = self.get_poll(poll_id)
-            if not poll:
-                logger.error(f"添加投票選擇時找不到投票: {poll_id}")
-                return False, None
-            
-            # 獲取用戶先前的選擇（如果有）
-            voters = poll.get('voters', {})
-            prev_option = voters.get(user_id)
-            
-            # 如果用戶之前有選擇，從該選項的列表中移除用戶
-            if prev_option:
-                # 從先前選項中移除用戶
-                self.db[self.polls_collection].update_one(
-                    {"poll_id": poll_id}, 
-                    {"$pull": {f"options.{prev_option}": user_id}}
+            shard_db = self.poll_db(poll_id)
+            before = None
+            if shard_db is not None:
+                # 只匹配進行中的投票：快取中的狀態可能已過期，結束投票後不會再寫入
+                before = shard_db[self.polls_collection].find_one_and_update(
+                    {"poll_id": poll_id, "status": "active"},
+                    poll_schema.vote_pipeline(user_id, option, datetime.now()),
+                    projection=poll_schema.previous_option_projection(user_id),
+                    return_document=pymongo.ReturnDocument.BEFORE
                 )
-                        
-            # 添加用戶到新選項
-            self.db[self.polls_collection].update_one(
-                {"poll_id": poll_id}, 
-                {"$addToSet": {f"options.{option}": user_id}}
-            )
+            if before is None:
+                logger.warning(f"添加投票選擇時投票不存在或已結束: {poll_id}")
+                return False, VOTE_CLOSED
 
-            # 更新用戶的選擇記錄
-            self.db[self.polls_collection].update_one(
-                {"poll_id": poll_id}, 
-                {"$set": {f"voters.{user_id}": option, "updated_at": datetime.now()}}
-            )
-                  
+            prev_option = poll_schema.previous_option(before, user_id)
             logger.info(f"添加投票選擇: {poll_id}, 用戶: {user_id}, 選項: {option}, 之前選項: {prev_option}")
             return True, prev_option
         except Exception as e:
             logger.error(f"添加投票選擇時發生錯誤: {e}")
             return False, None
     
+    @route('vote')
+    def add_capacity_vote(self, poll_id, user_id, option):
+        """有名額的投票添加投票選擇
+        名額判斷、候補和遞補在投票文件的一次管線更新中完成，同時大量點擊也不會超額；
+        名額投票的票一律記錄在投票文件中（不使用 votes 集合），才能與名額一起原子地判斷
+        參數:
+            poll_id: 投票ID
+            user_id: 用戶ID
+            option: 選擇的選項
+        返回:
+            (操作結果, poll_schema.CapacityVote)，失敗時為 (False, None)，投票不存在或已結束時為 (False, VOTE_CLOSED)
+        """
+        try:
+            shard_db = self.poll_db(poll_id)
+            before = None
+            if shard_db is not None:
+                before = shard_db[self.polls_collection].find_one_and_update(
+                    {"poll_id": poll_id, "status": "active"},
+                    poll_schema.capacity_vote_pipeline(user_id, option, datetime.now()),
+                    projection=poll_schema.capacity_projection(user_id),
+                    return_document=pymongo.ReturnDocument.BEFORE
+                )
+            if before is None:
+                logger.warning(f"添加投票選擇時投票不存在或已結束: {poll_id}")
+                return False, VOTE_CLOSED
+
+            action, result = poll_schema.capacity_outcome(before, user_id, option)
+            logger.info(f"添加名額投票選擇: {poll_id}, 用戶: {user_id}, 選項: {option}, 處理: {action}, "
+                        f"之前: {result.previous}, 遞補: {result.promoted}")
+            return True, result
+        except Exception as e:
+            logger.error(f"添加投票選擇時發生錯誤: {e}")
+            return False, None
+
+    def _active_poll_ids(self, shard_db, poll_ids):
+        """在主節點確認投票是否仍在進行中
+        返回:
+            進行中的投票ID集合
+        """
+        cursor = shard_db[self.polls_collection].find(
+            {"poll_id": {"$in": list(poll_ids)}, "status": "active"}, {"_id": 0, "poll_id": 1}
+        )
+        return {poll["poll_id"] for poll in cursor}
+
+    def _restore_votes(self, shard_db, befores):
+        """撤回寫入已結束投票的票，回復為寫入前的記錄
+        參數:
+            befores: {(poll_id, user_id): 寫入前的 votes 文件或None}
+        """
+        requests = []
+        for (poll_id, user_id), before in befores.items():
+            key = {"poll_id": poll_id, "user_id": user_id}
+            if before is None:
+                requests.append(pymongo.DeleteOne(key))
+            else:
+                requests.append(pymongo.UpdateOne(key, {"$set": {"code": before['code'], "updated_at": before.get('updated_at')}}))
+        if requests:
+            shard_db[self.votes_collection].bulk_write(requests, ordered=False)
+
+    def _upsert_vote(self, poll, user_id, option):
+        """votes 集合模式：以 (poll_id, user_id) upsert 一份投票文件，不寫入投票文件
+        votes 文件無法與投票狀態一起原子地判斷，寫入後在主節點確認投票仍在進行中；
+        已結束時撤回這一票並返回 (False, VOTE_CLOSED)。
+        確認時仍在進行中的票會被計入：結束投票在改變狀態之後才讀取票。
+        寫入在狀態改變之前、確認在之後的票會被撤回，但結束投票可能在撤回之前已讀到它，
+        此時結果中有這一票而用戶收到「投票已關閉」（文件模式沒有這個情況）
+        """
+        if not poll:
+            logger.warning("添加投票選擇時找不到投票")
+            return False, VOTE_CLOSED
+        poll_id = poll['poll_id']
+        try:
+            shard_db = self.group_db(poll.get('group_id'))
+            before = shard_db[self.votes_collection].find_one_and_update(
+                {"poll_id": poll_id, "user_id": user_id},
+                {"$set": {"code": poll_schema.OPTIONS.index(option), "group_id": poll.get('group_id'), "updated_at": datetime.now()}},
+                projection={"_id": 0, "code": 1, "updated_at": 1},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.BEFORE
+            )
+            if not self._active_poll_ids(shard_db, [poll_id]):
+                self._restore_votes(shard_db, {(poll_id, user_id): before})
+                logger.warning(f"添加投票選擇時投票已結束，已撤回: {poll_id}, 用戶: {user_id}")
+                return False, VOTE_CLOSED
+            if before is not None:
+                prev_option = poll_schema.OPTIONS[before['code']]
+            elif 'schema' in poll or 'voters' in poll:
+                # 切換模式前記錄在投票文件中的票
+                prev_option = poll_schema.voters(poll).get(user_id)
+            else:
+                # 只有基本資料（poll_cache）時只讀取該用戶在投票文件中的記錄
+                document = self.group_db(poll.get('group_id'))[self.polls_collection].find_one(
+                    {"poll_id": poll_id}, poll_schema.previous_option_projection(user_id))
+                prev_option = poll_schema.previous_option(document, user_id)
+            logger.info(f"添加投票選擇: {poll_id}, 用戶: {user_id}, 選項: {option}, 之前選項: {prev_option}")
+            return True, prev_option
+        except Exception as e:
+            logger.error(f"添加投票選擇時發生錯誤: {e}")
+            return False, None
+
+    @route('vote')
+    def apply_votes(self, votes, polls=None):
+        """以一次 bulk_write 套用多筆投票
+        每筆投票是一個獨立的管線更新，依文件中用戶先前的選擇調整票數，
+        因此不需要先讀取用戶先前的選擇；votes 集合模式下為 (poll_id, user_id) 的 upsert
+        參數:
+            votes: (poll_id, user_id, option) 列表，同一用戶在同一投票中只應出現一次
+            polls: 可選，{poll_id: 投票數據}（votes 集合模式下用於取得群組）
+        返回:
+            (操作結果, 不存在或已結束的投票ID集合)；這些投票的票不會被寫入（votes 集合模式下寫入後撤回）
+        """
+        if not votes:
+            return True, set()
+        try:
+            now = datetime.now()
+            collection = self.votes_collection if self.vote_storage == 'collection' else self.polls_collection
+            requests = {}
+            shards = {}
+            for poll_id, user_id, option in votes:
+                if poll_id not in shards:
+                    shards[poll_id] = self.poll_db(poll_id)
+                if shards[poll_id] is None:
+                    continue
+                if self.vote_storage == 'collection':
+                    group_id = (polls or {}).get(poll_id, {}).get('group_id')
+                    update = pymongo.UpdateOne(
+                        {"poll_id": poll_id, "user_id": user_id},
+                        {"$set": {"code": poll_schema.OPTIONS.index(option), "group_id": group_id, "updated_at": now}},
+                        upsert=True
+                    )
+                else:
+                    # 只匹配進行中的投票
+                    update = pymongo.UpdateOne({"poll_id": poll_id, "status": "active"},
+                                               poll_schema.vote_pipeline(user_id, option, now))
+                requests.setdefault(shards[poll_id].name, (shards[poll_id], []))[1].append((poll_id, user_id, update))
+
+            closed = {poll_id for poll_id, shard_db in shards.items() if shard_db is None}
+            # 每個分片一次 bulk_write
+            modified = 0
+            for shard_db, shard_requests in requests.values():
+                poll_ids = {poll_id for poll_id, _, _ in shard_requests}
+                befores = {}
+                if self.vote_storage == 'collection':
+                    # 寫入前的記錄，投票在寫入期間結束時據此撤回
+                    keys = [(poll_id, user_id) for poll_id, user_id, _ in shard_requests]
+                    befores = dict.fromkeys(keys)
+                    cursor = shard_db[collection].find(
+                        {"poll_id": {"$in": list(poll_ids)}, "user_id": {"$in": [user_id for _, user_id in keys]}},
+                        {"_id": 0, "poll_id": 1, "user_id": 1, "code": 1, "updated_at": 1}
+                    )
+                    for vote in cursor:
+                        if (vote['poll_id'], vote['user_id']) in befores:
+                            befores[(vote['poll_id'], vote['user_id'])] = vote
+                result = shard_db[collection].bulk_write([update for _, _, update in shard_requests], ordered=False)
+                modified += result.modified_count + len(result.upserted_ids)
+                if self.vote_storage == 'collection' or result.matched_count < len(shard_requests):
+                    shard_closed = poll_ids - self._active_poll_ids(shard_db, poll_ids)
+                    if shard_closed and befores:
+                        self._restore_votes(shard_db, {key: before for key, before in befores.items() if key[0] in shard_closed})
+                    closed |= shard_closed
+            if closed:
+                logger.warning(f"批次添加投票選擇時投票不存在或已結束: {sorted(closed)}")
+            logger.info(f"批次添加投票選擇: {len(votes)} 筆, 修改 {modified} 筆")
+            return True, closed
+        except Exception as e:
+            logger.error(f"批次添加投票選擇時發生錯誤: {e}")
+            return False, set()
+
     # ===== 成員相關操作 =====
     
+    @route('vote')
     def save_member(self, group_id, user_id, name):
         """保存或更新成員信息
         參數:
@@ -231,7 +723,7 @@ class Database:
                 "name": name
             }
             
-            result = self.db[self.members_collection].update_one(
+            result = self.group_db(group_id)[self.members_collection].update_one(
                 {"group_id": group_id, "user_id": user_id},
                 {"$set": member_data},
                 upsert=True
@@ -243,6 +735,53 @@ class Database:
             logger.error(f"保存成員信息時發生錯誤: {e}")
             return False
     
+    @route('history')
+    def get_member_names(self, group_id):
+        """獲取群組成員的名稱對照表
+        參數:
+            group_id: 群組ID
+        返回:
+            {user_id: name} 字典
+        """
+        try:
+            cursor = self.group_db(group_id)[self.members_collection].find(
+                {"group_id": group_id}, {"_id": 0, "user_id": 1, "name": 1}
+            )
+            return {member["user_id"]: member.get("name") for member in cursor}
+        except Exception as e:
+            logger.error(f"獲取群組成員名稱時發生錯誤: {e}")
+            return {}
+
+    @route('vote')
+    def save_members(self, members):
+        """以一次 bulk_write 保存多位成員信息
+        參數:
+            members: (group_id, user_id, name) 列表
+        返回:
+            操作結果
+        """
+        if not members:
+            return True
+        try:
+            now = datetime.now()
+            requests = {}
+            for group_id, user_id, name in members:
+                shard_db = self.group_db(group_id)
+                requests.setdefault(shard_db.name, (shard_db, []))[1].append(pymongo.UpdateOne(
+                    {"group_id": group_id, "user_id": user_id},
+                    {"$set": {"group_id": group_id, "user_id": user_id, "updated_at": now, "name": name}},
+                    upsert=True
+                ))
+            # 每個分片一次 bulk_write
+            for shard_db, shard_requests in requests.values():
+                shard_db[self.members_collection].bulk_write(shard_requests, ordered=False)
+            logger.info(f"批次保存成員信息: {len(members)} 位")
+            return True
+        except Exception as e:
+            logger.error(f"批次保存成員信息時發生錯誤: {e}")
+            return False
+
+    @route('history')
     def get_group_members(self, group_id):
         """獲取群組所有成員
         參數:
@@ -251,8 +790,102 @@ class Database:
             成員列表
         """
         try:
-            members = list(self.db[self.members_collection].find({"group_id": group_id}))
+            members = list(self.group_db(group_id)[self.members_collection].find({"group_id": group_id}))
             return members
         except Exception as e:
             logger.error(f"獲取群組成員時發生錯誤: {e}")
-            return []
\ No newline at end of file
+            return []
+
+    # ===== 查詢API（唯讀） =====
+    # 以下方法不攔截例外，由 history_api 返回錯誤狀態，避免把查詢失敗當成空結果快取
+
+    @route('history')
+    def poll_versions(self, group_id, status=None, before=None, limit=50):
+        """群組投票的一頁 (poll_id, created_at, updated_at)，依 (created_at, poll_id) 由新到舊
+        以 POLL_LIST_INDEX 覆蓋查詢，只讀取索引
+        參數:
+            group_id: 群組ID
+            status: 可選，'active' 或 'closed'
+            before: 可選，(created_at, poll_id)，只返回排在此之後的投票（上一頁的最後一個）
+            limit: 最多返回的數量
+        返回:
+            [{"poll_id", "created_at", "updated_at"}] 列表
+        """
+        query = {"group_id": group_id}
+        if status:
+            query["status"] = status
+        if before:
+            created_at, poll_id = before
+            query["$or"] = [{"created_at": {"$lt": created_at}},
+                            {"created_at": created_at, "poll_id": {"$lt": poll_id}}]
+        cursor = self.group_db(group_id)[self.polls_collection].find(
+            query, {"_id": 0, "poll_id": 1, "created_at": 1, "updated_at": 1}
+        ).hint(POLL_LIST_INDEX).sort([("created_at", pymongo.DESCENDING), ("poll_id", pymongo.DESCENDING)]).limit(limit)
+        return list(cursor)
+
+    @route('history')
+    def get_poll_summaries(self, group_id, poll_ids):
+        """以投影讀取投票的基本欄位（不含投票記錄）
+        返回:
+            {poll_id: 基本資料}
+        """
+        projection = {"_id": 0, "poll_id": 1, "title": 1, "status": 1, "capacity": 1, "created_at": 1, "updated_at": 1}
+        cursor = self.group_db(group_id)[self.polls_collection].find(
+            {"group_id": group_id, "poll_id": {"$in": poll_ids}}, projection
+        )
+        return {poll["poll_id"]: poll for poll in cursor}
+
+    @route('history')
+    def poll_version(self, poll_id):
+        """投票最後的變更時間：投票文件的 updated_at，
+        votes 集合模式下再取該投票最後一票的 updated_at（投票文件不隨每一票更新）
+        返回:
+            (投票是否存在, 最後變更時間)
+        """
+        shard_db = self.poll_db(poll_id)
+        if shard_db is None:
+            return False, None
+        poll = shard_db[self.polls_collection].find_one(
+            {"poll_id": poll_id}, {"_id": 0, "poll_id": 1, "updated_at": 1}, hint=POLL_VERSION_INDEX
+        )
+        if poll is None:
+            return False, None
+        updated_at = poll.get("updated_at")
+        if self.vote_storage == 'collection':
+            latest = shard_db[self.votes_collection].find_one(
+                {"poll_id": poll_id}, {"_id": 0, "poll_id": 1, "updated_at": 1},
+                sort=[("updated_at", pymongo.DESCENDING)], hint=VOTE_VERSION_INDEX
+            )
+            if latest and latest.get("updated_at") and (updated_at is None or latest["updated_at"] > updated_at):
+                updated_at = latest["updated_at"]
+        return True, updated_at
+
+    @route('history')
+    def member_versions(self, group_id, after=None, limit=100):
+        """群組成員的一頁 (user_id, updated_at)，依 user_id 排序
+        以 MEMBER_LIST_INDEX 覆蓋查詢，只讀取索引
+        參數:
+            group_id: 群組ID
+            after: 可選，只返回 user_id 大於此值的成員（上一頁的最後一位）
+            limit: 最多返回的數量
+        返回:
+            [{"user_id", "updated_at"}] 列表
+        """
+        query = {"group_id": group_id}
+        if after:
+            query["user_id"] = {"$gt": after}
+        cursor = self.group_db(group_id)[self.members_collection].find(
+            query, {"_id": 0, "user_id": 1, "updated_at": 1}
+        ).hint(MEMBER_LIST_INDEX).sort("user_id", pymongo.ASCENDING).limit(limit)
+        return list(cursor)
+
+    @route('history')
+    def get_members_by_ids(self, group_id, user_ids):
+        """以投影讀取指定成員
+        返回:
+            {user_id: 成員資料}
+        """
+        cursor = self.group_db(group_id)[self.members_collection].find(
+            {"group_id": group_id, "user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "name": 1, "updated_at": 1}
+        )
+        return {member["user_id"]: member for member in cursor}
@@ -0,0 +1,105 @@
+"""
+資料庫操作的讀寫策略
+
+每個 Database 方法屬於一種路由，各路由有自己的寫入確認和讀取偏好：
+- vote:      投票和成員寫入，主節點確認即返回（w=1），投票尖峰時延遲最低
+- lifecycle: 建立、結束、刪除投票，多數節點確認（w=majority）後才返回，主節點切換時不會遺失
+- history:   已結束投票、匯出和統計等歷史讀取，優先讀取次要節點，不與投票尖峰搶主節點
+- default:   其他操作，使用用戶端的預設設定（讀取主節點）
+
+方法以 @route('名稱') 標記，執行期間 Database 取得的資料庫對象會套用該路由的設定，
+並以 metrics 記錄每個路由和方法的延遲（db.<路由>、db.<路由>.<方法>）。
+單機伺服器沒有次要節點也不需要多數確認，此時不套用任何設定。
+"""
+import os
+import time
+import inspect
+import functools
+import contextvars
+import metrics
+import tracing
+
+VOTE_WRITE_CONCERN = os.environ.get('DB_VOTE_WRITE_CONCERN', '1')
+LIFECYCLE_WRITE_CONCERN = os.environ.get('DB_LIFECYCLE_WRITE_CONCERN', 'majority')
+HISTORY_READ_PREFERENCE = os.environ.get('DB_HISTORY_READ_PREFERENCE', 'secondaryPreferred')
+# 次要節點最多落後主節點的秒數（MongoDB 要求至少 90 秒）
+HISTORY_MAX_STALENESS = int(os.environ.get('DB_HISTORY_MAX_STALENESS', '90'))
+
+DEFAULT = 'default'
+
+_current = contextvars.ContextVar('db_route', default=DEFAULT)
+
+
+def _write_concern(value):
+    return int(value) if value.isdigit() else value
+
+
+def options(route_name):
+    """路由對應的 with_options 參數，default 返回空字典"""
+    from pymongo import WriteConcern
+    from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+
+    if route_name == 'vote':
+        return {"write_concern": WriteConcern(w=_write_concern(VOTE_WRITE_CONCERN))}
+    if route_name == 'lifecycle':
+        return {"write_concern": WriteConcern(w=_write_concern(LIFECYCLE_WRITE_CONCERN))}
+    if route_name == 'history':
+        mode = read_pref_mode_from_name(HISTORY_READ_PREFERENCE)
+        staleness = HISTORY_MAX_STALENESS if HISTORY_READ_PREFERENCE != 'primary' else -1
+        return {"read_preference": make_read_preference(mode, None, max_staleness=staleness)}
+    return {}
+
+
+def transaction_options(route_name):
+    """交易的參數：交易內忽略集合層級的寫入確認，需在提交時指定"""
+    return {key: value for key, value in options(route_name).items() if key == "write_concern"}
+
+
+def current_route():
+    return _current.get()
+
+
+def _record(route_name, method, elapsed):
+    metrics.observe(f"db.{route_name}", elapsed)
+    metrics.observe(f"db.{route_name}.{method}", elapsed)
+
+
+def route(route_name):
+    """標記 Database 方法所屬的路由，並記錄延遲"""
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            # 產生器在每次取值時才執行，路由需在每次恢復執行時設定
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                generator = func(*args, **kwargs)
+                # 只計算產生器本身的執行時間，不含呼叫方處理每一項的時間
+                elapsed = 0.0
+                try:
+                    while True:
+                        token = _current.set(route_name)
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                            _current.reset(token)
+                        yield item
+                finally:
+                    generator.close()
+                    _record(route_name, func.__name__, elapsed)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _current.set(route_name)
+            start = time.perf_counter()
+            try:
+                with tracing.span(f"db.{func.__name__}", route=route_name):
+                    return func(*args, **kwargs)
+            finally:
+                _current.reset(token)
+                _record(route_name, func.__name__, time.perf_counter() - start)
+        return wrapper
+    return decorator
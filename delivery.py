@@ -0,0 +1,136 @@
+"""
+回覆優先的訊息投遞
+
+webhook 事件附帶的 reply token 可免費回覆一次（不計入每月的推送額度），但只在收到事件後短時間內有效。
+需要發送給事件來源的訊息（投票確認、/poll、/endpoll 的結果）先以 reply_message 發送，
+只有在令牌已過期、已被使用或被 LINE 拒絕時才改用 push_message。
+- 收到事件時以 received() 記錄令牌的時間；超過 REPLY_TOKEN_SECONDS 的令牌不再嘗試
+- 每個令牌只使用一次，之後的訊息直接推送
+- 回覆被拒絕（400，令牌無效）時改用推送；其他錯誤照常拋出，不重複發送
+回覆會出現在觸發事件的聊天室；投票確認是給個人的訊息，只有一對一聊天中的點擊才傳入 reply_token。
+各類訊息的回覆和推送次數記錄在 metrics 的 delivery.<類型>.reply / push 下。
+每次發送都交給 quota 計算額度；預算模式不允許推送的訊息（例如額度吃緊時的投票確認）只在能回覆時發送。
+帶 retry_key 的推送以單次請求的標頭發送：SDK 的 push_message(retry_key=...) 會把標頭留在共用的
+LineBotApi 上，之後所有的推送和回覆都會帶著同一個 X-Line-Retry-Key 而被 LINE 以 409 拒絕。
+"""
+import os
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+import metrics
+import startup
+import quota
+
+logger = logging.getLogger(__name__)
+
+linebot_exceptions = startup.lazy_module('linebot.exceptions')
+
+# 設為0時所有訊息都以推送發送
+REPLY_FIRST = os.environ.get('REPLY_FIRST', '1') == '1'
+# 令牌的有效時間（LINE 為1分鐘），保留網路延遲的餘裕
+REPLY_TOKEN_SECONDS = float(os.environ.get('REPLY_TOKEN_SECONDS', '50'))
+# 記錄的令牌數上限
+MAX_TOKENS = 10000
+
+# reply_token -> [收到的時間, 是否已使用]
+_tokens = OrderedDict()
+_lock = threading.Lock()
+
+
+def received(reply_token):
+    """記錄收到事件的時間（webhook 解析出事件時呼叫）"""
+    if not reply_token:
+        return
+    with _lock:
+        if reply_token in _tokens:
+            return
+        _tokens[reply_token] = [time.monotonic(), False]
+        while len(_tokens) > MAX_TOKENS:
+            _tokens.popitem(last=False)
+
+
+def _take(reply_token):
+    """取得令牌的使用權
+    返回:
+        True 表示可以嘗試回覆（未過期、未使用；未記錄的令牌交由 LINE 判斷）
+    """
+    if not REPLY_FIRST or not reply_token:
+        return False
+    with _lock:
+        entry = _tokens.get(reply_token)
+        if entry is None:
+            _tokens[reply_token] = [time.monotonic(), True]
+            return True
+        if entry[1]:
+            metrics.incr("delivery.token_used")
+            return False
+        entry[1] = True
+        if time.monotonic() - entry[0] > REPLY_TOKEN_SECONDS:
+            metrics.incr("delivery.token_expired")
+            return False
+        return True
+
+
+def send(line_bot_api, to, messages, reply_token=None, kind='message', retry_key=None):
+    """以回覆發送訊息，無法回覆時推送給 to
+    參數:
+        line_bot_api: LineBotApi對象
+        to: 推送時的接收者ID（應為令牌來源的聊天室或用戶）
+        messages: SendMessage 對象或列表（最多 5 則）
+        reply_token: 可選，事件的回覆令牌
+        kind: 訊息類型，用於統計
+        retry_key: 可選，推送時的 X-Line-Retry-Key
+    返回:
+        'reply'、'push'，或預算模式不允許推送時返回 'suppressed'
+    """
+    if _take(reply_token):
+        try:
+            line_bot_api.reply_message(reply_token, messages)
+            metrics.incr(f"delivery.{kind}.reply")
+            metrics.incr("delivery.reply")
+            quota.record(line_bot_api, kind, to, 'reply')
+            return 'reply'
+        except linebot_exceptions.LineBotApiError as e:
+            if e.status_code != 400:
+                raise
+            # 令牌已過期或已被使用（例如另一個副本已回覆錯誤訊息）
+            logger.info(f"回覆令牌無效，改用推送: {kind}, {e.error.message if e.error else e}")
+            metrics.incr("delivery.reply_rejected")
+    if not quota.allow_push(kind):
+        logger.info(f"訊息額度不足（{quota.mode()}），不推送: {kind} -> {to}")
+        metrics.incr(f"delivery.{kind}.suppressed")
+        return 'suppressed'
+    if retry_key:
+        _push_with_retry_key(line_bot_api, to, messages, retry_key)
+    else:
+        line_bot_api.push_message(to, messages)
+    metrics.incr(f"delivery.{kind}.push")
+    metrics.incr("delivery.push")
+    quota.record(line_bot_api, kind, to, 'push')
+    return 'push'
+
+
+def _push_with_retry_key(line_bot_api, to, messages, retry_key):
+    """以 X-Line-Retry-Key 推送，標頭只用於這一次請求，不修改共用的 line_bot_api.headers"""
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    data = {
+        'to': to,
+        'messages': [message.as_json_dict() for message in messages],
+        'notificationDisabled': False,
+    }
+    # _post 會再合併 line_bot_api.headers（授權標頭）
+    headers = {'Content-Type': 'application/json', 'X-Line-Retry-Key': retry_key}
+    line_bot_api._post('/v2/bot/message/push', data=json.dumps(data), headers=headers)
+
+
+def reply_ratio():
+    """以回覆發送的比例（所有類型合計）"""
+    replies = metrics.get("delivery.reply")
+    total = replies + metrics.get("delivery.push")
+    return round(replies / total, 3) if total else 0.0
+
+
+metrics.register_gauge("delivery.reply_ratio", reply_ratio)
@@ -0,0 +1,172 @@
+"""
+匯出出席歷史記錄
+
+以伺服器端游標逐筆讀取已結束的投票，並將每位投票者寫成一列（CSV 或 JSON Lines），
+記憶體用量與歷史長度無關。每寫完一個投票就更新檢查點檔案（含當時的檔案大小），中斷後可用 --resume 繼續：
+先把輸出截斷到檢查點的大小，移除寫到一半的投票，再從下一個投票繼續，不會有重複的列。
+
+用法:
+    python export.py --output history.csv
+    python export.py --format jsonl --group <群組ID> --since 2024-01-01 --until 2025-01-01 --output history.jsonl
+    python export.py --output history.csv --resume
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import logging
+from datetime import datetime
+from db import Database
+import poll_schema
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ["poll_id", "group_id", "title", "created_at", "closed_at", "user_id", "name", "option", "option_label"]
+
+
+def _checkpoint_path(output):
+    return f"{output}.checkpoint"
+
+
+def load_checkpoint(output):
+    """讀取檢查點
+    返回:
+        ((group_id, poll_id), 檔案大小) 元組，沒有檢查點則返回None；
+        舊版的檢查點沒有記錄檔案大小，此時大小為None
+    """
+    path = _checkpoint_path(output)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return (data["group_id"], data["poll_id"]), data.get("offset")
+
+
+def save_checkpoint(output, group_id, poll_id):
+    """原子地寫入檢查點（先寫暫存檔再改名）
+    同時記錄輸出檔案目前的大小（呼叫前輸出已 flush），繼續時截斷到此大小
+    """
+    path = _checkpoint_path(output)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"group_id": group_id, "poll_id": poll_id, "offset": os.path.getsize(output)}, f)
+    os.replace(tmp_path, path)
+
+
+def iter_rows(db, group_id=None, since=None, until=None, after=None):
+    """逐列產生匯出資料
+    成員名稱按群組讀取；游標依群組排序，因此同一時間只保留一個群組的名稱表
+    返回:
+        (poll, rows) 的產生器，rows 為該投票的所有列
+    """
+    names_group = None
+    names = {}
+    for poll in db.iter_closed_polls(group_id=group_id, since=since, until=until, after=after):
+        poll = db.load_votes(poll)
+        if poll.get("group_id") != names_group:
+            names_group = poll.get("group_id")
+            names = db.get_member_names(names_group)
+
+        rows = []
+        for user_id, option in poll_schema.voters(poll).items():
+            rows.append({
+                "poll_id": poll.get("poll_id"),
+                "group_id": poll.get("group_id"),
+                "title": poll.get("title"),
+                "created_at": _format_time(poll.get("created_at")),
+                "closed_at": _format_time(poll.get("updated_at")),
+                "user_id": user_id,
+                "name": names.get(user_id) or f"User_{user_id[-4:]}",
+                "option": option,
+                "option_label": poll_schema.OPTION_LABELS.get(option, option),
+            })
+        yield poll, rows
+
+
+def _format_time(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def export(db, out, fmt="csv", group_id=None, since=None, until=None, after=None, checkpoint=None, write_header=True):
+    """將歷史記錄寫入檔案對象
+    參數:
+        db: Database對象
+        out: 已開啟的文字檔案對象
+        fmt: 'csv' 或 'jsonl'
+        group_id/since/until: 篩選條件
+        after: 從此 (group_id, poll_id) 之後繼續
+        checkpoint: 可選，每個投票寫完後呼叫 checkpoint(group_id, poll_id)
+        write_header: CSV 是否寫入標題列
+    返回:
+        (投票數, 列數)
+    """
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        if write_header:
+            writer.writeheader()
+
+    poll_count = 0
+    row_count = 0
+    for poll, rows in iter_rows(db, group_id, since, until, after):
+        for row in rows:
+            if writer:
+                writer.writerow(row)
+            else:
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out.flush()
+        if checkpoint:
+            checkpoint(poll.get("group_id"), poll.get("poll_id"))
+        poll_count += 1
+        row_count += len(rows)
+    return poll_count, row_count
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="匯出出席歷史記錄")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="輸出格式")
+    parser.add_argument("--output", help="輸出檔案，未指定則寫到標準輸出")
+    parser.add_argument("--group", help="只匯出指定群組")
+    parser.add_argument("--since", type=_parse_date, help="創建日期下限 YYYY-MM-DD（含）")
+    parser.add_argument("--until", type=_parse_date, help="創建日期上限 YYYY-MM-DD（不含）")
+    parser.add_argument("--resume", action="store_true", help="從檢查點繼續上次中斷的匯出")
+    args = parser.parse_args(argv)
+
+    if args.resume and not args.output:
+        parser.error("--resume 需要搭配 --output")
+
+    db = Database()
+    try:
+        if not args.output:
+            polls, rows = export(db, sys.stdout, args.format, args.group, args.since, args.until)
+        else:
+            checkpoint = load_checkpoint(args.output) if args.resume else None
+            resuming = checkpoint is not None and os.path.exists(args.output)
+            after = None
+            if resuming:
+                after, offset = checkpoint
+                if offset is not None:
+                    # 移除檢查點之後寫到一半的投票（中斷時已寫出但尚未記錄檢查點的列）
+                    os.truncate(args.output, offset)
+            with open(args.output, "a" if resuming else "w", encoding="utf-8", newline="") as out:
+                polls, rows = export(
+                    db, out, args.format, args.group, args.since, args.until,
+                    after=after,
+                    checkpoint=lambda g, p: save_checkpoint(args.output, g, p),
+                    write_header=not resuming,
+                )
+            # 完整匯出後移除檢查點
+            if os.path.exists(_checkpoint_path(args.output)):
+                os.remove(_checkpoint_path(args.output))
+        logger.info(f"匯出完成: {polls} 個投票, {rows} 列")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
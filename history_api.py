@@ -0,0 +1,274 @@
+"""
+唯讀的查詢API（儀表板和維運以HTTP查詢投票、結果和成員，不必直接連線MongoDB）
+
+    GET /api/groups/<group_id>/polls?status=active|closed&limit=50&cursor=...
+    GET /api/polls/<poll_id>
+    GET /api/groups/<group_id>/members?limit=100&cursor=...
+
+- 以 Authorization: Bearer <API_TOKEN> 驗證；未設定 API_TOKEN 時不開放（404）
+- 列表依索引鍵排序並以游標分頁（投票依 (created_at, poll_id) 由新到舊，成員依 user_id），不使用 skip；
+  回應的 next_cursor 為下一頁的 cursor 參數，沒有下一頁時為 null
+- 每個請求先以覆蓋查詢（只讀索引中的鍵和 updated_at）計算 ETag 和 Last-Modified，
+  與 If-None-Match / If-Modified-Since 相符時直接返回 304，不讀取文件；
+  否則才以投影讀取該頁需要的欄位
+處理函數與框架無關，返回 (狀態碼, 標頭, 內容)，Flask（app.py）和 ASGI（asgi_app.py）模式共用。
+"""
+import os
+import re
+import hmac
+import json
+import base64
+import hashlib
+import logging
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import metrics
+import tracing
+import poll_schema
+
+logger = logging.getLogger(__name__)
+
+# 未設定時API不開放
+API_TOKEN = os.environ.get('API_TOKEN')
+DEFAULT_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = 200
+# 回應格式變更時遞增，舊的 ETag 隨之失效
+FORMAT_VERSION = 1
+
+STATUSES = ('active', 'closed')
+
+
+class ApiError(Exception):
+    """以指定狀態碼返回的錯誤"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _format_time(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _http_date(value):
+    """資料庫中的時間（本地時間，不含時區）轉為HTTP日期"""
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except ValueError:
+        raise ApiError(400, "cursor 無效")
+
+
+def _encode_poll_cursor(version):
+    """投票列表的游標：(created_at, poll_id)"""
+    return _encode_cursor(json.dumps([_format_time(version.get("created_at")), version["poll_id"]]))
+
+
+def _decode_poll_cursor(cursor):
+    key = _decode_cursor(cursor)
+    if key is None:
+        return None
+    try:
+        created_at, poll_id = json.loads(key)
+        return (datetime.fromisoformat(created_at) if created_at else None), poll_id
+    except (TypeError, ValueError):
+        raise ApiError(400, "cursor 無效")
+
+
+def _page_size(args):
+    value = args.get("limit")
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        size = int(value)
+    except ValueError:
+        raise ApiError(400, "limit 必須是整數")
+    if not 1 <= size <= MAX_PAGE_SIZE:
+        raise ApiError(400, f"limit 必須介於 1 和 {MAX_PAGE_SIZE} 之間")
+    return size
+
+
+def _validators(scope, versions):
+    """由 (鍵, updated_at) 計算 ETag 和 Last-Modified
+    參數:
+        scope: 請求的範圍（端點和參數），不同頁不會有相同的 ETag
+        versions: [(鍵, updated_at)]
+    返回:
+        (ETag, 最後變更時間或None)
+    """
+    digest = hashlib.sha1(json.dumps(
+        [FORMAT_VERSION, scope, [(key, _format_time(updated_at)) for key, updated_at in versions]],
+        ensure_ascii=False, default=str
+    ).encode()).hexdigest()[:24]
+    times = [updated_at for _, updated_at in versions if isinstance(updated_at, datetime)]
+    return f'"{digest}"', max(times) if times else None
+
+
+def _not_modified(headers, etag, last_modified):
+    """條件請求是否符合（有 If-None-Match 時只比對 ETag）"""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = headers.get("if-modified-since")
+    if not if_modified_since or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    # HTTP日期只到秒
+    return int(last_modified.astimezone(timezone.utc).timestamp()) <= int(since.timestamp())
+
+
+def _conditional(endpoint, headers, scope, versions, build):
+    """依條件請求返回 304，或以 build() 產生內容返回 200"""
+    etag, last_modified = _validators(scope, versions)
+    response_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified is not None:
+        response_headers["Last-Modified"] = _http_date(last_modified)
+    if _not_modified(headers, etag, last_modified):
+        metrics.incr(f"api.{endpoint}.not_modified")
+        return 304, response_headers, b""
+    metrics.incr(f"api.{endpoint}.ok")
+    body = json.dumps(build(), ensure_ascii=False, default=_format_time).encode("utf-8")
+    response_headers["Content-Type"] = "application/json; charset=utf-8"
+    return 200, response_headers, body
+
+
+def list_polls(db, headers, args, group_id):
+    """群組的投票列表（基本欄位，不含投票記錄）"""
+    status = args.get("status")
+    if status is not None and status not in STATUSES:
+        raise ApiError(400, "status 必須是 active 或 closed")
+    limit = _page_size(args)
+    before = _decode_poll_cursor(args.get("cursor"))
+
+    # 多取一筆判斷是否有下一頁
+    versions = db.poll_versions(group_id, status=status, before=before, limit=limit + 1)
+    page = versions[:limit]
+    next_cursor = _encode_poll_cursor(page[-1]) if len(versions) > limit else None
+    scope = ["polls", group_id, status, before, limit, next_cursor]
+
+    def build():
+        poll_ids = [version["poll_id"] for version in page]
+        summaries = db.get_poll_summaries(group_id, poll_ids)
+        return {"polls": [summaries[poll_id] for poll_id in poll_ids if poll_id in summaries],
+                "next_cursor": next_cursor}
+
+    return _conditional("polls", headers, scope,
+                        [(version["poll_id"], version.get("updated_at")) for version in page], build)
+
+
+def poll_results(db, headers, args, poll_id):
+    """單一投票的結果：票數、各選項的投票者（含名稱）和候補名單"""
+    found, updated_at = db.poll_version(poll_id)
+    if not found:
+        raise ApiError(404, "找不到投票")
+
+    def build():
+        poll = db.load_votes(db.get_poll(poll_id))
+        if poll is None:
+            raise ApiError(404, "找不到投票")
+        names = db.get_member_names(poll.get('group_id'))
+
+        def people(user_ids):
+            return [{"user_id": user_id, "name": names.get(user_id)} for user_id in user_ids]
+
+        result = {field: poll.get(field) for field in
+                  ("poll_id", "title", "group_id", "status", "capacity", "created_at", "updated_at")}
+        result["updated_at"] = updated_at
+        result["counts"] = poll_schema.counts(poll)
+        result["voters"] = {option: people(poll_schema.option_voters(poll, option)) for option in poll_schema.OPTIONS}
+        result["waitlist"] = people(poll_schema.waitlist(poll))
+        return result
+
+    return _conditional("poll", headers, ["poll", poll_id], [(poll_id, updated_at)], build)
+
+
+def list_members(db, headers, args, group_id):
+    """群組成員列表"""
+    limit = _page_size(args)
+    after = _decode_cursor(args.get("cursor"))
+
+    versions = db.member_versions(group_id, after=after, limit=limit + 1)
+    page = versions[:limit]
+    next_cursor = _encode_cursor(page[-1]["user_id"]) if len(versions) > limit else None
+    scope = ["members", group_id, after, limit, next_cursor]
+
+    def build():
+        user_ids = [version["user_id"] for version in page]
+        members = db.get_members_by_ids(group_id, user_ids)
+        return {"members": [members[user_id] for user_id in user_ids if user_id in members],
+                "next_cursor": next_cursor}
+
+    return _conditional("members", headers, scope,
+                        [(version["user_id"], version.get("updated_at")) for version in page], build)
+
+
+# (路徑, 處理函數)，路徑參數依序傳入處理函數
+ROUTES = [
+    (re.compile(r"^/api/groups/([^/]+)/polls$"), list_polls),
+    (re.compile(r"^/api/polls/([^/]+)$"), poll_results),
+    (re.compile(r"^/api/groups/([^/]+)/members$"), list_members),
+]
+
+
+def _authorized(headers):
+    authorization = headers.get("authorization") or ""
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), API_TOKEN.encode())
+
+
+def _error(status, message):
+    body = json.dumps({"error": message}, ensure_ascii=False).encode("utf-8")
+    return status, {"Content-Type": "application/json; charset=utf-8"}, body
+
+
+@tracing.traced("api.request")
+def handle(db, method, path, args, headers):
+    """處理一個API請求
+    參數:
+        db: Database對象
+        method: HTTP方法
+        path: 請求路徑（/api/...）
+        args: 查詢參數（以 get 取值）
+        headers: 請求標頭（以小寫名稱 get 取值）
+    返回:
+        (狀態碼, 標頭字典, 內容 bytes)
+    """
+    if not API_TOKEN:
+        return _error(404, "Not Found")
+    if not _authorized(headers):
+        metrics.incr("api.unauthorized")
+        return _error(401, "Unauthorized")
+    for pattern, handler in ROUTES:
+        match = pattern.match(path)
+        if match:
+            break
+    else:
+        return _error(404, "Not Found")
+    if method not in ("GET", "HEAD"):
+        return _error(405, "Method Not Allowed")
+
+    try:
+        status, response_headers, body = handler(db, headers, args, *match.groups())
+    except ApiError as e:
+        return _error(e.status, e.message)
+    except Exception as e:
+        logger.error(f"處理API請求時發生錯誤: {path}, {e}")
+        metrics.incr("api.errors")
+        return _error(503, "Service Unavailable")
+    if method == "HEAD":
+        body = b""
+    return status, response_headers, body
@@ -0,0 +1,87 @@
+import os
+import time
+import threading
+
+# Crockford Base32 字母表（不含 I、L、O、U，且不含底線，可安全放入 postback 的 vote_{poll_id}_{option}）
+ENCODING = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+# ID 組成：48 位元毫秒時間戳（10 字元）+ 80 位元隨機數（16 字元），共 26 字元
+TIME_LEN = 10
+RANDOM_LEN = 16
+RANDOM_BITS = 80
+RANDOM_MAX = (1 << RANDOM_BITS) - 1
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+
+def _reset_state():
+    """重置單調狀態（fork 後子行程不可沿用父行程的隨機序列）"""
+    global _last_ms, _last_random
+    _last_ms = 0
+    _last_random = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_state)
+
+
+def _encode(value, length):
+    """將整數編碼為固定長度的 Crockford Base32 字串"""
+    chars = []
+    for _ in range(length):
+        chars.append(ENCODING[value & 0x1F])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+def new_id(now_ms=None):
+    """產生可依時間排序的唯一ID（ULID 格式）
+    同一毫秒內在同一行程中遞增隨機部分以保持單調；
+    不同行程/機器之間依靠 80 位元隨機數避免碰撞，不需要協調。
+    參數:
+        now_ms: 可選，指定毫秒時間戳（測試用）
+    返回:
+        26 字元的 ID 字串，字典序即為時間序
+    """
+    global _last_ms, _last_random
+    if now_ms is None:
+        now_ms = int(time.time() * 1000)
+
+    with _lock:
+        if now_ms <= _last_ms:
+            # 同一毫秒（或時鐘回撥）：沿用上一個時間戳並遞增隨機部分
+            now_ms = _last_ms
+            random_part = _last_random + 1
+            if random_part > RANDOM_MAX:
+                # 隨機部分溢位，借用下一毫秒
+                now_ms += 1
+                random_part = int.from_bytes(os.urandom(10), "big")
+        else:
+            random_part = int.from_bytes(os.urandom(10), "big")
+        _last_ms = now_ms
+        _last_random = random_part
+
+    return _encode(now_ms, TIME_LEN) + _encode(random_part, RANDOM_LEN)
+
+
+def id_timestamp(poll_id):
+    """從ID取出建立時間（毫秒），舊式的秒級時間戳ID同樣支援
+    參數:
+        poll_id: 投票ID
+    返回:
+        毫秒時間戳，無法解析時返回None
+    """
+    if not poll_id:
+        return None
+    if poll_id.isdigit():
+        # 舊格式：int(datetime.now().timestamp())
+        return int(poll_id) * 1000
+    value = 0
+    for char in poll_id[:TIME_LEN].upper():
+        index = ENCODING.find(char)
+        if index < 0:
+            return None
+        value = (value << 5) | index
+    return value
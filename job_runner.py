@@ -0,0 +1,176 @@
+"""
+排程任務的執行器
+
+排程執行緒只負責判斷任務是否到期，任務本身交給有上限的執行緒池執行，
+一個慢的任務不會延誤其他任務。每個任務有自己的逾時和重疊策略：
+- skip:  上一次仍在執行時略過這一次
+- queue: 上一次仍在執行時排入一次，結束後立即再執行（多次到期只排入一次）
+- allow: 允許同時執行
+
+執行緒無法被強制中止，逾時採用協作式取消：逾時後記錄 timeout 並設定取消旗標，
+任務在每個處理單元之間以 cancelled() 檢查，發現被取消就停止。
+任務的執行位置在任務函數實際返回後才釋放，因此 skip / queue 的任務即使逾時也不會同時執行兩份；
+queue 排入的下一次在逾時的那次結束後才開始。
+卡住的 LINE 或 MongoDB 呼叫本身由各自的逾時設定結束。
+每次執行的耗時和結果（ok、error、timeout、skipped）記錄在 metrics 的 scheduler.<任務> 下。
+非同步模式（asgi_app）下任務改在事件迴圈上執行，執行緒池不使用。
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import metrics
+import async_bridge
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', '4'))
+
+OVERLAP_POLICIES = ('skip', 'queue', 'allow')
+
+_cancel_event = contextvars.ContextVar('job_cancel_event', default=None)
+
+
+def cancelled():
+    """目前執行的任務是否已逾時被取消（不在任務中時返回 False）"""
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+
+class Job:
+    """一個排程任務的設定和執行狀態"""
+
+    def __init__(self, name, func, timeout, overlap='skip'):
+        """
+        參數:
+            name: 任務名稱，用於日誌和指標
+            func: 無參數的任務函數
+            timeout: 逾時秒數
+            overlap: 重疊策略，'skip'、'queue' 或 'allow'
+        """
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError(f"未知的重疊策略: {overlap}")
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.overlap = overlap
+        self.running = 0
+        self.queued = False
+        self.last_started_at = None
+        self.last_duration = None
+        self.last_outcome = None
+
+
+class _Run:
+    __slots__ = ("job", "cancel", "start")
+
+    def __init__(self, job):
+        self.job = job
+        self.cancel = threading.Event()
+        self.start = None
+
+
+class JobRunner:
+    """以執行緒池執行排程任務"""
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scheduler-job")
+        self._lock = threading.Lock()
+        self.jobs = {}
+
+    def add(self, name, func, timeout, overlap='skip'):
+        """註冊任務
+        返回:
+            無參數的觸發函數，交給 schedule 的 do()
+        """
+        job = self.jobs[name] = Job(name, func, timeout, overlap)
+        return lambda: self.submit(job)
+
+    def submit(self, job):
+        """任務到期：依重疊策略決定是否提交到執行緒池
+        返回:
+            True 表示已提交
+        """
+        with self._lock:
+            if job.running and job.overlap != 'allow':
+                if job.overlap == 'queue':
+                    job.queued = True
+                    logger.info(f"排程任務 {job.name} 仍在執行，結束後再執行一次")
+                else:
+                    logger.warning(f"排程任務 {job.name} 仍在執行，略過這一次")
+                    self._record(job, 'skipped')
+                return False
+            job.running += 1
+        run = _Run(job)
+        if async_bridge.enabled():
+            # 非同步模式：任務在事件迴圈上的 greenlet 中執行，等待 I/O 時不佔用執行緒
+            async_bridge.spawn(self._execute, run)
+        else:
+            self._executor.submit(self._execute, run)
+        return True
+
+    def _execute(self, run):
+        job = run.job
+        run.start = time.perf_counter()
+        job.last_started_at = datetime.now()
+        timer = threading.Timer(job.timeout, self._on_timeout, args=(run,))
+        timer.daemon = True
+        timer.start()
+
+        token = _cancel_event.set(run.cancel)
+        outcome = 'ok'
+        try:
+            job.func()
+        except Exception as e:
+            outcome = 'error'
+            logger.error(f"排程任務 {job.name} 發生錯誤: {e}")
+        finally:
+            _cancel_event.reset(token)
+            timer.cancel()
+
+        duration = time.perf_counter() - run.start
+        metrics.observe(f"scheduler.{job.name}", duration)
+        if run.cancel.is_set():
+            # 逾時時已記錄結果
+            logger.info(f"已逾時的排程任務 {job.name} 在 {duration:.1f} 秒後結束")
+        else:
+            job.last_duration = duration
+            self._record(job, outcome)
+        self._release(job)
+
+    def _on_timeout(self, run):
+        job = run.job
+        run.cancel.set()
+        job.last_duration = time.perf_counter() - run.start
+        logger.error(f"排程任務 {job.name} 超過 {job.timeout} 秒，已要求取消")
+        # 執行位置由 _execute 在任務返回後釋放
+        self._record(job, 'timeout')
+
+    def _release(self, job):
+        with self._lock:
+            job.running -= 1
+            rerun = job.queued and not job.running
+            job.queued = False
+        if rerun:
+            self.submit(job)
+
+    def _record(self, job, outcome):
+        job.last_outcome = outcome
+        metrics.incr(f"scheduler.{job.name}.{outcome}")
+
+    def status(self):
+        """各任務的最近一次執行狀態（供 /jobs 指令查看）"""
+        lines = []
+        for job in self.jobs.values():
+            started = job.last_started_at.strftime('%m/%d %H:%M:%S') if job.last_started_at else "未執行"
+            duration = f"{job.last_duration:.1f}s" if job.last_duration is not None else "-"
+            running = f", 執行中 {job.running}" if job.running else ""
+            lines.append(f"{job.name}: {started}, {duration}, {job.last_outcome or '-'}{running}"
+                         f"（逾時 {job.timeout}s, {job.overlap}）")
+        return "\n".join(lines) or "沒有排程任務"
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,240 @@
+import os
+import socket
+import threading
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from linebot import LineBotApi
+from linebot.http_client import HttpClient, HttpResponse, RequestsHttpClient, RequestsHttpResponse
+import metrics
+import tracing
+import async_bridge
+
+logger = logging.getLogger(__name__)
+
+# 連線池大小，預設與工作執行緒數相同
+POOL_SIZE = int(os.environ.get('LINE_HTTP_POOL_SIZE', os.environ.get('WEB_CONCURRENCY', '10')))
+# 非同步模式的連線數不受工作執行緒數限制，超過時請求在連線池中等待
+ASYNC_POOL_SIZE = int(os.environ.get('LINE_ASYNC_POOL_SIZE', '100'))
+
+# LINE API 位址，壓力測試時指向模擬伺服器
+API_ENDPOINT = os.environ.get('LINE_API_ENDPOINT')
+
+# 各類端點的 (連線逾時, 讀取逾時)，單位秒
+CONNECT_TIMEOUT = float(os.environ.get('LINE_CONNECT_TIMEOUT', '3'))
+READ_TIMEOUTS = {
+    'profile': float(os.environ.get('LINE_PROFILE_TIMEOUT', '5')),
+    'message': float(os.environ.get('LINE_MESSAGE_TIMEOUT', '10')),
+    'content': float(os.environ.get('LINE_CONTENT_TIMEOUT', '30')),
+    'other': float(os.environ.get('LINE_OTHER_TIMEOUT', '10')),
+}
+
+# TCP keep-alive：閒置 60 秒後開始探測，每 15 秒一次，4 次無回應即斷線
+KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _name, _value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4)):
+    if hasattr(socket, _name):
+        KEEPALIVE_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _name), _value))
+
+
+def endpoint_kind(url):
+    """依URL判斷端點類型，用於選擇逾時和統計"""
+    if 'api-data.line.me' in url or '/content' in url:
+        return 'content'
+    if '/profile' in url or '/member/' in url:
+        return 'profile'
+    if '/message/' in url:
+        return 'message'
+    return 'other'
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """啟用 TCP keep-alive 的連線池"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + KEEPALIVE_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+    def reuse_stats(self):
+        """統計連線重用情況
+        返回:
+            (請求數, 新建連線數)
+        """
+        requests_count = 0
+        connections = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+        return requests_count, connections
+
+
+_session = None
+_adapter = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """取得全行程共用的 Session（webhook 處理和排程器共用同一個連線池）"""
+    global _session, _adapter
+    with _session_lock:
+        if _session is None:
+            _adapter = KeepAliveAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, pool_block=False)
+            _session = requests.Session()
+            _session.mount('https://', _adapter)
+            _session.mount('http://', _adapter)
+            metrics.register_gauge('line_api.connection_reuse_rate', connection_reuse_rate)
+            logger.info(f"已建立LINE API連線池，大小: {POOL_SIZE}")
+        return _session
+
+
+def connection_reuse_rate():
+    """連線重用率：不需要新建連線的請求比例"""
+    if _adapter is None:
+        return 0.0
+    requests_count, connections = _adapter.reuse_stats()
+    if requests_count == 0:
+        return 0.0
+    return round(1 - connections / requests_count, 3)
+
+
+def _measure(kind, method, timeout_error, send):
+    """發送請求並記錄端點類型的延遲、逾時次數和追蹤區段"""
+    start = time.perf_counter()
+    with tracing.span(f"line_api.{kind}", method=method) as span:
+        try:
+            response = send()
+        except timeout_error:
+            metrics.incr(f"line_api.{kind}.timeouts")
+            raise
+        finally:
+            metrics.observe(f"line_api.{kind}", time.perf_counter() - start)
+        span.set("status", response.status_code)
+    return response
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """使用共用連線池並按端點類型設定逾時的 HTTP 客戶端"""
+
+    def __init__(self, timeout=None):
+        super().__init__(timeout=timeout)
+        self.session = get_session()
+
+    def _request(self, method, url, timeout, **kwargs):
+        kind = endpoint_kind(url)
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUTS[kind])
+        response = _measure(kind, method, requests.exceptions.Timeout,
+                            lambda: self.session.request(method, url, timeout=timeout, **kwargs))
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request('PUT', url, timeout, headers=headers, data=data)
+
+
+_async_client = None
+
+
+def get_async_client():
+    """取得全行程共用的 httpx.AsyncClient（非同步模式）"""
+    global _async_client
+    with _session_lock:
+        if _async_client is None:
+            import httpx
+            _async_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASYNC_POOL_SIZE,
+                                                                  max_keepalive_connections=ASYNC_POOL_SIZE))
+            logger.info(f"已建立LINE API非同步連線池，大小: {ASYNC_POOL_SIZE}")
+        return _async_client
+
+
+async def close_async_client():
+    """關閉非同步連線池（asgi_app 結束時呼叫）"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+class HttpxHttpResponse(HttpResponse):
+    """httpx 回應（內容已完整讀取）"""
+
+    def __init__(self, response):
+        self.response = response
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    @property
+    def text(self):
+        return self.response.text
+
+    @property
+    def content(self):
+        return self.response.content
+
+    @property
+    def json(self):
+        return self.response.json()
+
+    def iter_content(self, chunk_size=1024, decode_unicode=False):
+        body = self.response.text if decode_unicode else self.response.content
+        return (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+
+
+class AsyncHttpClient(HttpClient):
+    """非同步模式的 HTTP 客戶端：LineBotApi 照常同步呼叫，請求經由 async_bridge 以 httpx 在事件迴圈上發送
+    逾時和指標與 PooledHttpClient 相同
+    """
+
+    def __init__(self, timeout=None):
+        super().__init__(timeout=timeout)
+        self.client = get_async_client()
+
+    def _request(self, method, url, timeout, **kwargs):
+        import httpx
+        kind = endpoint_kind(url)
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUTS[kind])
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        timeout = httpx.Timeout(read, connect=connect)
+        response = _measure(kind, method, httpx.TimeoutException,
+                            lambda: async_bridge.call(self.client.request, method, url, timeout=timeout, **kwargs))
+        return HttpxHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, timeout, headers=headers, params=params)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, timeout, headers=headers, content=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, timeout, headers=headers, content=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request('PUT', url, timeout, headers=headers, content=data)
+
+
+def create_line_bot_api(channel_access_token):
+    """建立使用共用連線池的 LineBotApi（非同步模式下以 httpx 發送）"""
+    http_client = AsyncHttpClient if async_bridge.enabled() else PooledHttpClient
+    if API_ENDPOINT:
+        return LineBotApi(channel_access_token, endpoint=API_ENDPOINT, http_client=http_client)
+    return LineBotApi(channel_access_token, http_client=http_client)
@@ -0,0 +1,78 @@
+import threading
+from collections import defaultdict
+
+# 行程內的計數器和耗時統計，供 /metrics 指令查看
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = {}
+_gauges = {}
+
+
+def incr(name, value=1):
+    """累加計數器"""
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, seconds):
+    """記錄一次耗時（秒）"""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+
+
+def register_gauge(name, func):
+    """註冊一個在取快照時才計算的指標（如比率、佇列長度）"""
+    with _lock:
+        _gauges[name] = func
+
+
+def get(name):
+    """讀取計數器目前的值"""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot(prefix=None):
+    """取得所有指標的快照
+    參數:
+        prefix: 可選，只返回以此前綴開頭的指標
+    返回:
+        {"counters": {...}, "timings": {name: {count, avg_ms, max_ms}}, "gauges": {...}}
+    """
+    with _lock:
+        counters = {k: v for k, v in _counters.items() if not prefix or k.startswith(prefix)}
+        timings = {
+            k: {
+                "count": t["count"],
+                "avg_ms": round(t["total"] / t["count"] * 1000, 2) if t["count"] else 0,
+                "max_ms": round(t["max"] * 1000, 2)
+            }
+            for k, t in _timings.items() if not prefix or k.startswith(prefix)
+        }
+        gauges = {k: f for k, f in _gauges.items() if not prefix or k.startswith(prefix)}
+    values = {}
+    for name, func in gauges.items():
+        try:
+            values[name] = func()
+        except Exception as e:
+            values[name] = f"error: {e}"
+    return {"counters": counters, "timings": timings, "gauges": values}
+
+
+def format_snapshot(prefix=None):
+    """將指標快照格式化為文字訊息"""
+    data = snapshot(prefix)
+    lines = []
+    for name in sorted(data["counters"]):
+        lines.append(f"{name}: {data['counters'][name]}")
+    for name in sorted(data["gauges"]):
+        lines.append(f"{name}: {data['gauges'][name]}")
+    for name in sorted(data["timings"]):
+        t = data["timings"][name]
+        lines.append(f"{name}: {t['count']} 次, 平均 {t['avg_ms']}ms, 最大 {t['max_ms']}ms")
+    return "\n".join(lines) or "目前沒有指標"
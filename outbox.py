@@ -0,0 +1,333 @@
+"""
+LINE 訊息發件匣
+
+所有需要可靠送達的訊息（新投票、投票結果、給開發者的通知）先和觸發它的狀態變更一起寫入
+outbox 集合（副本集上使用交易；單機伺服器則先寫發件匣再變更狀態），
+再由背景的投遞執行緒取出發送：
+- 至少送達一次：發送成功才標記為 sent；程序在發送途中中止時，租約到期後會被重新取出
+- 冪等：每筆訊息有唯一的 key，重複寫入會被忽略；推送時帶上 X-Line-Retry-Key，LINE 端不會重複投遞。
+  批次第一次推送前把重試令牌和是否合併通知寫入批次中的每筆訊息，重試時整批取出、以相同的令牌和內容重送
+- 批次：每輪一次取出多筆，同一接收者的訊息合併為一次推送（最多 5 則）
+- 額度吃緊時開發者通知延後並合併成較少的推送（見 quota）
+- 回覆優先：附帶回覆令牌（/poll、/endpoll）的訊息在令牌有效期內以回覆發送，不計入推送額度
+"""
+import os
+import threading
+import uuid
+import logging
+from datetime import datetime, timedelta
+import metrics
+import startup
+import tracing
+import profiler
+import delivery
+import quota
+
+logger = logging.getLogger(__name__)
+
+pymongo = startup.lazy_module('pymongo')
+linebot_exceptions = startup.lazy_module('linebot.exceptions')
+
+BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '5'))
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 8
+PUSH_MAX_MESSAGES = 5
+TEXT_MAX_LENGTH = 5000
+
+_wakeup = threading.Event()
+_worker = None
+
+
+class _RawMessage:
+    """已序列化的訊息，推送時直接輸出保存的 JSON"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_json_dict(self):
+        return self.data
+
+
+def enqueue(db, key, to, messages, kind, session=None, reply_token=None):
+    """寫入一筆待發送的訊息
+    參數:
+        db: Database對象
+        key: 冪等鍵，同一個 key 只會發送一次
+        to: 接收者ID（用戶或群組）
+        messages: SendMessage 對象列表（最多 5 則）
+        kind: 訊息類型，如 'poll'、'result'、'note'
+        session: 可選，交易的 session
+        reply_token: 可選，觸發事件的回覆令牌（事件來源須為 to）；在有效期內投遞時以回覆發送
+    返回:
+        True 表示新寫入，False 表示已存在
+    """
+    if not to:
+        logger.warning(f"發件匣訊息沒有接收者，略過: {key}")
+        return False
+    now = datetime.now()
+    collection = db.db[db.outbox_collection]
+    # 交易中的重複鍵錯誤會中止整個交易，先查詢是否已寫入
+    if session is not None and collection.find_one({"key": key}, {"_id": 1}, session=session):
+        logger.info(f"發件匣訊息已存在: {key}")
+        return False
+    try:
+        collection.insert_one({
+            "key": key,
+            "to": to,
+            "kind": kind,
+            "messages": [message.as_json_dict() for message in messages],
+            "status": "pending",
+            "attempts": 0,
+            "created_at": now,
+            "next_attempt_at": now,
+            # 投遞時接續寫入這筆訊息的追蹤
+            "trace": tracing.current_context(),
+            # 回覆令牌只在收到事件後短時間內有效，過期後改為推送
+            **({"reply_token": reply_token, "reply_by": now + timedelta(seconds=delivery.REPLY_TOKEN_SECONDS)}
+               if reply_token else {}),
+        }, session=session)
+        metrics.incr(f"outbox.enqueued.{kind}")
+        return True
+    except pymongo.errors.DuplicateKeyError:
+        if session is not None:
+            # 同時寫入的另一筆已使交易中止，拋出讓呼叫者處理
+            raise
+        logger.info(f"發件匣訊息已存在: {key}")
+        return False
+
+
+def cancel(db, keys):
+    """撤回尚未取出的訊息（單機伺服器沒有交易，狀態變更失敗時刪除先寫入的訊息）
+    返回:
+        刪除的筆數
+    """
+    result = db.db[db.outbox_collection].delete_many({"key": {"$in": list(keys)}, "status": "pending"})
+    if result.deleted_count:
+        logger.info(f"已撤回發件匣訊息: {result.deleted_count} 筆")
+    return result.deleted_count
+
+
+def notify():
+    """通知投遞執行緒立即處理（在狀態變更提交後呼叫）"""
+    _wakeup.set()
+
+
+def _claim(db, now):
+    """以租約方式取出一批待發送的訊息
+    三次往返：找出候選、以本輪的 claim 標記鎖定、讀回成功鎖定的文件
+    """
+    collection = db.db[db.outbox_collection]
+    due = {"$or": [
+        {"status": "pending", "next_attempt_at": {"$lte": now}},
+        {"status": "sending", "lease_until": {"$lt": now}},
+    ]}
+    candidates = dict(due)
+    # 額度吃緊時開發者通知留在發件匣，到合併推送的時間才取出
+    deferred = quota.deferred_kinds()
+    if deferred:
+        candidates["kind"] = {"$nin": deferred}
+    docs = list(collection.find(candidates, {"_id": 1, "retry_key": 1})
+                .sort("next_attempt_at", pymongo.ASCENDING).limit(BATCH_SIZE))
+    if not docs:
+        return []
+    ids = [doc["_id"] for doc in docs]
+    # 已推送過的批次整批取出（不受筆數和延後類型限制），才能以相同的重試令牌重送相同的內容
+    retry_keys = list({doc["retry_key"] for doc in docs if doc.get("retry_key")})
+    if retry_keys:
+        ids += [doc["_id"] for doc in collection.find({**due, "retry_key": {"$in": retry_keys}, "_id": {"$nin": ids}}, {"_id": 1})]
+
+    claim = uuid.uuid4().hex
+    collection.update_many(
+        {"_id": {"$in": ids}, **due},
+        {"$set": {"status": "sending", "claim": claim, "lease_until": now + timedelta(seconds=LEASE_SECONDS)},
+         "$inc": {"attempts": 1}}
+    )
+    return list(collection.find({"claim": claim}).sort("created_at", pymongo.ASCENDING))
+
+
+def _is_text_note(entry):
+    return entry["kind"] == 'note' and all(message.get("type") == 'text' for message in entry["messages"])
+
+
+def _merge_texts(messages):
+    """將文字訊息依序合併，每則不超過 TEXT_MAX_LENGTH 字"""
+    merged = []
+    for message in messages:
+        text = message["text"]
+        if merged and len(merged[-1]["text"]) + len(text) + 2 <= TEXT_MAX_LENGTH:
+            merged[-1]["text"] += "\n\n" + text
+        else:
+            merged.append({"type": "text", "text": text})
+    return merged
+
+
+def _merged_size(current, entry):
+    """文字通知加入批次後，合併的訊息增加的則數"""
+    before = [message for other in current if _is_text_note(other) for message in other["messages"]]
+    return len(_merge_texts(before + entry["messages"])) - len(_merge_texts(before))
+
+
+def _group_batches(entries, merge_notes=False):
+    """將同一接收者的訊息合併為每次最多 5 則的推送
+    merge_notes 時開發者的文字通知先合併成較少的長訊息，再計算則數
+    """
+    batches = []
+    by_recipient = {}
+    for entry in entries:
+        by_recipient.setdefault(entry["to"], []).append(entry)
+    for to, recipient_entries in by_recipient.items():
+        current, count = [], 0
+        for entry in recipient_entries:
+            size = len(entry["messages"])
+            if merge_notes and _is_text_note(entry):
+                size = _merged_size(current, entry)
+            if current and count + size > PUSH_MAX_MESSAGES:
+                batches.append((to, current))
+                current, count = [], 0
+                if merge_notes and _is_text_note(entry):
+                    size = _merged_size(current, entry)
+            current.append(entry)
+            count += size
+        if current:
+            batches.append((to, current))
+    return batches
+
+
+def _reply_token(entries, now):
+    """批次中第一個仍在有效期內的回覆令牌（第一次投遞時才使用，重試時令牌可能已被使用）"""
+    for entry in entries:
+        if entry.get("reply_token") and entry["attempts"] <= 1 and entry["reply_by"] > now:
+            return entry["reply_token"]
+    return None
+
+
+def _batch_messages(entries, merge_notes=False):
+    if not merge_notes:
+        return [message for entry in entries for message in entry["messages"]]
+    notes = [message for entry in entries if _is_text_note(entry) for message in entry["messages"]]
+    others = [message for entry in entries if not _is_text_note(entry) for message in entry["messages"]]
+    return others + _merge_texts(notes)
+
+
+def _plan_batches(collection, entries, merge_notes):
+    """決定本輪的推送批次
+    重試的訊息沿用第一次推送時的批次、重試令牌和合併方式；新的批次先寫入重試令牌再推送
+    返回:
+        [(接收者, 訊息列表, 是否合併通知)]
+    """
+    batches = []
+    frozen = {}
+    fresh = []
+    for entry in entries:
+        if entry.get("retry_key"):
+            frozen.setdefault(entry["retry_key"], []).append(entry)
+        else:
+            fresh.append(entry)
+    for batch in frozen.values():
+        batches.append((batch[0]["to"], batch, batch[0].get("merged", False)))
+    for to, batch in _group_batches(fresh, merge_notes):
+        retry_key = str(uuid.uuid4())
+        collection.update_many({"_id": {"$in": [entry["_id"] for entry in batch]}},
+                               {"$set": {"retry_key": retry_key, "merged": merge_notes}})
+        for entry in batch:
+            entry["retry_key"] = retry_key
+        batches.append((to, batch, merge_notes))
+    return batches
+
+
+def _send_batch(line_bot_api, to, entries, merge_notes=False):
+    messages = [_RawMessage(message) for message in _batch_messages(entries, merge_notes)]
+    retry_key = entries[0]["retry_key"]
+    # 合併推送的多筆訊息接續第一筆的追蹤
+    parent = next((tuple(entry["trace"]) for entry in entries if entry.get("trace")), None)
+    with tracing.span("outbox.push", parent=parent, entries=len(entries)) as span:
+        span.set("via", delivery.send(line_bot_api, to, messages, reply_token=_reply_token(entries, datetime.now()),
+                                      kind=f"outbox.{entries[0]['kind']}", retry_key=retry_key))
+
+
+@profiler.profiled("outbox.drain_once")
+def drain_once(db, line_bot_api):
+    """處理一批到期的訊息
+    返回:
+        本輪處理的訊息數
+    """
+    collection = db.db[db.outbox_collection]
+    now = datetime.now()
+    entries = _claim(db, now)
+    if not entries:
+        return 0
+
+    for to, batch, merge_notes in _plan_batches(collection, entries, quota.merging_notes()):
+        ids = [entry["_id"] for entry in batch]
+        try:
+            _send_batch(line_bot_api, to, batch, merge_notes)
+            if merge_notes and any(entry["kind"] == 'note' for entry in batch):
+                quota.digest_sent()
+            delivered = True
+        except linebot_exceptions.LineBotApiError as e:
+            # 409 表示相同的重試令牌已被接受，訊息已送達
+            delivered = e.status_code == 409
+            error = f"{e.status_code} {e.error.message if e.error else e}"
+            permanent = 400 <= e.status_code < 500 and e.status_code not in (409, 429)
+        except Exception as e:
+            delivered = False
+            error = str(e)
+            permanent = False
+
+        if delivered:
+            collection.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"status": "sent", "sent_at": datetime.now()}, "$unset": {"claim": "", "lease_until": ""}}
+            )
+            metrics.incr("outbox.sent", len(batch))
+            continue
+
+        logger.error(f"發件匣推送失敗: {to}, {len(batch)} 筆, 錯誤: {error}")
+        attempts = max(entry["attempts"] for entry in batch)
+        if permanent or attempts >= MAX_ATTEMPTS:
+            collection.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"status": "failed", "last_error": error}, "$unset": {"claim": "", "lease_until": ""}}
+            )
+            metrics.incr("outbox.failed", len(batch))
+        else:
+            # 指數退避後重試
+            delay = min(5 * 2 ** attempts, 600)
+            collection.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"status": "pending", "last_error": error, "next_attempt_at": datetime.now() + timedelta(seconds=delay)},
+                 "$unset": {"claim": "", "lease_until": ""}}
+            )
+            metrics.incr("outbox.retried", len(batch))
+    return len(entries)
+
+
+def pending_count(db):
+    """尚未送達的訊息數"""
+    return db.db[db.outbox_collection].count_documents({"status": {"$in": ["pending", "sending"]}})
+
+
+def _run(db, line_bot_api):
+    while True:
+        try:
+            # 一直處理到沒有到期的訊息為止（啟動時即會補送上次中止前未送達的訊息）
+            while drain_once(db, line_bot_api):
+                pass
+        except Exception as e:
+            logger.error(f"發件匣投遞時發生錯誤: {e}")
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start_worker(db, line_bot_api):
+    """啟動發件匣投遞執行緒"""
+    global _worker
+    if _worker is not None:
+        return _worker
+    metrics.register_gauge("outbox.pending", lambda: pending_count(db))
+    _worker = threading.Thread(target=_run, args=(db, line_bot_api), name="outbox-worker")
+    _worker.daemon = True
+    _worker.start()
+    logger.info("發件匣投遞執行緒已啟動")
+    return _worker
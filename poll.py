@@ -1,12 +1,28 @@
 import os
-from linebot.models import (
-    TextSendMessage, FlexSendMessage,
-)
 import json
+from collections import namedtuple
 from datetime import datetime
 import logging
-from linebot import LineBotApi
-from db import Database
+from typing import TYPE_CHECKING
+import startup
+from db import Database, VOTE_CLOSED
+from idgen import new_id
+import analytics
+import results_renderer
+import poll_schema
+import outbox
+import delivery
+import poll_cache
+import tracing
+import metrics
+import profiler
+from vote_debounce import VoteDebouncer
+
+if TYPE_CHECKING:
+    from linebot import LineBotApi
+
+# LINE SDK 的訊息模型，延遲載入模式下第一次使用時才匯入
+models = startup.lazy_module('linebot.models')
 
 # 設定日誌
 logging.basicConfig(
@@ -19,23 +35,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 單一投票事件（從 webhook 事件中取出的投票所需欄位）
+# private: 事件來自與機器人的一對一聊天；只有這時確認訊息才以回覆發送，否則回覆會出現在群組中
+VoteEvent = namedtuple('VoteEvent', ['poll_id', 'vote', 'user_id', 'reply_token', 'private'], defaults=(False,))
+
 # 投票選項和對應的表情符號
-mapping = {"attend": "✅出席", "absent": "❌請假"}
+mapping = poll_schema.OPTION_LABELS
+# 確認訊息中的狀態（含有名額投票的候補）
+status_labels = {**mapping, "waitlist": "⏳候補"}
+status_colors = {"attend": "#28a745", "absent": "#dc3545", "waitlist": "#f0ad4e"}
+
+# 投票點擊合併視窗（秒），預設0為關閉（開啟後每次點擊延後這段時間才寫入和確認）
+VOTE_DEBOUNCE_SECONDS = float(os.getenv('VOTE_DEBOUNCE_SECONDS', '0'))
 
 # 創建投票功能
-def create_poll(db:Database, title, group_id, line_bot_api:LineBotApi):
+@tracing.traced("poll.create_poll")
+def create_poll(db:Database, title, group_id, line_bot_api:'LineBotApi', capacity=None, reply_token=None):
     """創建新投票\n
     參數:
         db: Database對象
         title: 投票標題
         group_id: 群組ID
         line_bot_api: LineBotApi對象
-        active_polls: 活動投票數據
+        capacity: 可選，出席名額；額滿後選擇出席的用戶排入候補
+        reply_token: 可選，/poll 指令的回覆令牌，投票訊息優先以回覆發送到群組
     """
     
     try:
-        # 生成投票ID（使用時間戳）
-        poll_id = f"{int(datetime.now().timestamp())}"
+        # 生成投票ID（可依時間排序的唯一ID，同一秒內多次創建也不會碰撞）
+        poll_id = new_id()
         
          # 初始化投票數據
         poll_data = {
@@ -45,16 +73,14 @@ def create_poll(db:Database, title, group_id, line_bot_api:LineBotApi):
             'created_at': datetime.now(),
             'updated_at': datetime.now(),
             'status': 'active',
-            'options': {
-                'attend': [],
-                'absent': [],
-            },
-            'voters': {}
+            'version': 0,
+            # 投票記錄（v2 結構：每位投票者一個選項代碼，票數另存）
+            **poll_schema.new_poll_fields()
         }
+        if capacity:
+            poll_data['capacity'] = capacity
+            poll_data['waitlist'] = []
         
-        # 保存到MongoDB
-        db.save_poll(poll_data)
-
         # 創建Flex Message
         bubble = {
             "type": "bubble",
@@ -139,104 +165,384 @@ def create_poll(db:Database, title, group_id, line_bot_api:LineBotApi):
             }
         }
         
-        flex_message = FlexSendMessage(
+        if capacity:
+            bubble["body"]["contents"].insert(1, {
+                "type": "text",
+                "text": f"名額 {capacity} 人，額滿後依序候補",
+                "size": "sm",
+                "color": "#f0ad4e",
+                "margin": "md",
+                "wrap": True
+            })
+
+        flex_message = models.FlexSendMessage(
             alt_text=f"投票: {title}",
             contents=bubble
         )
 
-        # 發送投票訊息
-        line_bot_api.push_message(
-            os.getenv('DEV_USER_ID'),
-            [
-                TextSendMessage(text=f"📊 Created a new poll: {title}\n\nPoll ID: {poll_id}\n\nUse /endpoll to see results when ready.")
-            ]
-        )
+        dev_message = models.TextSendMessage(text=f"📊 Created a new poll: {title}\n\nPoll ID: {poll_id}\n\nUse /endpoll to see results when ready.")
 
-        line_bot_api.push_message(
-            group_id,
-            flex_message
-        )
+        # 投票訊息和投票數據一起寫入（副本集上為同一交易），由發件匣負責投遞
+        def save(session):
+            # 先保存投票：單機伺服器上沒有交易，保存失敗時不能留下指向不存在投票的訊息
+            if not db.save_poll(poll_data, session=session):
+                raise RuntimeError(f"保存投票失敗: {poll_id}")
+            outbox.enqueue(db, f"poll:{poll_id}:dev", os.getenv('DEV_USER_ID'), [dev_message], 'note', session=session)
+            outbox.enqueue(db, f"poll:{poll_id}:group", group_id, [flex_message], 'poll', session=session,
+                           reply_token=reply_token)
+
+        db.run_transaction(save)
+        outbox.notify()
+        # 投票路徑第一次點擊即可命中快取
+        poll_cache.put(poll_data)
         
         logger.info(f"創建了新投票: {poll_id}, 標題: {title}")
         return True, poll_id
     
     except Exception as e:
         logger.error(f"創建投票時發生錯誤: {e}")
-        line_bot_api.push_message(
+        delivery.send(
+            line_bot_api,
             os.getenv('DEV_USER_ID'),
-            TextSendMessage(text=f"創建投票時發生錯誤: {str(e)}")
+            models.TextSendMessage(text=f"創建投票時發生錯誤: {str(e)}"),
+            kind='note'
         )
-        return False
+        return False, None
 
 # 觸發投票功能
+@tracing.traced("poll.handle_postback")
 def handle_postback(event, line_bot_api, db):
     """處理按鈕點擊事件\n
     參數:
         event: Line事件對象
-        active_polls: 活動投票數據
         line_bot_api: LineBotApi對象
+        db: Database對象
     """
-    postback_data = event.postback.data
     user_id = event.source.user_id
 
     # 處理投票
-    if postback_data.startswith('vote_'):
-        parts = postback_data.split('_')
-        if len(parts) >= 3:
-            poll_id = parts[1]
-            vote = parts[2]
-            
-            # 獲取投票數據
-            poll = db.get_poll(poll_id)
-            if not poll:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="找不到該投票")
-                )
-                return
-            
-            elif poll.get('status') != 'active':
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="投票已關閉")
-                )
-                return
-            group_id = poll.get('group_id')
-
-            # 保存成員信息
+    parsed = parse_vote_data(event.postback.data)
+    if parsed:
+        poll_id, vote = parsed
+        submit_vote(VoteEvent(poll_id, vote, user_id, event.reply_token, event.source.type == 'user'), line_bot_api, db)
+
+def submit_vote(vote_event, line_bot_api, db):
+    """處理單一投票事件，啟用合併視窗時交給合併器\n
+    參數:
+        vote_event: VoteEvent
+        line_bot_api: LineBotApi對象
+        db: Database對象
+    """
+    delivery.received(vote_event.reply_token)
+    if vote_debouncer.enabled:
+        # 短時間內的連續點擊合併為一次寫入和一則確認訊息
+        vote_debouncer.submit(vote_event.poll_id, vote_event.user_id, vote_event.vote, vote_event.reply_token, line_bot_api, db,
+                              private=vote_event.private)
+    else:
+        handle_vote(vote_event.poll_id, vote_event.vote, vote_event.user_id, vote_event.reply_token, line_bot_api, db,
+                    private=vote_event.private)
+
+def parse_vote_data(postback_data):
+    """解析投票按鈕的 postback 資料 vote_{poll_id}_{option}
+    返回:
+        (poll_id, vote) 元組，不是投票資料則返回None
+    """
+    if not postback_data or not postback_data.startswith('vote_'):
+        return None
+    parts = postback_data.split('_')
+    if len(parts) < 3:
+        return None
+    return parts[1], parts[2]
+
+def reply_poll_closed(poll_id, reply_token, line_bot_api):
+    """寫入時發現投票已結束：移除快取中過期的狀態並回覆用戶"""
+    poll_cache.invalidate(poll_id)
+    try:
+        line_bot_api.reply_message(reply_token, models.TextSendMessage(text="投票已關閉"))
+    except Exception as e:
+        logger.error(f"回覆投票已關閉時發生錯誤: {e}")
+
+@profiler.profiled("poll.handle_vote")
+@tracing.traced("poll.handle_vote")
+def handle_vote(poll_id, vote, user_id, reply_token, line_bot_api, db, private=False):
+    """處理單一用戶的投票\n
+    參數:
+        poll_id: 投票ID
+        vote: 選項，'attend' 或 'absent'
+        user_id: 用戶ID
+        reply_token: 回覆令牌
+        line_bot_api: LineBotApi對象
+        db: Database對象
+        private: 事件是否來自一對一聊天（否則確認訊息推送給用戶，不回覆到群組）
+    """
+    # 只需要狀態、群組、標題和名額，從快取取得（不存在的投票也會被快取）
+    poll = poll_cache.get(db, poll_id)
+    if not poll:
+        line_bot_api.reply_message(
+            reply_token,
+            models.TextSendMessage(text="找不到該投票")
+        )
+        return
+    
+    elif poll.get('status') != 'active':
+        line_bot_api.reply_message(
+            reply_token,
+            models.TextSendMessage(text="投票已關閉")
+        )
+        return
+    group_id = poll.get('group_id')
+
+    # 保存成員信息
+    try:
+        user_profile = line_bot_api.get_profile(user_id)
+        user_name = user_profile.display_name
+    except Exception:
+        user_name = f"User_{user_id[-4:]}"
+    db.save_member(group_id, user_id, user_name)
+    
+    logger.info(f"用戶 {user_name} 投票: {poll_id}, 選項: {vote}")
+
+    if vote in mapping and poll_schema.has_capacity(poll):
+        if record_capacity_vote(poll, user_id, vote, line_bot_api, db, reply_token=reply_token, private=private):
+            return
+        line_bot_api.reply_message(
+            reply_token,
+            models.TextSendMessage(text="投票處理時發生錯誤，請重試")
+        )
+        return
+
+    option = None
+    if vote == 'attend':
+        option = 'attend'
+    elif vote == 'absent':
+        option = 'absent'
+
+    if option:
+        # 添加投票選擇
+        success, prev_option = db.add_vote(poll_id, user_id, option, poll=poll)
+        
+        if success:
+            # 投票改變了結果，移除該投票的渲染快取
+            results_renderer.invalidate(poll_id)
+            # 回覆用戶
+            send_beautiful_vote_confirmation(user_id=user_id, poll_title=poll.get('title'), pre_option=prev_option, option=option,
+                                             line_bot_api=line_bot_api, reply_token=reply_token if private else None)
+            logger.info(f"用戶 {user_name} 投票: {poll_id}, 選項: {option}")
+            return
+        if prev_option == VOTE_CLOSED:
+            # 快取中的狀態已過期（其他副本已結束投票）
+            reply_poll_closed(poll_id, reply_token, line_bot_api)
+            return
+    
+    # 如果投票ID不存在
+    line_bot_api.reply_message(
+        reply_token,
+        models.TextSendMessage(text="投票處理時發生錯誤，請重試")
+    )
+
+@profiler.profiled("poll.handle_vote_batch")
+@tracing.traced("poll.handle_vote_batch")
+def handle_vote_batch(vote_events, line_bot_api, db):
+    """批次處理同一次 webhook 傳來的多個投票事件\n
+    同一用戶對同一投票的多個事件只保留最後一個；所有投票一次查詢、
+    成員信息和投票選擇各以一次 bulk_write 寫入，之後再逐一發送確認訊息。
+    資料庫往返次數不隨事件數增加。
+    參數:
+        vote_events: VoteEvent 列表（依事件順序）
+        line_bot_api: LineBotApi對象
+        db: Database對象
+    """
+    latest = {}
+    for vote_event in vote_events:
+        delivery.received(vote_event.reply_token)
+        latest[(vote_event.poll_id, vote_event.user_id)] = vote_event
+
+    polls = db.get_polls({poll_id for poll_id, _ in latest})
+
+    accepted = []
+    for vote_event in latest.values():
+        poll = polls.get(vote_event.poll_id)
+        if not poll:
+            reply = "找不到該投票"
+        elif poll.get('status') != 'active':
+            reply = "投票已關閉"
+        elif vote_event.vote not in mapping:
+            reply = "投票處理時發生錯誤，請重試"
+        else:
+            accepted.append(vote_event)
+            continue
+        try:
+            line_bot_api.reply_message(vote_event.reply_token, models.TextSendMessage(text=reply))
+        except Exception as e:
+            logger.error(f"回覆投票錯誤訊息時發生錯誤: {e}")
+
+    if not accepted:
+        return
+
+    # 每位用戶只查詢一次名稱
+    user_names = {}
+    for user_id in {vote_event.user_id for vote_event in accepted}:
+        try:
+            user_names[user_id] = line_bot_api.get_profile(user_id).display_name
+        except Exception:
+            user_names[user_id] = f"User_{user_id[-4:]}"
+
+    db.save_members({
+        (polls[vote_event.poll_id].get('group_id'), vote_event.user_id, user_names[vote_event.user_id])
+        for vote_event in accepted
+    })
+
+    # 有名額的投票需逐票判斷名額和候補，逐一以管線更新寫入
+    capacity_votes = [v for v in accepted if poll_schema.has_capacity(polls[v.poll_id])]
+    for vote_event in capacity_votes:
+        if not record_capacity_vote(polls[vote_event.poll_id], vote_event.user_id, vote_event.vote, line_bot_api, db,
+                                    reply_token=vote_event.reply_token, private=vote_event.private):
             try:
-                user_profile = line_bot_api.get_profile(user_id)
-                user_name = user_profile.display_name
-                db.save_member(group_id, user_id, user_name)
-            except Exception:
-                user_name = f"User_{user_id[-4:]}"
-                db.save_member(group_id, user_id)
-            
-            logger.info(f"用戶 {user_name} 投票: {poll_id}, 選項: {vote}")
-
-            option = None
-            if vote == 'attend':
-                option = 'attend'
-            elif vote == 'absent':
-                option = 'absent'
-
-            if option:
-                # 添加投票選擇
-                success, prev_option = db.add_vote(poll_id, user_id, option)
-                
-                if success:
-                    # 回覆用戶
-                    send_beautiful_vote_confirmation(user_id=user_id, poll_title=poll.get('title'), pre_option=prev_option, option=option, line_bot_api=line_bot_api)
-                    logger.info(f"用戶 {user_name} 投票: {poll_id}, 選項: {option}")
-                    return
-            
-            # 如果投票ID不存在
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="投票處理時發生錯誤，請重試")
-            )
+                line_bot_api.reply_message(vote_event.reply_token, models.TextSendMessage(text="投票處理時發生錯誤，請重試"))
+            except Exception as e:
+                logger.error(f"回覆投票錯誤訊息時發生錯誤: {e}")
+    accepted = [v for v in accepted if not poll_schema.has_capacity(polls[v.poll_id])]
+    if not accepted:
+        return
+
+    # 寫入前取得用戶先前的選擇，用於確認訊息
+    previous_votes = db.get_previous_votes(polls, [(v.poll_id, v.user_id) for v in accepted])
+
+    success, closed = db.apply_votes([(v.poll_id, v.user_id, v.vote) for v in accepted], polls)
+    if not success:
+        for vote_event in accepted:
+            try:
+                line_bot_api.reply_message(vote_event.reply_token, models.TextSendMessage(text="投票處理時發生錯誤，請重試"))
+            except Exception as e:
+                logger.error(f"回覆投票錯誤訊息時發生錯誤: {e}")
+        return
+
+    # 讀取後、寫入前結束的投票不會被寫入
+    for vote_event in accepted:
+        if vote_event.poll_id in closed:
+            reply_poll_closed(vote_event.poll_id, vote_event.reply_token, line_bot_api)
+    accepted = [v for v in accepted if v.poll_id not in closed]
+
+    for poll_id in {vote_event.poll_id for vote_event in accepted}:
+        results_renderer.invalidate(poll_id)
+
+    for vote_event in accepted:
+        poll = polls[vote_event.poll_id]
+        prev_option = previous_votes.get((vote_event.poll_id, vote_event.user_id))
+        send_beautiful_vote_confirmation(user_id=vote_event.user_id, poll_title=poll.get('title'), pre_option=prev_option, option=vote_event.vote,
+                                         line_bot_api=line_bot_api,
+                                         reply_token=vote_event.reply_token if vote_event.private else None)
+        logger.info(f"用戶 {user_names[vote_event.user_id]} 投票: {vote_event.poll_id}, 選項: {vote_event.vote}")
+
+def record_capacity_vote(poll, user_id, option, line_bot_api, db, reply_token=None, private=False):
+    """有名額的投票記錄一票並發送確認訊息；出席者改為請假時通知遞補的候補者\n
+    參數:
+        poll: 投票數據
+        user_id: 用戶ID
+        option: 'attend' 或 'absent'
+        line_bot_api: LineBotApi對象
+        db: Database對象
+        reply_token: 可選，投票事件的回覆令牌
+        private: 事件是否來自一對一聊天；是時確認訊息優先以回覆發送，否則推送給用戶
+    返回:
+        操作結果（投票已結束時回覆用戶後也返回True）
+    """
+    poll_id = poll['poll_id']
+    success, result = db.add_capacity_vote(poll_id, user_id, option)
+    if not success:
+        if result == VOTE_CLOSED:
+            reply_poll_closed(poll_id, reply_token, line_bot_api)
+            return True
+        return False
+
+    results_renderer.invalidate(poll_id)
+    note = f"名額已滿，您目前是候補第 {result.position} 位" if result.status == 'waitlist' else None
+    send_beautiful_vote_confirmation(user_id=user_id, poll_title=poll.get('title'), pre_option=result.previous,
+                                     option=result.status, line_bot_api=line_bot_api, note=note,
+                                     reply_token=reply_token if private else None)
+
+    if result.promoted:
+        # 遞補通知需可靠送達，經由發件匣投遞；以更新前的版本號作為冪等鍵
+        outbox.enqueue(db, f"promote:{poll_id}:{result.promoted}:{result.version}", result.promoted,
+                       [models.TextSendMessage(text=f"🎉 {poll.get('title')}\n有人取消出席，您已從候補遞補為出席")],
+                       'promotion')
+        outbox.notify()
+        logger.info(f"候補遞補為出席: {poll_id}, 用戶: {result.promoted}")
+    return True
+
+# 投票點擊合併器，視窗結束時以最後一次點擊的選項呼叫 handle_vote
+vote_debouncer = VoteDebouncer(VOTE_DEBOUNCE_SECONDS, handle_vote)
+metrics.register_gauge("vote_debounce.pending", vote_debouncer.pending_count)
+
+@tracing.traced("poll.resolve_display_names")
+def resolve_display_names(user_ids, line_bot_api):
+    """查詢用戶顯示名稱，查詢失敗時使用ID末四碼
+    參數:
+        user_ids: 用戶ID列表
+        line_bot_api: LineBotApi對象
+    返回:
+        '@名稱' 列表
+    """
+    names = []
+    for user_id in user_ids:
+        try:
+            user_profile = line_bot_api.get_profile(user_id)
+            names.append(f'@{user_profile.display_name}')
+        except Exception:
+            names.append(f"@User_{user_id[-4:]}")
+    return names
+
+@tracing.traced("poll.render_poll_results")
+def render_poll_results(poll, line_bot_api):
+    """取得投票結果的 Flex 訊息，以 (poll_id, version) 查詢快取
+    版本號在每次投票時遞增，內容未變時直接返回已序列化的訊息
+    參數:
+        poll: 投票數據
+        line_bot_api: LineBotApi對象
+    返回:
+        (訊息批次列表, {option: [顯示名稱]})
+    """
+    poll_id = poll['poll_id']
+    version = poll.get('version', 0)
+    cached = results_renderer.get_cached(poll_id, version)
+    if cached:
+        return cached['payload'], cached['names']
+
+    names_by_option = {
+        option: resolve_display_names(poll_schema.option_voters(poll, option), line_bot_api)
+        for option in poll_schema.OPTIONS
+    }
+    if poll_schema.waitlist(poll):
+        names_by_option['waitlist'] = resolve_display_names(poll_schema.waitlist(poll), line_bot_api)
+    contents_list = results_renderer.render_results(poll, names_by_option)
+    payload = results_renderer.serialize_messages(poll, contents_list)
+    results_renderer.put_cached(poll_id, version, payload, names_by_option, poll.get('group_id'))
+    return payload, names_by_option
+
+@tracing.traced("poll.show_poll_status")
+def show_poll_status(event, poll_id, line_bot_api, db):
+    """回覆投票目前的結果（不結束投票）\n
+    參數:
+        event: Line事件對象
+        poll_id: 投票ID
+        line_bot_api: LineBotApi對象
+        db: Database對象
+    """
+    poll = db.load_votes(db.get_poll(poll_id))
+    if not poll:
+        line_bot_api.reply_message(
+            event.reply_token,
+            models.TextSendMessage(text=f"找不到指定的投票ID: {poll_id}")
+        )
+        return False
+
+    result_batches, _ = render_poll_results(poll, line_bot_api)
+    # 一次回覆最多 5 則訊息，只回覆第一批
+    line_bot_api.reply_message(event.reply_token, results_renderer.to_send_messages(result_batches[0]))
+    return True
 
 # 結束投票功能
+@tracing.traced("poll.end_poll")
 def end_poll(event, poll_id, line_bot_api, db):
     """
     結束投票並顯示美觀的結果\n
@@ -244,347 +550,93 @@ def end_poll(event, poll_id, line_bot_api, db):
         event: Line事件對象
         poll_id: 投票ID
     """
-    poll = db.get_poll(poll_id)
+    poll = db.load_votes(db.get_poll(poll_id))
     if not poll:
         if event:
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text=f"找不到指定的投票ID: {poll_id}")
+                models.TextSendMessage(text=f"找不到指定的投票ID: {poll_id}")
             )
         return False
     
     try:
-        logger.info(f"{poll}")
-        # 計算總票數和百分比
-        options = poll.get('options', {})
-        attend_count = len(options.get('attend', []))
-        absent_count = len(options.get('absent', []))
-        total_votes = len(poll.get('voters', {}))
-        logger.info(f"結束投票: {poll_id}, 出席: {attend_count}, 缺席: {absent_count}, 總票數: {total_votes}")
-        
-        # 創建Flex Message顯示結果
-        contents = []
-        
-        # 標題部分
-        contents.append({
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "📊 投票結果",
-                    "weight": "bold",
-                    "size": "xl",
-                    "color": "#ffffff"
-                }
-            ],
-            "backgroundColor": "#4A90E2",
-            "paddingAll": "15px"
-        })
-        
-        # 投票標題
-        contents.append({
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": poll['title'],
-                    "weight": "bold",
-                    "size": "lg",
-                    "wrap": True
-                },
-                {
-                    "type": "text",
-                    "text": f"Total votes: {total_votes}",
-                    "size": "sm",
-                    "color": "#888888",
-                    "margin": "md"
-                },
-                {
-                    "type": "separator",
-                    "margin": "lg"
-                }
-            ],
-            "paddingAll": "15px"
-        })
+        # 先以目前的票渲染（逐一查詢名稱），關閉後票沒有變化時交易中直接使用已渲染的訊息
+        render_poll_results(poll, line_bot_api)
 
-        # 每個選項的結果
-        options_contents = []
-        
-        # 準時出席
-        attend_percent = 0 if total_votes == 0 else (attend_count / total_votes) * 100
-        options_contents.append({
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "✅出席",
-                            "size": "md",
-                            "flex": 5
-                        },
-                        {
-                            "type": "text",
-                            "text": f"{attend_count} ({attend_percent:.1f}%)",
-                            "size": "md",
-                            "align": "end",
-                            "flex": 2
-                        }
-                    ]
-                },
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [],
-                            "backgroundColor": "#28a745",
-                            "height": "6px",
-                            "width": f"{attend_percent}%"
-                        }
-                    ],
-                    "backgroundColor": "#EEEEEE",
-                    "height": "6px",
-                    "margin": "sm"
-                }
-            ],
-            "margin": "lg"
-        })
+        # 在投票的群組中下 /endpoll 時，回覆令牌用於第一批結果（一次回覆最多 5 則），其餘推送
+        group_id = poll['group_id']
+        reply_token = event.reply_token if event and getattr(event.source, 'group_id', None) == group_id else None
 
-        # 無法出席
-        absent_percent = 0 if total_votes == 0 else (absent_count / total_votes) * 100
-        options_contents.append({
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "❌請假",
-                            "size": "md",
-                            "flex": 5
-                        },
-                        {
-                            "type": "text",
-                            "text": f"{absent_count} ({absent_percent:.1f}%)",
-                            "size": "md",
-                            "align": "end",
-                            "flex": 2
-                        }
-                    ]
-                },
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [],
-                            "backgroundColor": "#dc3545",
-                            "height": "6px",
-                            "width": f"{absent_percent}%"
-                        }
-                    ],
-                    "backgroundColor": "#EEEEEE",
-                    "height": "6px",
-                    "margin": "sm"
-                }
-            ],
-            "margin": "lg"
-        })
-        
-        # 添加選項結果
-        contents.append({
-            "type": "box",
-            "layout": "vertical",
-            "contents": options_contents,
-            "paddingAll": "15px"
-        })
-        # 參與者列表
-        participants_contents = []
-        
-        # 添加出席者列表
-        if attend_count > 0:
-            # 獲取參與者名稱
-            attend_users = []
-            for user_id in options.get('attend', []):
-                try:
-                    user_profile = line_bot_api.get_profile(user_id)
-                    user_name = user_profile.display_name
-                    attend_users.append(f'@{user_name}')
-                except Exception:
-                    user_name = f"User_{user_id[-4:]}"
-            logger.info(f"出席者: {attend_users}")
-            participants_contents.append({
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "text",
-                        "text": "✅出席",
-                        "weight": "bold",
-                        "size": "md",
-                        "color": "#28a745"
-                    },
-                    {
-                        "type": "text",
-                        "text": "\n".join(attend_users),
-                        "size": "md",
-                        "wrap": True,
-                        "margin": "sm",
-                        "color": "#888888"
-                    }
-                ],
-                "margin": "md"
-            })
-        
-        # 添加缺席者列表
-        if absent_count > 0:
-            absent_users = []
-            
-            for user_id in options.get('absent', []):
-                try:
-                    user_profile = line_bot_api.get_profile(user_id)
-                    user_name = user_profile.display_name
-                    absent_users.append(f'@{user_name}')
-                except Exception:
-                    user_name = f"User_{user_id[-4:]}"
-            logger.info(f"缺席者: {absent_users}")
-            participants_contents.append({
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "text",
-                        "text": "❌請假",
-                        "weight": "bold",
-                        "size": "md",
-                        "color": "#dc3545"
-                    },
-                    {
-                        "type": "text",
-                        "text": "\n".join(absent_users),
-                        "size": "md",
-                        "wrap": True,
-                        "margin": "sm",
-                        "color": "#888888"
-                    }
-                ],
-                "margin": "md"
-            })
-        
-        # 添加參與者列表到內容中
-        if participants_contents:
-            contents.append({
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "separator",
-                        "margin": "md"
-                    },
-                    {
-                        "type": "text",
-                        "text": "Participants:",
-                        "weight": "bold",
-                        "margin": "lg"
-                    },
-                    {
-                        "type": "box",
-                        "layout": "horizontal",
-                        "contents": participants_contents,
-                        "margin": "md"
-                    }
-                ],
-                "paddingAll": "15px"
-            })
-        
-        # 計算出席率
-        total_attendance = attend_count
-        attendance_rate = 0 if total_votes == 0 else (total_attendance / total_votes) * 100
-        
-        # 添加出席率
-        contents.append({
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "separator",
-                    "margin": "sm"
-                },
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "出席率:",
-                            "size": "md",
-                            "weight": "bold",
-                            "flex": 4
-                        },
-                        {
-                            "type": "text",
-                            "text": f"{attendance_rate:.1f}%",
-                            "size": "md",
-                            "weight": "bold",
-                            "color": "#4A90E2",
-                            "align": "end",
-                            "flex": 2
-                        }
-                    ],
-                    "margin": "lg"
-                }
-            ],
-            "paddingAll": "15px"
-        })
-        
-        # 建立Flex訊息
-        flex_message = FlexSendMessage(
-            alt_text=f"Poll Results: {poll['title']}",
-            contents={
-                "type": "bubble",
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": contents
-                }
-            }
-        )
+        def close(session):
+            # 先關閉再讀取票：關閉之後投票不會再被寫入，關閉前被接受的票都會出現在結果中
+            # （交易中失敗時拋出例外，發件匣的訊息一起中止）
+            if not db.update_poll_status(poll_id, 'closed', session=session):
+                raise RuntimeError(f"關閉投票失敗: {poll_id}")
+            return publish_results(db, poll_id, line_bot_api, reply_token=reply_token, session=session)
 
-        # 發送結果
-        group_id = poll['group_id']
-        line_bot_api.push_message(group_id, flex_message)
-        
-        # 更新投票狀態為已關閉
-        db.update_poll_status(poll_id, 'closed')
+        db.run_transaction(close)
+        # 交易提交後才移除快取，提交前的讀取不會把舊狀態放回快取
+        poll_cache.invalidate(poll_id)
+        outbox.notify()
         
         logger.info(f"結束投票: {poll_id}")
-
-        # 將結果發送給開發者
-        poll_result_to_note(line_bot_api, attend_users)
         return True
     except Exception as e:
         logger.error(f"結束投票時發生錯誤: {e}")
         if event:
-            line_bot_api.push_message(
+            delivery.send(
+                line_bot_api,
                 os.getenv('DEV_USER_ID'),
-                TextSendMessage(text=f"結束投票時發生錯誤: {str(e)}")
-            )     
+                models.TextSendMessage(text=f"結束投票時發生錯誤: {str(e)}"),
+                kind='note'
+            )
         return False  
 
-def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, line_bot_api):
+def publish_results(db, poll_id, line_bot_api, reply_token=None, session=None):
+    """讀取已關閉投票的票，將結果訊息和給開發者的結果寫入發件匣，並增量更新出席統計\n
+    最後清除投票的 results_pending。單機伺服器上沒有交易，關閉後中途失敗時由排程任務
+    （publish_pending_results）重新執行；冪等鍵以關閉時的 updated_at 組成，已寫入的訊息不會重複。
+    參數:
+        db: Database對象
+        poll_id: 投票ID
+        line_bot_api: LineBotApi對象
+        reply_token: 可選，第一批結果的回覆令牌
+        session: 可選，交易的session
+    返回:
+        已結束的投票數據（含所有投票記錄）
+    """
+    poll = db.load_votes(db.get_poll(poll_id, session=session), session=session)
+    if not poll:
+        raise RuntimeError(f"找不到投票: {poll_id}")
+
+    counts = poll_schema.counts(poll)
+    logger.info(f"結束投票: {poll_id}, 出席: {counts['attend']}, 缺席: {counts['absent']}, "
+                f"總票數: {poll_schema.total_votes(poll)}")
+
+    # 投票內容沒有變化時沿用已渲染的訊息，不再逐一查詢名稱
+    result_batches, names_by_option = render_poll_results(poll, line_bot_api)
+    attend_users = names_by_option.get('attend', [])
+    logger.info(f"出席者: {attend_users}")
+
+    # 結果訊息（內容過大時為多則 carousel）以關閉時間作為冪等鍵的一部分：
+    # 重新發送時不會重複，已結束的投票再次結束時會重新發送
+    group_id = poll['group_id']
+    updated_at = poll.get('updated_at')
+    result_key = f"result:{poll_id}:{updated_at.timestamp() if updated_at else 0}"
+    for index, batch in enumerate(result_batches):
+        outbox.enqueue(db, f"{result_key}:{index}", group_id,
+                       results_renderer.to_send_messages(batch), 'result', session=session,
+                       reply_token=reply_token if index == 0 else None)
+    # 將結果發送給開發者
+    outbox.enqueue(db, f"{result_key}:dev", os.getenv('DEV_USER_ID'),
+                   [models.TextSendMessage(text=poll_result_to_note(attend_users))], 'note', session=session)
+    # 出席統計與結果一起寫入；失敗時拋出，投票保持 results_pending 由排程任務重試
+    if not analytics.record_closed_poll(db, poll, session=session):
+        raise RuntimeError(f"更新出席統計失敗: {poll_id}")
+    db.mark_results_published(poll_id, session=session)
+    return poll
+
+def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, line_bot_api, note=None, reply_token=None):
     """
     發送增強版的投票確認訊息，處理三種情況：
     1. 重複投票 (prev_option == option)
@@ -594,13 +646,13 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
         user_id: 用戶ID
         poll_title: 投票標題
         pre_option: 之前的選項
-        option: 用戶選擇的選項
+        option: 用戶選擇的選項（有名額的投票可為 'waitlist'）
         line_bot_api: LINE Bot API對象
+        note: 可選，取代底部的說明文字
+        reply_token: 可選，投票事件的回覆令牌；有效時以回覆發送，否則推送給用戶
     """
-    # 根據選項設定顏色
-    color = "#28a745"  # 綠色 (出席)
-    if "absent" in option.lower():
-        color = "#dc3545"  # 紅色 (請假)
+    # 根據選項設定顏色：綠色 (出席)、紅色 (請假)、橘色 (候補)
+    color = status_colors.get(option, "#28a745")
     
     pre_text = None
     # 確定訊息類型和內容
@@ -621,9 +673,7 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
         status_text = "您的新選擇:"
 
         # 獲取之前選項的顏色
-        pre_color = "#28a745"  # 綠色 (出席)
-        if "absent" in pre_option.lower():
-            pre_color = "#dc3545"  # 紅色 (請假)
+        pre_color = status_colors.get(pre_option, "#28a745")
         
         pre_text = {
             "type": "box",
@@ -637,7 +687,7 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
                 },
                 {
                     "type": "text",
-                    "text": f"{mapping[pre_option]}",
+                    "text": f"{status_labels[pre_option]}",
                     "size": "sm",
                     "color": pre_color,
                     "align": "end"
@@ -646,6 +696,11 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
             "margin": "sm"
         }
 
+    if option == 'waitlist' and pre_option != option:
+        header_text = "已列入候補"
+    if note:
+        body_text = note
+
     # 創建Flex Message
     bubble = {
         "type": "bubble",
@@ -687,7 +742,7 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
                         },
                         {
                             "type": "text",
-                            "text": f"{mapping[option]}",
+                            "text": f"{status_labels[option]}",
                             "size": "sm",
                             "color": color,
                             "align": "end",
@@ -726,11 +781,11 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
     
     # 發送訊息
     try:
-        flex_message = FlexSendMessage(
+        flex_message = models.FlexSendMessage(
             alt_text="投票確認",
             contents=bubble
         )
-        line_bot_api.push_message(user_id, flex_message)
+        delivery.send(line_bot_api, user_id, flex_message, reply_token=reply_token, kind='confirmation')
         return True
     except Exception as e:
         logger.error(f"發送美化投票確認訊息時發生錯誤: {e}")
@@ -738,15 +793,15 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
         try:
             if pre_option is None:
                 # 新投票
-                message = f"您在: {poll_title}中\n選擇了: {mapping[option]}"
+                message = f"您在: {poll_title}中\n選擇了: {status_labels[option]}"
             elif pre_option == option:
                 # 重複投票
-                message = f"您在: {poll_title}中\n已經選擇過: {mapping[option]}"
+                message = f"您在: {poll_title}中\n已經選擇過: {status_labels[option]}"
             else:
                 # 更改投票
-                message = f"您在: {poll_title}中\n將選擇從 {mapping[pre_option]} 更改為 {mapping[option]}"
+                message = f"您在: {poll_title}中\n將選擇從 {status_labels[pre_option]} 更改為 {status_labels[option]}"
             
-            line_bot_api.push_message(user_id, TextSendMessage(text=message))
+            delivery.send(line_bot_api, user_id, models.TextSendMessage(text=message), reply_token=reply_token, kind='confirmation')
         except:
             pass
         return False
@@ -755,7 +810,7 @@ def send_beautiful_vote_confirmation(user_id, poll_title, pre_option, option, li
         logger.error(f"獲取群組成員時發生錯誤: {e}")
         return []
     
-def poll_result_to_note(api, attend_users):
+def poll_result_to_note(attend_users):
     """
     將投票結果轉換為文字格式
     """
@@ -766,10 +821,4 @@ def poll_result_to_note(api, attend_users):
     for i, user in enumerate(attend_users):
         note += f"{i+1}.{user} \n"
     
-    try:
-        api.push_message(os.getenv('DEV_USER_ID'), TextSendMessage(text=note))
-    except Exception as e:
-        logger.error(f"發送結果到開發者時發生錯誤: {e}")
-        return False
-    
-    
\ No newline at end of file
+    return note
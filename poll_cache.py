@@ -0,0 +1,118 @@
+"""
+投票基本資料快取
+
+投票路徑只需要投票的狀態、群組、標題和名額，不需要整份投票文件（含所有投票記錄）。
+此快取以 poll_id 保存這些很少變動的欄位：
+- 創建投票時直接寫入，第一次點擊不需查詢資料庫
+- 未命中時以投影只讀取基本欄位，並保存結果（讀穿）
+- 不存在的 poll_id 也保存為否定項目，重放或偽造的 postback 不必每次查詢資料庫
+- update_poll_status 和 delete_poll 時移除；其他副本的變更經由 change stream 移除
+  （只有基本欄位變動時才移除，投票不影響快取）
+單機伺服器沒有 change stream，項目在 POLL_CACHE_SECONDS 後過期。
+快取的狀態只用於提早拒絕投票：投票寫入只匹配進行中的投票（db.VOTE_CLOSED），
+其他副本已結束的投票即使快取中仍為 active 也不會被寫入。
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+import metrics
+import change_listener
+
+# 投票路徑使用的欄位
+META_FIELDS = ('poll_id', 'title', 'group_id', 'status', 'capacity')
+
+CACHE_SIZE = int(os.environ.get('POLL_CACHE_SIZE', '4096'))
+TTL_SECONDS = float(os.environ.get('POLL_CACHE_SECONDS', '30'))
+NEGATIVE_TTL_SECONDS = float(os.environ.get('POLL_CACHE_NEGATIVE_SECONDS', '60'))
+
+# poll_id -> (到期時間, 基本資料或 None)
+_cache = OrderedDict()
+_lock = threading.Lock()
+# 每次移除項目時遞增；讀取資料庫期間有移除發生時不保存讀到的（可能已過期的）結果
+_generation = 0
+
+
+def meta(poll):
+    """從投票數據取出基本資料"""
+    return {field: poll.get(field) for field in META_FIELDS}
+
+
+def _store(poll_id, value, ttl, generation=None):
+    with _lock:
+        if generation is not None and generation != _generation:
+            return
+        _cache[poll_id] = (time.monotonic() + ttl, value)
+        _cache.move_to_end(poll_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+            metrics.incr("poll_cache.evicted")
+
+
+def put(poll):
+    """保存投票的基本資料（創建投票後呼叫）"""
+    _store(poll['poll_id'], meta(poll), TTL_SECONDS)
+
+
+def get(db, poll_id):
+    """取得投票的基本資料，未命中時從資料庫讀取
+    參數:
+        db: Database對象
+        poll_id: 投票ID
+    返回:
+        基本資料字典，投票不存在則返回None
+    """
+    with _lock:
+        entry = _cache.get(poll_id)
+        if entry is not None and entry[0] > time.monotonic():
+            _cache.move_to_end(poll_id)
+            metrics.incr("poll_cache.hit" if entry[1] is not None else "poll_cache.negative_hit")
+            return entry[1]
+        generation = _generation
+
+    metrics.incr("poll_cache.miss")
+    success, poll = db.get_poll_meta(poll_id)
+    if not success:
+        # 查詢失敗（而非不存在）時不保存，下次重新查詢
+        return None
+    if poll is None:
+        _store(poll_id, None, NEGATIVE_TTL_SECONDS, generation)
+        return None
+    _store(poll_id, meta(poll), TTL_SECONDS, generation)
+    return meta(poll)
+
+
+def invalidate(poll_id):
+    global _generation
+    with _lock:
+        _cache.pop(poll_id, None)
+        _generation += 1
+
+
+def clear():
+    global _generation
+    with _lock:
+        _cache.clear()
+        _generation += 1
+
+
+def hit_rate():
+    """命中率（含否定項目的命中）"""
+    hits = metrics.get("poll_cache.hit") + metrics.get("poll_cache.negative_hit")
+    total = hits + metrics.get("poll_cache.miss")
+    return round(hits / total, 3) if total else 0.0
+
+
+def _on_change(event):
+    fields = event.get("fields")
+    # 投票只更新投票記錄和票數，不影響基本資料
+    if event["operation"] == "update" and fields is not None and not set(fields) & set(META_FIELDS):
+        return
+    if event["poll_id"]:
+        invalidate(event["poll_id"])
+    else:
+        clear()
+
+
+metrics.register_gauge("poll_cache.hit_rate", hit_rate)
+change_listener.subscribe('polls', _on_change, clear)
@@ -0,0 +1,385 @@
+"""
+投票文件結構
+
+v1（舊）：每一票存兩次
+    options: {option: [user_id, ...]}
+    voters:  {user_id: option}
+
+v2：每位投票者只記錄一次，選項以代碼（OPTIONS 中的索引）表示，票數存為欄位
+    schema: 2
+    v:      {user_id: 代碼}
+    counts: {option: 票數}
+
+讀取時兩種結構都能處理。每次投票的更新管線會先把 v1 文件就地轉換為 v2 再記錄投票，
+因此有人投票的舊投票會自動轉換；其餘文件用 `python poll_schema.py migrate` 分批轉換，
+已轉換的文件不再匹配，中斷後重新執行即可繼續。
+"""
+import argparse
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+# 選項代碼即為在此列表中的索引，只能在末尾新增
+OPTIONS = ['attend', 'absent']
+# 選項的顯示名稱（含表情符號）
+OPTION_LABELS = {"attend": "✅出席", "absent": "❌請假"}
+
+
+def new_poll_fields():
+    """新投票的投票記錄欄位"""
+    return {'schema': SCHEMA_VERSION, 'v': {}, 'counts': {option: 0 for option in OPTIONS}}
+
+
+def is_v2(poll):
+    return poll.get('schema') == SCHEMA_VERSION
+
+
+def voters(poll):
+    """{user_id: option}"""
+    if is_v2(poll):
+        return {user_id: OPTIONS[code] for user_id, code in poll.get('v', {}).items()}
+    return dict(poll.get('voters', {}))
+
+
+def option_voters(poll, option):
+    """選擇指定選項的用戶ID列表"""
+    if is_v2(poll):
+        code = OPTIONS.index(option)
+        return [user_id for user_id, value in poll.get('v', {}).items() if value == code]
+    return list(poll.get('options', {}).get(option, []))
+
+
+def counts(poll):
+    """{option: 票數}"""
+    if is_v2(poll):
+        stored = poll.get('counts', {})
+        return {option: stored.get(option, 0) for option in OPTIONS}
+    options = poll.get('options', {})
+    return {option: len(options.get(option, [])) for option in OPTIONS}
+
+
+def total_votes(poll):
+    if is_v2(poll):
+        return len(poll.get('v', {}))
+    return len(poll.get('voters', {}))
+
+
+def previous_option(before, user_id):
+    """從更新前的文件取得用戶先前的選擇"""
+    if before is None:
+        return None
+    if is_v2(before):
+        code = before.get('v', {}).get(user_id)
+        return OPTIONS[code] if code is not None else None
+    return before.get('voters', {}).get(user_id)
+
+
+def previous_option_projection(user_id):
+    """讀取用戶先前選擇所需的欄位"""
+    return {"_id": 0, "schema": 1, f"v.{user_id}": 1, f"voters.{user_id}": 1}
+
+
+# ===== 更新管線 =====
+
+def _codes_expression():
+    """聚合運算式：文件中的 {user_id: 選項代碼}，兩種結構皆可"""
+    return {"$cond": [
+        {"$eq": ["$schema", SCHEMA_VERSION]},
+        {"$ifNull": ["$v", {}]},
+        {"$arrayToObject": {"$map": {
+            "input": {"$objectToArray": {"$ifNull": ["$voters", {}]}},
+            "in": {"k": "$$this.k", "v": {"$indexOfArray": [OPTIONS, "$$this.v"]}}
+        }}}
+    ]}
+
+
+def upgrade_stages():
+    """將 v1 文件轉換為 v2 的更新管線（v2 文件不變）"""
+    is_v2_expr = {"$eq": ["$schema", SCHEMA_VERSION]}
+    return [
+        {"$set": {
+            "v": _codes_expression(),
+            "counts": {"$cond": [is_v2_expr, "$counts", {
+                option: {"$size": {"$ifNull": [f"$options.{option}", []]}} for option in OPTIONS
+            }]},
+            "schema": SCHEMA_VERSION,
+        }},
+        {"$unset": ["voters", "options"]},
+    ]
+
+
+def vote_pipeline(user_id, option, now):
+    """記錄一票的更新管線：先轉換為 v2，再依先前的選擇調整票數
+    同一階段中的運算式讀取的是階段開始前的文件，因此 $v.<user_id> 是先前的選擇
+    """
+    code = OPTIONS.index(option)
+    previous = f"$v.{user_id}"
+    vote = {
+        f"counts.{name}": {"$add": [
+            {"$ifNull": [f"$counts.{name}", 0]},
+            1 if index == code else 0,
+            {"$cond": [{"$eq": [previous, index]}, -1, 0]},
+        ]}
+        for index, name in enumerate(OPTIONS)
+    }
+    vote.update({
+        f"v.{user_id}": {"$literal": code},
+        "updated_at": now,
+        "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+    })
+    return upgrade_stages() + [{"$set": vote}]
+
+
+def voters_expression():
+    """聚合運算式：[{k: user_id, v: option}]，兩種結構皆可"""
+    return {"$cond": [
+        {"$eq": ["$schema", SCHEMA_VERSION]},
+        {"$map": {
+            "input": {"$objectToArray": {"$ifNull": ["$v", {}]}},
+            "in": {"k": "$$this.k", "v": {"$arrayElemAt": [OPTIONS, "$$this.v"]}}
+        }},
+        {"$objectToArray": {"$ifNull": ["$voters", {}]}}
+    ]}
+
+
+# ===== 名額和候補 =====
+# capacity: 出席名額（沒有此欄位表示不限）
+# waitlist: 候補名單 [user_id, ...]，依加入順序；候補中的用戶不在 v 中，也不計入票數
+# 名額已滿時選擇出席的用戶排入候補，出席者改為請假時候補第一位自動遞補。
+# 每一票是一次管線更新，名額判斷、候補和遞補都在同一份文件的同一次更新中完成，
+# 同時大量點擊也不會超額，不需要任何鎖。
+
+# 投票結果：previous/status 為 'attend'、'absent'、'waitlist' 或 None；
+# position 為候補順位（不在候補時為 None）；promoted 為因此遞補為出席的用戶；version 為更新前的版本號
+CapacityVote = namedtuple('CapacityVote', ['previous', 'status', 'position', 'promoted', 'version'])
+
+
+def has_capacity(poll):
+    return poll.get('capacity') is not None
+
+
+def waitlist(poll):
+    return list(poll.get('waitlist', []))
+
+
+def capacity_projection(user_id):
+    """計算名額投票結果所需的欄位"""
+    return {"_id": 0, "schema": 1, "version": 1, f"v.{user_id}": 1, f"voters.{user_id}": 1,
+            "waitlist": 1, "counts": 1, "options": 1, "capacity": 1}
+
+
+def capacity_outcome(before, user_id, option):
+    """依更新前的文件推算管線的處理結果（與 capacity_vote_pipeline 的判斷相同）
+    返回:
+        (動作, CapacityVote)，動作為 'same'、'attend'、'waitlist'、'leave_wait'、'cancel' 或 'absent'
+    """
+    previous = previous_option(before, user_id)
+    queue = before.get('waitlist', [])
+    waiting = user_id in queue
+    full = counts(before)['attend'] >= before['capacity']
+
+    if option == 'attend':
+        if previous == 'attend' or waiting:
+            action = 'same'
+        elif not full:
+            action = 'attend'
+        else:
+            action = 'waitlist'
+    else:
+        if waiting:
+            action = 'leave_wait'
+        elif previous == 'attend':
+            action = 'cancel'
+        else:
+            action = 'absent'
+
+    if waiting:
+        previous = 'waitlist'
+    position = None
+    if action == 'waitlist':
+        status, position = 'waitlist', len(queue) + 1
+    elif action == 'same' and waiting:
+        status, position = 'waitlist', queue.index(user_id) + 1
+    else:
+        status = option
+    promoted = queue[0] if action == 'cancel' and queue else None
+    return action, CapacityVote(previous, status, position, promoted, before.get('version', 0))
+
+
+def capacity_vote_pipeline(user_id, option, now):
+    """有名額的投票記錄一票的更新管線
+    1. 轉換為 v2，取得用戶先前的選擇和是否在候補中
+    2. 依選項、名額和先前的狀態決定動作（與 capacity_outcome 相同）
+    3. 依動作更新投票記錄、候補名單和票數；出席者改為請假時候補第一位遞補
+    """
+    attend, absent = OPTIONS.index('attend'), OPTIONS.index('absent')
+    code = OPTIONS.index(option)
+
+    def action_is(*names):
+        return {"$in": ["$_action", list(names)]}
+
+    def flag(condition):
+        return {"$cond": [condition, 1, 0]}
+
+    if option == 'attend':
+        action = {"$switch": {"branches": [
+            {"case": {"$or": [{"$eq": ["$_prev", attend]}, "$_waiting"]}, "then": "same"},
+            {"case": {"$lt": [{"$ifNull": ["$counts.attend", 0]}, "$capacity"]}, "then": "attend"},
+        ], "default": "waitlist"}}
+    else:
+        action = {"$switch": {"branches": [
+            {"case": "$_waiting", "then": "leave_wait"},
+            {"case": {"$eq": ["$_prev", attend]}, "then": "cancel"},
+        ], "default": "absent"}}
+
+    promote = {"$and": [action_is("cancel"), {"$gt": [{"$size": "$waitlist"}, 0]}]}
+    without_user = {"$arrayToObject": {"$filter": {
+        "input": {"$objectToArray": "$v"}, "cond": {"$ne": ["$$this.k", user_id]}
+    }}}
+    with_user = {"$mergeObjects": [
+        "$v",
+        {"$arrayToObject": {"$literal": [[user_id, code]]}},
+        {"$cond": [promote, {"$arrayToObject": [[{"k": {"$arrayElemAt": ["$waitlist", 0]}, "v": attend}]]}, {}]},
+    ]}
+
+    return upgrade_stages() + [
+        {"$set": {
+            "_prev": {"$ifNull": [f"$v.{user_id}", -1]},
+            "_waiting": {"$in": [user_id, {"$ifNull": ["$waitlist", []]}]},
+            "waitlist": {"$ifNull": ["$waitlist", []]},
+        }},
+        {"$set": {"_action": action}},
+        {"$set": {
+            "v": {"$switch": {"branches": [
+                {"case": action_is("same"), "then": "$v"},
+                {"case": action_is("waitlist"), "then": without_user},
+            ], "default": with_user}},
+            "waitlist": {"$switch": {"branches": [
+                {"case": action_is("waitlist"), "then": {"$concatArrays": ["$waitlist", {"$literal": [user_id]}]}},
+                {"case": action_is("leave_wait"), "then": {"$filter": {"input": "$waitlist", "cond": {"$ne": ["$$this", user_id]}}}},
+                {"case": promote, "then": {"$slice": ["$waitlist", 1, {"$size": "$waitlist"}]}},
+            ], "default": "$waitlist"}},
+            "counts.attend": {"$add": [
+                {"$ifNull": ["$counts.attend", 0]},
+                flag(action_is("attend")), {"$multiply": [-1, flag(action_is("cancel"))]}, flag(promote),
+            ]},
+            "counts.absent": {"$add": [
+                {"$ifNull": ["$counts.absent", 0]},
+                flag(action_is("leave_wait", "cancel")),
+                flag({"$and": [action_is("absent"), {"$ne": ["$_prev", absent]}]}),
+                {"$multiply": [-1, flag({"$and": [action_is("attend", "waitlist"), {"$eq": ["$_prev", absent]}]})]},
+            ]},
+            "updated_at": now,
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+        }},
+        {"$unset": ["_prev", "_waiting", "_action"]},
+    ]
+
+
+# ===== votes 集合模式 =====
+# 每一票是 votes 集合中的一份文件 {poll_id, user_id, group_id, code, updated_at}，
+# 投票文件本身不再被每一票寫入；結算時再把投票記錄合併回投票數據
+
+def with_votes(poll, votes):
+    """將 votes 集合中的投票合併到投票數據，返回 v2 結構的副本
+    投票文件中已有的記錄（切換模式前的投票）會被 votes 集合中同一用戶的記錄覆蓋
+    參數:
+        poll: 投票數據
+        votes: votes 集合的文件
+    """
+    codes = {user_id: OPTIONS.index(option) for user_id, option in voters(poll).items()}
+    latest = None
+    for vote in votes:
+        codes[vote['user_id']] = vote['code']
+        if latest is None or vote['updated_at'] > latest:
+            latest = vote['updated_at']
+    merged = {key: value for key, value in poll.items() if key not in ('options', 'voters')}
+    merged.update({
+        'schema': SCHEMA_VERSION,
+        'v': codes,
+        'counts': {option: sum(1 for code in codes.values() if code == index) for index, option in enumerate(OPTIONS)},
+        # 投票文件不隨每一票更新，以票數和最後投票時間作為結果快取的版本
+        'version': (poll.get('version', 0), len(codes), latest),
+    })
+    return merged
+
+
+def votes_lookup_stages(votes_collection):
+    """聚合管線階段：從 votes 集合取回投票並合併為 v2 的 v 欄位"""
+    return [
+        {"$lookup": {"from": votes_collection, "localField": "poll_id", "foreignField": "poll_id", "as": "_votes"}},
+        {"$set": {
+            "schema": SCHEMA_VERSION,
+            "v": {"$mergeObjects": [
+                _codes_expression(),
+                {"$arrayToObject": {"$map": {"input": "$_votes", "in": {"k": "$$this.user_id", "v": "$$this.code"}}}}
+            ]},
+        }},
+        {"$unset": "_votes"},
+    ]
+
+
+# ===== 批次轉換 =====
+
+def migrate(db, batch_size=500):
+    """將所有分片中的 v1 文件分批轉換為 v2
+    返回:
+        轉換的文件數
+    """
+    import pymongo
+
+    converted = 0
+    for shard_db in db.router.all_shards():
+        polls = shard_db[db.polls_collection]
+        while True:
+            ids = [doc["_id"] for doc in polls.find({"schema": {"$ne": SCHEMA_VERSION}}, {"_id": 1}).limit(batch_size)]
+            if not ids:
+                break
+            result = polls.bulk_write([
+                pymongo.UpdateOne({"_id": _id, "schema": {"$ne": SCHEMA_VERSION}}, upgrade_stages())
+                for _id in ids
+            ], ordered=False)
+            converted += result.modified_count
+            logger.info(f"{shard_db.name}: 已轉換 {converted} 份投票文件")
+    return converted
+
+
+def schema_stats(db):
+    """各結構的文件數和平均大小
+    返回:
+        {schema: (文件數, 平均位元組)}
+    """
+    stats = {}
+    for shard_db in db.router.all_shards():
+        for row in shard_db[db.polls_collection].aggregate([
+            {"$group": {"_id": {"$ifNull": ["$schema", 1]}, "count": {"$sum": 1}, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}}
+        ]):
+            count, size = stats.get(row["_id"], (0, 0))
+            stats[row["_id"]] = (count + row["count"], size + row["bytes"])
+    return {schema: (count, round(size / count) if count else 0) for schema, (count, size) in stats.items()}
+
+
+def main(argv=None):
+    from db import Database
+
+    parser = argparse.ArgumentParser(description="投票文件結構工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="將 v1 投票文件轉換為 v2")
+    migrate_parser.add_argument("--batch-size", type=int, default=500, help="每批轉換的文件數")
+    subparsers.add_parser("stats", help="各結構的文件數和平均大小")
+    args = parser.parse_args(argv)
+
+    db = Database()
+    try:
+        if args.command == "migrate":
+            print(f"已轉換 {migrate(db, args.batch_size)} 份投票文件")
+        for schema, (count, average) in sorted(schema_stats(db).items()):
+            print(f"v{schema}: {count} 份, 平均 {average} 位元組")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
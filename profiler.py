@@ -0,0 +1,185 @@
+"""
+按需啟用的請求分析（cProfile）
+
+以 @profiled('名稱') 標記 webhook 處理、投票處理、發件匣投遞和排程任務，啟用後：
+- 依 PROFILE_SAMPLE_RATE 抽樣分析部分呼叫
+- PROFILE_SLOW_MS > 0 時只保留耗時超過門檻的分析結果，其餘捨棄
+- 同名稱的結果累積合併，每 PROFILE_DUMP_EVERY 次寫入 PROFILE_DIR：
+  <名稱>-<時間>.prof（可用 pstats 或 snakeviz 開啟）和 .txt（最耗時的前 N 個函數）
+可由環境變數 PROFILE_ENABLED=1 啟動時開啟，或由開發者以 /profile 指令在執行中切換。
+未啟用時每次呼叫只多一次布林判斷；同一時間只分析一個呼叫，其餘並行的呼叫不分析。
+cProfile 只分析呼叫的執行緒：合併視窗後的投票在計時器執行緒、推送在發件匣執行緒，因此各自標記，
+webhook 的 callback 只包含簽名驗證、解析和立即處理的部分。
+非同步模式下事件迴圈執行緒上的所有 greenlet 共用一個執行緒，分析結果會混入其他請求，因此不分析。
+"""
+import os
+import io
+import time
+import random
+import logging
+import functools
+import threading
+from datetime import datetime
+import metrics
+import async_bridge
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('PROFILE_ENABLED', '0') == '1'
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.05'))
+SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+DUMP_EVERY = int(os.environ.get('PROFILE_DUMP_EVERY', '20'))
+TOP_N = int(os.environ.get('PROFILE_TOP_N', '25'))
+
+# cProfile 同一時間只能有一個分析器在執行
+_active = threading.Lock()
+_lock = threading.Lock()
+# {名稱: [pstats.Stats, 累積次數]}
+_pending = {}
+
+
+def enable(sample_rate=None, slow_ms=None):
+    """開啟分析，可同時調整抽樣比例和耗時門檻"""
+    global ENABLED, SAMPLE_RATE, SLOW_MS
+    if sample_rate is not None:
+        SAMPLE_RATE = sample_rate
+    if slow_ms is not None:
+        SLOW_MS = slow_ms
+    ENABLED = True
+    logger.info(f"已開啟請求分析: 抽樣 {SAMPLE_RATE:.0%}, 門檻 {SLOW_MS}ms")
+
+
+def disable():
+    """關閉分析並寫出尚未寫入的結果"""
+    global ENABLED
+    ENABLED = False
+    paths = dump_all()
+    logger.info("已關閉請求分析")
+    return paths
+
+
+def status():
+    """目前設定和累積中的分析次數"""
+    with _lock:
+        pending = {name: count for name, (_, count) in _pending.items()}
+    state = "開啟" if ENABLED else "關閉"
+    lines = [f"分析: {state}, 抽樣 {SAMPLE_RATE:.0%}, 門檻 {SLOW_MS}ms, 每 {DUMP_EVERY} 次寫入 {PROFILE_DIR}"]
+    lines += [f"{name}: 累積 {count} 次" for name, count in sorted(pending.items())]
+    return "\n".join(lines)
+
+
+def _collect(name, profile):
+    import pstats
+
+    with _lock:
+        entry = _pending.get(name)
+        if entry is None:
+            _pending[name] = [pstats.Stats(profile), 1]
+        else:
+            entry[0].add(profile)
+            entry[1] += 1
+        if _pending[name][1] < DUMP_EVERY:
+            return
+        stats, count = _pending.pop(name)
+    _dump(name, stats, count)
+
+
+def _dump(name, stats, count):
+    """寫出累積的分析結果和熱點摘要
+    返回:
+        .prof 檔案路徑
+    """
+    import pstats
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+    stats.dump_stats(base + ".prof")
+
+    summary = io.StringIO()
+    summary.write(f"{name}: {count} 次呼叫的合併分析\n\n")
+    pstats.Stats(base + ".prof", stream=summary).sort_stats("cumulative").print_stats(TOP_N)
+    summary.write("\n")
+    pstats.Stats(base + ".prof", stream=summary).sort_stats("tottime").print_stats(TOP_N)
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write(summary.getvalue())
+
+    metrics.incr("profiler.dumps")
+    logger.info(f"已寫入分析結果: {base}.prof（{count} 次）")
+    return base + ".prof"
+
+
+def dump_all():
+    """立即寫出所有累積中的結果
+    返回:
+        寫入的 .prof 檔案路徑列表
+    """
+    with _lock:
+        pending = list(_pending.items())
+        _pending.clear()
+    return [_dump(name, stats, count) for name, (stats, count) in pending]
+
+
+def _run_profiled(name, func, args, kwargs):
+    import cProfile
+
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        _active.release()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if SLOW_MS <= 0 or elapsed_ms >= SLOW_MS:
+            metrics.incr(f"profiler.{name}.kept")
+            try:
+                _collect(name, profile)
+            except Exception as e:
+                logger.error(f"寫入分析結果時發生錯誤: {name}, {e}")
+        else:
+            metrics.incr(f"profiler.{name}.discarded")
+
+
+def profiled(name, sample_rate=None):
+    """標記要分析的函數
+    參數:
+        name: 分析結果的名稱，也是輸出檔名的前綴
+        sample_rate: 可選，取代 PROFILE_SAMPLE_RATE（如很少執行的排程任務設為 1）
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rate = SAMPLE_RATE if sample_rate is None else sample_rate
+            if not ENABLED or random.random() >= rate or async_bridge.on_loop_thread() \
+                    or not _active.acquire(blocking=False):
+                return func(*args, **kwargs)
+            return _run_profiled(name, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def handle_command(args):
+    """/profile 指令：on [抽樣比例] [門檻ms] | off | dump | status
+    返回:
+        回覆文字
+    """
+    action = args[0].lower() if args else "status"
+    try:
+        if action == "on":
+            sample_rate = float(args[1]) if len(args) > 1 else None
+            slow_ms = float(args[2]) if len(args) > 2 else None
+            enable(sample_rate, slow_ms)
+            return status()
+        if action == "off":
+            paths = disable()
+            return "已關閉分析" + "".join(f"\n{path}" for path in paths)
+        if action == "dump":
+            paths = dump_all()
+            return "\n".join(paths) or "沒有累積中的分析結果"
+    except ValueError:
+        return "格式：/profile on [抽樣比例0-1] [門檻ms]"
+    if action == "status":
+        return status()
+    return "格式：/profile on [抽樣比例] [門檻ms] | off | dump | status"
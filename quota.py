@@ -0,0 +1,230 @@
+"""
+LINE 訊息額度的統計與預算模式
+
+每則推送依接收者計費：推送給用戶算 1 則，推送給群組或聊天室按成員數計算；回覆不計費。
+delivery.send 每次發送都呼叫 record()，按訊息類型和接收者累計；
+排程任務每 QUOTA_RECONCILE_MINUTES 分鐘以 LINE 的額度端點（/v2/bot/message/quota 和 /quota/consumption）校正，
+兩次校正之間以本行程的推送數估計用量（多副本部署時其他副本的用量在下次校正時才計入）。
+
+以本月至今的用量線性推估月底用量，依剩餘額度切換預算模式：
+- normal:   照常發送
+- saving:   推估月底用量超過額度，投票確認只以回覆發送（無法回覆時不推送），
+            給開發者的通知延後到每 QUOTA_DIGEST_MINUTES 分鐘合併為一則推送
+- critical: 剩餘額度低於 QUOTA_CRITICAL_RATIO，只推送投票、結果和候補遞補通知，其他推送全部暫停
+            （發件匣中的通知保留到模式解除後再送）
+/metrics 中的 quota.* 顯示用量、額度、推估值和目前的模式。
+
+開發和測試時（QUOTA_STUB=1，指向模擬伺服器的 LINE_API_ENDPOINT 時預設開啟）以本地的額度端點校正，
+不呼叫 LINE：額度為 QUOTA_LIMIT，用量為 QUOTA_STUB_USAGE 加上本行程本月推送的計費則數。
+"""
+import os
+import time
+import threading
+import logging
+import calendar
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 額度端點無法使用或方案不限量時的本地額度，未設定則視為不限量
+LOCAL_LIMIT = int(os.environ.get('QUOTA_LIMIT', '0')) or None
+RECONCILE_MINUTES = int(os.environ.get('QUOTA_RECONCILE_MINUTES', '60'))
+DIGEST_MINUTES = float(os.environ.get('QUOTA_DIGEST_MINUTES', '1440'))
+CRITICAL_RATIO = float(os.environ.get('QUOTA_CRITICAL_RATIO', '0.05'))
+# 以本地的額度端點校正（不呼叫 LINE），LINE API 指向模擬伺服器時預設開啟
+STUB = os.environ.get('QUOTA_STUB', '1' if os.environ.get('LINE_API_ENDPOINT') else '0') == '1'
+# 本地額度端點回報的本月基本用量（模擬其他副本或本月稍早的用量）
+STUB_USAGE = int(os.environ.get('QUOTA_STUB_USAGE', '0'))
+# 群組成員數的快取時間（秒）
+MEMBER_COUNT_SECONDS = 6 * 3600
+
+# critical 模式下仍推送的訊息類型
+ESSENTIAL_KINDS = ('poll', 'result', 'promotion')
+
+_lock = threading.Lock()
+_state = {
+    "month": None,          # (年, 月)，跨月時重設
+    "limit": LOCAL_LIMIT,
+    "reconciled_usage": 0,  # 最近一次校正時 LINE 回報的用量
+    "local_usage": 0,       # 校正後本行程推送的計費則數
+    "reconciled_at": None,
+}
+# 本月按類型和接收者累計的計費則數
+_by_kind = Counter()
+_by_recipient = Counter()
+_member_counts = {}
+# 上次送出合併通知的時間（time.monotonic），None 表示本行程尚未送過
+_last_digest = None
+
+
+def _base_kind(kind):
+    """發件匣的類型為 'outbox.<類型>'，預算規則只看原本的類型"""
+    return kind.split('.', 1)[1] if kind.startswith('outbox.') else kind
+
+
+def _roll_month(now):
+    """跨月時重設本月的統計（呼叫者持有 _lock）"""
+    month = (now.year, now.month)
+    if _state["month"] != month:
+        _state.update(month=month, reconciled_usage=0, local_usage=0, reconciled_at=None)
+        _by_kind.clear()
+        _by_recipient.clear()
+
+
+def _member_count(line_bot_api, to):
+    """群組或聊天室的成員數（推送的計費則數），查詢失敗時以 1 計"""
+    cached = _member_counts.get(to)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    try:
+        if to.startswith('C'):
+            count = line_bot_api.get_group_members_count(to)
+        else:
+            count = line_bot_api.get_room_members_count(to)
+    except Exception as e:
+        logger.warning(f"查詢成員數時發生錯誤: {to}, {e}")
+        return cached[1] if cached else 1
+    _member_counts[to] = (time.monotonic() + MEMBER_COUNT_SECONDS, count)
+    return count
+
+
+def record(line_bot_api, kind, to, via):
+    """記錄一次發送
+    參數:
+        line_bot_api: LineBotApi對象（查詢群組成員數）
+        kind: 訊息類型
+        to: 接收者ID
+        via: 'reply' 或 'push'
+    """
+    kind = _base_kind(kind)
+    if via != 'push':
+        metrics.incr(f"quota.replies.{kind}")
+        return
+    cost = _member_count(line_bot_api, to) if to[:1] in ('C', 'R') else 1
+    with _lock:
+        _roll_month(datetime.now())
+        _state["local_usage"] += cost
+        _by_kind[kind] += cost
+        _by_recipient[to] += cost
+    metrics.incr(f"quota.pushes.{kind}", cost)
+
+
+class StubQuotaApi:
+    """本地的額度端點，與 LineBotApi 的 get_message_quota / get_message_quota_consumption 相同的介面"""
+
+    def get_message_quota(self):
+        return SimpleNamespace(type='limited' if LOCAL_LIMIT else 'none', value=LOCAL_LIMIT)
+
+    def get_message_quota_consumption(self):
+        with _lock:
+            _roll_month(datetime.now())
+            pushed = sum(_by_kind.values())
+        return SimpleNamespace(total_usage=STUB_USAGE + pushed)
+
+
+def reconcile(line_bot_api):
+    """以 LINE 的額度端點校正用量和額度（QUOTA_STUB 時以本地的額度端點）"""
+    if STUB:
+        line_bot_api = StubQuotaApi()
+    quota = line_bot_api.get_message_quota()
+    consumption = line_bot_api.get_message_quota_consumption()
+    with _lock:
+        _roll_month(datetime.now())
+        _state["limit"] = quota.value if quota.type == 'limited' else LOCAL_LIMIT
+        _state["reconciled_usage"] = consumption.total_usage
+        _state["local_usage"] = 0
+        _state["reconciled_at"] = datetime.now()
+    logger.info(f"已校正訊息額度: 用量 {consumption.total_usage}, 額度 {_state['limit']}, 模式 {mode()}")
+
+
+def usage():
+    with _lock:
+        _roll_month(datetime.now())
+        return _state["reconciled_usage"] + _state["local_usage"]
+
+
+def limit():
+    return _state["limit"]
+
+
+def forecast(now=None):
+    """以本月至今的平均速度推估月底的用量"""
+    now = now or datetime.now()
+    days = calendar.monthrange(now.year, now.month)[1]
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    # 月初的前一天以一天計，避免少量推送被放大
+    elapsed = max((now - month_start).total_seconds(), 86400)
+    return round(usage() * days * 86400 / elapsed)
+
+
+def mode():
+    """目前的預算模式"""
+    quota_limit = limit()
+    if not quota_limit:
+        return 'normal'
+    if quota_limit - usage() <= quota_limit * CRITICAL_RATIO:
+        return 'critical'
+    if forecast() > quota_limit:
+        return 'saving'
+    return 'normal'
+
+
+def allow_push(kind):
+    """此類型的訊息在目前的預算模式下是否可以推送"""
+    kind = _base_kind(kind)
+    current = mode()
+    if current == 'critical':
+        return kind in ESSENTIAL_KINDS
+    if current == 'saving':
+        return kind != 'confirmation'
+    return True
+
+
+def deferred_kinds():
+    """發件匣中暫不投遞的訊息類型（開發者通知在合併推送的時間到之前保留）"""
+    current = mode()
+    if current == 'critical':
+        return ['note']
+    if current == 'saving' and _last_digest is not None and time.monotonic() - _last_digest < DIGEST_MINUTES * 60:
+        return ['note']
+    return []
+
+
+def merging_notes():
+    """開發者通知是否合併為摘要"""
+    return mode() != 'normal'
+
+
+def digest_sent():
+    """記錄已送出一次合併的通知"""
+    global _last_digest
+    _last_digest = time.monotonic()
+
+
+def report():
+    """用量摘要（供 /quota 指令查看）"""
+    quota_limit = limit()
+    with _lock:
+        reconciled_at = _state["reconciled_at"]
+        by_kind = dict(_by_kind)
+        top = _by_recipient.most_common(5)
+    lines = [
+        f"模式: {mode()}",
+        f"本月用量: {usage()} / {quota_limit or '不限'}，推估月底: {forecast()}",
+        f"最近校正: {reconciled_at.strftime('%m/%d %H:%M') if reconciled_at else '未校正'}",
+    ]
+    if by_kind:
+        lines.append("本行程推送（按類型）: " + ", ".join(f"{kind} {count}" for kind, count in sorted(by_kind.items())))
+    if top:
+        lines.append("本行程推送（按接收者）: " + ", ".join(f"{to[-6:]} {count}" for to, count in top))
+    return "\n".join(lines)
+
+
+metrics.register_gauge("quota.usage", usage)
+metrics.register_gauge("quota.limit", lambda: limit() or 0)
+metrics.register_gauge("quota.forecast", forecast)
+metrics.register_gauge("quota.forecast_ratio", lambda: round(forecast() / limit(), 3) if limit() else 0.0)
+metrics.register_gauge("quota.mode", mode)
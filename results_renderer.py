@@ -0,0 +1,424 @@
+import os
+import json
+import threading
+import logging
+from collections import OrderedDict
+import metrics
+import change_listener
+import poll_schema
+
+logger = logging.getLogger(__name__)
+
+# LINE Flex Message 的大小限制（序列化後的 UTF-8 位元組數）
+# 單一 bubble 最多 30KB，carousel 最多 12 個 bubble 且合計 50KB，一次推送最多 5 則訊息
+BUBBLE_MAX_BYTES = 30 * 1024
+CAROUSEL_MAX_BYTES = 50 * 1024
+CAROUSEL_MAX_BUBBLES = 12
+PUSH_MAX_MESSAGES = 5
+# 保留給估算誤差的餘量
+SAFETY_MARGIN = 1024
+
+OPTION_STYLES = [
+    ("attend", "✅出席", "#28a745"),
+    ("absent", "❌請假", "#dc3545"),
+]
+# 有名額的投票的候補名單（不計入票數）
+WAITLIST_STYLE = ("waitlist", "⏳候補", "#f0ad4e")
+
+# 渲染結果快取：poll_id -> {"version", "group_id", "payload", "names"}
+# version 是投票文件中每次投票遞增的版本號，版本不同的項目視為過期；
+# 其他副本更新成員名稱時經由 change stream 移除該群組的項目
+CACHE_SIZE = int(os.environ.get('RESULTS_CACHE_SIZE', '256'))
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _size(obj):
+    """序列化後的位元組數"""
+    return len(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def _header_box():
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "📊 投票結果",
+                "weight": "bold",
+                "size": "xl",
+                "color": "#ffffff"
+            }
+        ],
+        "backgroundColor": "#4A90E2",
+        "paddingAll": "15px"
+    }
+
+
+def _title_box(title, total_votes, page=None, pages=None, capacity_text=None):
+    subtitle = f"Total votes: {total_votes}"
+    if page is not None and pages and pages > 1:
+        subtitle += f"  ({page}/{pages})"
+    if capacity_text:
+        subtitle += f"\n{capacity_text}"
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": title,
+                "weight": "bold",
+                "size": "lg",
+                "wrap": True
+            },
+            {
+                "type": "text",
+                "text": subtitle,
+                "size": "sm",
+                "color": "#888888",
+                "margin": "md",
+                "wrap": True
+            },
+            {
+                "type": "separator",
+                "margin": "lg"
+            }
+        ],
+        "paddingAll": "15px"
+    }
+
+
+def _option_bar(label, color, count, total_votes):
+    percent = 0 if total_votes == 0 else (count / total_votes) * 100
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "box",
+                "layout": "horizontal",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": label,
+                        "size": "md",
+                        "flex": 5
+                    },
+                    {
+                        "type": "text",
+                        "text": f"{count} ({percent:.1f}%)",
+                        "size": "md",
+                        "align": "end",
+                        "flex": 2
+                    }
+                ]
+            },
+            {
+                "type": "box",
+                "layout": "vertical",
+                "contents": [
+                    {
+                        "type": "box",
+                        "layout": "vertical",
+                        "contents": [],
+                        "backgroundColor": color,
+                        "height": "6px",
+                        "width": f"{percent}%"
+                    }
+                ],
+                "backgroundColor": "#EEEEEE",
+                "height": "6px",
+                "margin": "sm"
+            }
+        ],
+        "margin": "lg"
+    }
+
+
+def _options_box(counts, total_votes):
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            _option_bar(label, color, counts.get(option, 0), total_votes)
+            for option, label, color in OPTION_STYLES
+        ],
+        "paddingAll": "15px"
+    }
+
+
+def _attendance_box(attend_count, total_votes):
+    attendance_rate = 0 if total_votes == 0 else (attend_count / total_votes) * 100
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "separator",
+                "margin": "sm"
+            },
+            {
+                "type": "box",
+                "layout": "horizontal",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": "出席率:",
+                        "size": "md",
+                        "weight": "bold",
+                        "flex": 4
+                    },
+                    {
+                        "type": "text",
+                        "text": f"{attendance_rate:.1f}%",
+                        "size": "md",
+                        "weight": "bold",
+                        "color": "#4A90E2",
+                        "align": "end",
+                        "flex": 2
+                    }
+                ],
+                "margin": "lg"
+            }
+        ],
+        "paddingAll": "15px"
+    }
+
+
+def _section(label, color, names):
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": label,
+                "weight": "bold",
+                "size": "md",
+                "color": color
+            },
+            {
+                "type": "text",
+                "text": "\n".join(names),
+                "size": "md",
+                "wrap": True,
+                "margin": "sm",
+                "color": "#888888"
+            }
+        ],
+        "margin": "md"
+    }
+
+
+def _participants_box(sections):
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "separator",
+                "margin": "md"
+            },
+            {
+                "type": "text",
+                "text": "Participants:",
+                "weight": "bold",
+                "margin": "lg"
+            },
+            {
+                "type": "box",
+                "layout": "horizontal",
+                "contents": [_section(label, color, names) for label, color, names in sections],
+                "margin": "md"
+            }
+        ],
+        "paddingAll": "15px"
+    }
+
+
+def _bubble(contents):
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": contents
+        }
+    }
+
+
+def _paginate(summary_size, page_size, name_lists, budget):
+    """按位元組預算將名單切成多頁
+    邊建邊累計大小：每個名字增加其 JSON 字串長度加上換行跳脫字元
+    參數:
+        summary_size: 第一頁（含摘要）的固定大小
+        page_size: 後續頁面的固定大小
+        name_lists: [(label, color, names)]
+        budget: 單頁可用位元組數
+    返回:
+        每頁的 [(label, color, names)] 列表
+    """
+    pages = []
+    current = []
+    used = summary_size
+    empty_section = _size(_section("", "", []))
+
+    for label, color, names in name_lists:
+        section_names = []
+        section_cost = empty_section + _size(label) + _size(color)
+        if used + section_cost > budget and current:
+            pages.append(current)
+            current, used = [], page_size
+        used += section_cost
+        for name in names:
+            # 名字序列化後的長度：省下的兩個引號正好抵銷換行跳脫字元 "\n" 的 2 位元組
+            cost = _size(name)
+            if used + cost > budget and (section_names or current):
+                if section_names:
+                    current.append((label, color, section_names))
+                pages.append(current)
+                current, section_names = [], []
+                used = page_size + section_cost
+            section_names.append(name)
+            used += cost
+        if section_names:
+            current.append((label, color, section_names))
+
+    if current or not pages:
+        pages.append(current)
+    return pages
+
+
+def render_results(poll, names_by_option):
+    """渲染投票結果，內容超過單一 bubble 的大小時自動分頁為 carousel
+    參數:
+        poll: 投票數據
+        names_by_option: {option: [顯示名稱]}
+    返回:
+        Flex contents 字典的列表（bubble 或 carousel），每個對應一則訊息
+    """
+    counts = poll_schema.counts(poll)
+    total_votes = poll_schema.total_votes(poll)
+    title = poll['title']
+
+    name_lists = [
+        (label, color, names_by_option.get(option, []))
+        for option, label, color in OPTION_STYLES + [WAITLIST_STYLE]
+        if names_by_option.get(option)
+    ]
+    capacity_text = None
+    if poll_schema.has_capacity(poll):
+        capacity_text = f"名額 {counts.get('attend', 0)}/{poll['capacity']}，候補 {len(poll_schema.waitlist(poll))} 人"
+
+    summary = [_header_box(), _title_box(title, total_votes, 1, 99, capacity_text), _options_box(counts, total_votes),
+               _attendance_box(counts.get('attend', 0), total_votes)]
+    summary_size = _size(_bubble(summary)) + _size(_participants_box([]))
+    page_size = _size(_bubble([_title_box(title, total_votes, 99, 99, capacity_text)])) + _size(_participants_box([]))
+    budget = BUBBLE_MAX_BYTES - SAFETY_MARGIN
+    pages = _paginate(summary_size, page_size, name_lists, budget)
+
+    bubbles = []
+    for index, sections in enumerate(pages):
+        page_no = index + 1
+        if index == 0:
+            contents = [_header_box(), _title_box(title, total_votes, page_no, len(pages), capacity_text),
+                        _options_box(counts, total_votes)]
+            if sections:
+                contents.append(_participants_box(sections))
+            contents.append(_attendance_box(counts.get('attend', 0), total_votes))
+        else:
+            contents = [_title_box(title, total_votes, page_no, len(pages), capacity_text), _participants_box(sections)]
+        bubbles.append(_bubble(contents))
+
+    if len(bubbles) == 1:
+        return bubbles
+
+    # 將頁面組成 carousel，每個 carousel 不超過 12 個 bubble 及 50KB
+    messages = []
+    carousel, carousel_size = [], 0
+    for bubble in bubbles:
+        bubble_size = _size(bubble)
+        if carousel and (len(carousel) >= CAROUSEL_MAX_BUBBLES
+                         or carousel_size + bubble_size > CAROUSEL_MAX_BYTES - SAFETY_MARGIN):
+            messages.append({"type": "carousel", "contents": carousel})
+            carousel, carousel_size = [], 0
+        carousel.append(bubble)
+        carousel_size += bubble_size
+    messages.append({"type": "carousel", "contents": carousel})
+
+    logger.info(f"投票結果分為 {len(bubbles)} 頁, {len(messages)} 則訊息: {poll.get('poll_id')}")
+    return messages
+
+
+class PreparedMessage:
+    """已序列化的訊息，發送時直接輸出保存的 JSON，不需再轉換為 SDK 的模型對象"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_json_dict(self):
+        return self.data
+
+
+def get_cached(poll_id, version):
+    """取得快取的渲染結果，版本不符則視為未命中
+    返回:
+        {"version", "payload", "names"}，未命中則返回None
+    """
+    with _cache_lock:
+        entry = _cache.get(poll_id)
+        if entry is None or entry["version"] != version:
+            metrics.incr("results_cache.miss")
+            return None
+        _cache.move_to_end(poll_id)
+    metrics.incr("results_cache.hit")
+    return entry
+
+
+def put_cached(poll_id, version, payload, names_by_option, group_id=None):
+    """保存渲染結果，超過容量時淘汰最久未使用的項目"""
+    with _cache_lock:
+        _cache[poll_id] = {"version": version, "group_id": group_id, "payload": payload, "names": names_by_option}
+        _cache.move_to_end(poll_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+            metrics.incr("results_cache.evicted")
+
+
+def invalidate(poll_id):
+    """投票後移除該投票的快取項目（其他投票不受影響）"""
+    with _cache_lock:
+        _cache.pop(poll_id, None)
+
+
+def invalidate_group(group_id):
+    """成員名稱變更後移除該群組所有投票的快取項目"""
+    with _cache_lock:
+        for poll_id in [key for key, entry in _cache.items() if entry["group_id"] == group_id]:
+            del _cache[poll_id]
+
+
+def clear():
+    with _cache_lock:
+        _cache.clear()
+
+
+change_listener.subscribe('polls', lambda event: invalidate(event["poll_id"]) if event["poll_id"] else clear(), clear)
+change_listener.subscribe('members', lambda event: invalidate_group(event["group_id"]), clear)
+
+
+def serialize_messages(poll, contents_list):
+    """將渲染結果序列化為 Flex 訊息，並按每次推送上限分批
+    返回:
+        訊息批次列表，每批最多 5 則，每則為可直接發送的 JSON 字典
+    """
+    alt_text = f"Poll Results: {poll['title']}"[:400]
+    messages = [{"type": "flex", "altText": alt_text, "contents": contents} for contents in contents_list]
+    return [messages[i:i + PUSH_MAX_MESSAGES] for i in range(0, len(messages), PUSH_MAX_MESSAGES)]
+
+
+def to_send_messages(batch):
+    """將一批序列化的訊息包裝為可交給 LineBotApi 的對象"""
+    return [PreparedMessage(message) for message in batch]
@@ -0,0 +1,457 @@
+"""
+按群組分片的儲存配置
+
+每個群組的投票、成員和出席統計存放在其中一個分片（同一個 MongoDB 叢集內的一個資料庫）：
+- 以一致性雜湊環將 group_id 對應到分片，增減分片時只有約 1/N 的群組需要搬移
+- shard_routes 集合保存雜湊環的分片列表，以及固定到某個分片的群組（搬移中或尚未搬移的群組）
+- poll_directory 集合保存 poll_id -> group_id，投票 postback 只帶 poll_id 時用來找到分片
+- 路由表在行程內快取 ROUTE_CACHE_SECONDS 秒，副本集上經由 change stream 立即失效
+- 搬移中的群組（路由項目有 moving 欄位）每次存取都讀取路由項目；最後比對和切換期間凍結（frozen），
+  存取凍結群組的操作等待凍結解除後改用新的分片
+
+用法:
+    python sharding.py status
+    python sharding.py rebalance --shards line_poll_db,line_poll_db_1,line_poll_db_2
+    python sharding.py move --group <群組ID> --to line_poll_db_1
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime
+import metrics
+import change_listener
+import async_bridge
+
+logger = logging.getLogger(__name__)
+
+ROUTES_COLLECTION = 'shard_routes'
+DIRECTORY_COLLECTION = 'poll_directory'
+# 按群組分片的集合，其餘集合（發件匣、路由表）只存在主資料庫
+SHARDED_COLLECTIONS = ('polls', 'votes', 'members', 'member_stats', 'group_stats')
+
+VNODES = 64
+ROUTE_CACHE_SECONDS = float(os.environ.get('SHARD_ROUTE_CACHE_SECONDS', '30'))
+DIRECTORY_CACHE_SIZE = 10000
+# 存取凍結中的群組時最多等待的秒數，超過時拋出 GroupMovingError（投票路徑回覆請重試）
+MOVE_FENCE_SECONDS = float(os.environ.get('SHARD_MOVE_FENCE_SECONDS', '10'))
+FENCE_POLL_SECONDS = 0.2
+# 凍結後等待進行中的操作完成的秒數
+FREEZE_GRACE_SECONDS = 1
+
+
+class GroupMovingError(Exception):
+    """群組搬移中，凍結在 MOVE_FENCE_SECONDS 內未解除"""
+
+
+def _pause(seconds):
+    """等待凍結解除（非同步模式下讓出事件迴圈）"""
+    if async_bridge.enabled():
+        async_bridge.call(asyncio.sleep, seconds)
+    else:
+        time.sleep(seconds)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """一致性雜湊環，每個分片有 VNODES 個虛擬節點"""
+
+    def __init__(self, shards, vnodes=VNODES):
+        self.shards = list(shards)
+        self._ring = sorted((_hash(f"{shard}#{i}"), shard) for shard in self.shards for i in range(vnodes))
+        self._keys = [key for key, _ in self._ring]
+
+    def lookup(self, group_id):
+        """群組在環上對應的分片"""
+        index = bisect.bisect(self._keys, _hash(group_id or "")) % len(self._ring)
+        return self._ring[index][1]
+
+
+class ShardRouter:
+    """將群組和投票路由到分片資料庫"""
+
+    def __init__(self, client, main_db, default_shards):
+        self.client = client
+        self.routes = main_db[ROUTES_COLLECTION]
+        self.directory = main_db[DIRECTORY_COLLECTION]
+        self._default_shards = list(default_shards)
+        self._lock = threading.Lock()
+        self._ring = None
+        self._pins = {}
+        self._moving = set()
+        self._loaded_at = 0
+        self._poll_groups = OrderedDict()
+        # 其他副本或搬移工具變更路由時立即失效，不必等到快取過期
+        change_listener.subscribe(ROUTES_COLLECTION, lambda event: self.invalidate(), self.invalidate)
+
+    def _refresh(self, wait=False):
+        if self._ring is not None and time.monotonic() - self._loaded_at < ROUTE_CACHE_SECONDS:
+            return
+        # 只有一個呼叫者讀取路由表，其他呼叫者在讀取期間沿用現有的路由表；
+        # 不在鎖上等待，非同步模式下同一執行緒中的 greenlet 等待鎖會卡住事件迴圈
+        if not self._lock.acquire(blocking=wait or self._ring is None):
+            return
+        try:
+            if self._ring is not None and time.monotonic() - self._loaded_at < ROUTE_CACHE_SECONDS:
+                return
+            config = self.routes.find_one({"_id": "ring"})
+            shards = config["shards"] if config else self._default_shards
+            docs = list(self.routes.find({"group_id": {"$exists": True}}))
+            self._ring = HashRing(shards)
+            self._pins = {doc["group_id"]: doc["shard"] for doc in docs}
+            self._moving = {doc["group_id"] for doc in docs if doc.get("moving")}
+            self._loaded_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """下次路由時重新讀取路由表"""
+        self._loaded_at = 0
+
+    def reload(self):
+        """立即重新讀取路由表"""
+        self._loaded_at = 0
+        self._refresh(wait=True)
+
+    @property
+    def ring(self):
+        self._refresh()
+        return self._ring
+
+    @property
+    def sharded(self):
+        """是否有多於一個分片（只有一個分片時不需查詢投票目錄）"""
+        self._refresh()
+        return len(self._ring.shards) > 1 or any(shard not in self._ring.shards for shard in self._pins.values())
+
+    def shard_name(self, group_id):
+        """群組所在的分片名稱（固定路由優先於雜湊環）"""
+        self._refresh()
+        return self._pins.get(group_id) or self._ring.lookup(group_id)
+
+    def _fenced_shard(self, group_id):
+        """搬移中的群組不使用快取的路由，每次讀取路由項目；凍結時等待凍結解除
+        返回:
+            分片名稱
+        """
+        deadline = time.monotonic() + MOVE_FENCE_SECONDS
+        fenced = False
+        while True:
+            doc = self.routes.find_one({"_id": f"group:{group_id}"}, {"shard": 1, "moving": 1, "frozen": 1})
+            if doc is None or not doc.get("moving"):
+                # 搬移已結束，下次存取時重新讀取路由表
+                self.invalidate()
+                return doc["shard"] if doc else self._ring.lookup(group_id)
+            if not doc.get("frozen"):
+                return doc["shard"]
+            if not fenced:
+                metrics.incr("shard.fenced")
+                fenced = True
+            if time.monotonic() > deadline:
+                raise GroupMovingError(f"群組搬移中: {group_id}")
+            _pause(FENCE_POLL_SECONDS)
+
+    def shard_db(self, group_id):
+        """群組所在的分片資料庫（搬移中的群組見 _fenced_shard）"""
+        name = self.shard_name(group_id)
+        if group_id in self._moving:
+            name = self._fenced_shard(group_id)
+        metrics.incr(f"shard.{name}.ops")
+        return self.client[name]
+
+    def shard_names(self):
+        """所有分片名稱（雜湊環上的分片和固定路由用到的分片）"""
+        self._refresh()
+        return sorted(set(self._ring.shards) | set(self._pins.values()))
+
+    def all_shards(self):
+        return [self.client[name] for name in self.shard_names()]
+
+    def pins(self):
+        self._refresh()
+        return dict(self._pins)
+
+    def pin(self, group_id, shard):
+        """將群組固定到指定分片（同時解除凍結）"""
+        self.routes.update_one(
+            {"_id": f"group:{group_id}"},
+            {"$set": {"group_id": group_id, "shard": shard, "updated_at": datetime.now()},
+             "$unset": {"moving": "", "frozen": ""}},
+            upsert=True
+        )
+        self.reload()
+
+    def start_move(self, group_id, shard, target):
+        """標記群組搬移中：路由仍指向 shard，各副本看到標記後每次存取都讀取路由項目"""
+        self.routes.update_one(
+            {"_id": f"group:{group_id}"},
+            {"$set": {"group_id": group_id, "shard": shard, "moving": target, "frozen": False,
+                      "updated_at": datetime.now()}},
+            upsert=True
+        )
+        self.reload()
+
+    def freeze(self, group_id):
+        """凍結搬移中的群組，存取該群組的操作等待 pin() 解除凍結"""
+        self.routes.update_one({"_id": f"group:{group_id}"}, {"$set": {"frozen": True, "updated_at": datetime.now()}})
+
+    def unpin(self, group_id):
+        """移除群組的固定路由，之後按雜湊環路由"""
+        self.routes.delete_one({"_id": f"group:{group_id}"})
+        self.reload()
+
+    def set_shards(self, shards):
+        """更新雜湊環的分片列表"""
+        self.routes.update_one(
+            {"_id": "ring"},
+            {"$set": {"shards": list(shards), "updated_at": datetime.now()}},
+            upsert=True
+        )
+        self.reload()
+
+    def remember_poll(self, poll_id, group_id):
+        with self._lock:
+            self._poll_groups[poll_id] = group_id
+            self._poll_groups.move_to_end(poll_id)
+            while len(self._poll_groups) > DIRECTORY_CACHE_SIZE:
+                self._poll_groups.popitem(last=False)
+
+    def record_poll(self, poll_id, group_id, session=None):
+        """將投票寫入目錄（投票的群組不會改變，因此目錄項目可無限期快取）"""
+        self.directory.update_one(
+            {"poll_id": poll_id},
+            {"$set": {"poll_id": poll_id, "group_id": group_id}},
+            upsert=True,
+            session=session
+        )
+        self.remember_poll(poll_id, group_id)
+
+    def group_for_poll(self, poll_id):
+        """從目錄查詢投票所屬的群組
+        返回:
+            (是否找到, group_id)
+        """
+        with self._lock:
+            if poll_id in self._poll_groups:
+                self._poll_groups.move_to_end(poll_id)
+                return True, self._poll_groups[poll_id]
+        entry = self.directory.find_one({"poll_id": poll_id}, {"_id": 0, "group_id": 1})
+        if entry is None:
+            return False, None
+        self.remember_poll(poll_id, entry.get("group_id"))
+        return True, entry.get("group_id")
+
+
+# ===== 線上搬移 =====
+
+def _copy_group(source, target, group_id, since=None):
+    """將群組的文件從來源分片複製（覆蓋）到目標分片
+    指定 since 時只複製之後更新過的文件
+    返回:
+        複製的文件數
+    """
+    copied = 0
+    for name in SHARDED_COLLECTIONS:
+        query = {"group_id": group_id}
+        if since:
+            query["updated_at"] = {"$gte": since}
+        for doc in source[name].find(query):
+            target[name].replace_one({"_id": doc["_id"]}, doc, upsert=True)
+            copied += 1
+    return copied
+
+
+def _verify_copy(source, target, group_id):
+    """凍結期間比對兩邊的文件：補上差異，刪除目標中來源已刪除的文件
+    比對 (_id, updated_at)，沒有 updated_at 的文件比對整份內容
+    返回:
+        {集合: 已確認複製的 _id 列表}，補上後仍不一致時返回 None
+    """
+    verified = {}
+    for name in SHARDED_COLLECTIONS:
+        query = {"group_id": group_id}
+        source_docs = {doc["_id"]: doc for doc in source[name].find(query)}
+        target_versions = {doc["_id"]: doc.get("updated_at")
+                           for doc in target[name].find(query, {"updated_at": 1})}
+        stale = [doc_id for doc_id in target_versions if doc_id not in source_docs]
+        if stale:
+            target[name].delete_many({"_id": {"$in": stale}})
+        for doc_id, doc in source_docs.items():
+            if doc_id in target_versions and doc.get("updated_at") is not None \
+                    and target_versions[doc_id] == doc["updated_at"]:
+                continue
+            target[name].replace_one({"_id": doc_id}, doc, upsert=True)
+        copied = {doc["_id"]: doc for doc in target[name].find(query)}
+        if copied != source_docs:
+            logger.error(f"搬移群組 {group_id} 時 {name} 比對不一致")
+            return None
+        verified[name] = list(source_docs)
+    return verified
+
+
+def move_group(db, group_id, target, wait=ROUTE_CACHE_SECONDS):
+    """線上搬移一個群組到目標分片
+    1. 複製群組的文件（不影響讀寫）
+    2. 標記搬移中並等待 wait 秒，讓各副本的路由快取都看到標記（之後每次存取都讀取路由項目），
+       再補上期間寫入的文件
+    3. 凍結群組，等待進行中的操作完成後逐份比對兩邊的文件並補上差異
+    4. 切換路由到目標分片並解除凍結，再只刪除已確認複製的來源文件
+    凍結只涵蓋比對和切換，存取該群組的操作在這段時間等待（最多 MOVE_FENCE_SECONDS 秒）；
+    比對不一致或失敗時解除凍結並保留在來源分片
+    參數:
+        db: Database對象
+        group_id: 群組ID
+        target: 目標分片名稱
+        wait: 標記後等待的秒數（副本集上路由經由 change stream 立即失效，可縮短）
+    返回:
+        複製的文件數
+    """
+    router = db.router
+    source_name = router.shard_name(group_id)
+    if source_name == target:
+        return 0
+    source, destination = db.client[source_name], db.client[target]
+    db.ensure_shard_indexes(target)
+
+    started = datetime.now()
+    copied = _copy_group(source, destination, group_id)
+    router.start_move(group_id, source_name, target)
+    try:
+        time.sleep(wait)
+        copied += _copy_group(source, destination, group_id, since=started)
+        router.freeze(group_id)
+        time.sleep(FREEZE_GRACE_SECONDS)
+        verified = _verify_copy(source, destination, group_id)
+    except Exception:
+        router.pin(group_id, source_name)
+        raise
+    if verified is None:
+        router.pin(group_id, source_name)
+        raise RuntimeError(f"搬移群組 {group_id} 時資料比對不一致，已保留在 {source_name}")
+
+    router.pin(group_id, target)
+    for name, doc_ids in verified.items():
+        if doc_ids:
+            source[name].delete_many({"_id": {"$in": doc_ids}})
+
+    # 與雜湊環一致時不需要固定路由
+    if router.ring.lookup(group_id) == target:
+        router.unpin(group_id)
+    logger.info(f"已搬移群組 {group_id}: {source_name} -> {target}, {copied} 份文件")
+    return copied
+
+
+def _all_groups(db):
+    groups = set()
+    for shard in db.router.all_shards():
+        for name in ('polls', 'members'):
+            groups.update(g for g in shard[name].distinct("group_id") if g is not None)
+    return groups
+
+
+def backfill_directory(db):
+    """為目錄中沒有的投票補上目錄項目（分片前建立的投票）"""
+    count = 0
+    for shard in db.router.all_shards():
+        for poll in shard['polls'].find({}, {"_id": 0, "poll_id": 1, "group_id": 1}):
+            result = db.router.directory.update_one(
+                {"poll_id": poll["poll_id"]},
+                {"$setOnInsert": {"poll_id": poll["poll_id"], "group_id": poll.get("group_id")}},
+                upsert=True
+            )
+            count += 1 if result.upserted_id else 0
+    return count
+
+
+def rebalance(db, shards, wait=ROUTE_CACHE_SECONDS):
+    """切換到新的分片配置並搬移受影響的群組
+    1. 補齊投票目錄
+    2. 將新配置下會換分片的群組固定在目前的分片，再更新雜湊環（此時沒有資料需要立即移動）
+    3. 逐一搬移被固定的群組到新配置下的分片
+    """
+    router = db.router
+    added = backfill_directory(db)
+    logger.info(f"補齊投票目錄: {added} 筆")
+
+    new_ring = HashRing(shards)
+    pins = router.pins()
+    for group_id in _all_groups(db):
+        current = router.shard_name(group_id)
+        if group_id not in pins and new_ring.lookup(group_id) != current:
+            router.pin(group_id, current)
+    router.set_shards(shards)
+    for shard in shards:
+        db.ensure_shard_indexes(shard)
+
+    moved = 0
+    for group_id, shard in router.pins().items():
+        target = new_ring.lookup(group_id)
+        if shard != target:
+            move_group(db, group_id, target, wait=wait)
+            moved += 1
+        else:
+            router.unpin(group_id)
+    logger.info(f"重新分配完成: 搬移 {moved} 個群組")
+    return moved
+
+
+def shard_status(db):
+    """各分片的負載分佈
+    返回:
+        [{shard, groups, polls, active_polls, members}]
+    行程內各分片的操作次數見 /metrics 的 shard.<分片>.ops
+    """
+    rows = []
+    for name in db.router.shard_names():
+        shard = db.client[name]
+        rows.append({
+            "shard": name,
+            "groups": len(shard['polls'].distinct("group_id")),
+            "polls": shard['polls'].estimated_document_count(),
+            "active_polls": shard['polls'].count_documents({"status": "active"}),
+            "members": shard['members'].estimated_document_count(),
+        })
+    return rows
+
+
+def main(argv=None):
+    from db import Database
+
+    parser = argparse.ArgumentParser(description="群組分片工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="顯示各分片的負載分佈")
+    rebalance_parser = subparsers.add_parser("rebalance", help="切換到新的分片配置並搬移群組")
+    rebalance_parser.add_argument("--shards", required=True, help="以逗號分隔的分片資料庫名稱")
+    move_parser = subparsers.add_parser("move", help="搬移單一群組")
+    move_parser.add_argument("--group", required=True, help="群組ID")
+    move_parser.add_argument("--to", required=True, help="目標分片資料庫名稱")
+    for sub in (rebalance_parser, move_parser):
+        sub.add_argument("--wait", type=float, default=ROUTE_CACHE_SECONDS, help="標記搬移中後等待的秒數")
+    args = parser.parse_args(argv)
+
+    db = Database()
+    try:
+        if args.command == "status":
+            pins = db.router.pins()
+            for row in shard_status(db):
+                print(f"{row['shard']}: {row['groups']} 個群組, {row['polls']} 個投票"
+                      f"（{row['active_polls']} 個進行中）, {row['members']} 位成員")
+            print(f"固定路由: {len(pins)} 個群組")
+        elif args.command == "rebalance":
+            rebalance(db, [s.strip() for s in args.shards.split(",") if s.strip()], wait=args.wait)
+        elif args.command == "move":
+            move_group(db, args.group, args.to, wait=args.wait)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
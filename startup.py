@@ -0,0 +1,190 @@
+"""
+啟動延遲載入與啟動時間分析
+
+- LazyModule / LazyObject：在第一次使用時才匯入模組或建立資源（資料庫連線、LINE API 客戶端）
+- phase()：記錄每個啟動階段的耗時和期間新匯入的模組數，`/startup` 指令可隨時查看
+- `python startup.py`：以 `-X importtime` 在子行程匯入 app，按頂層套件彙總匯入耗時
+"""
+import importlib
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# 行程啟動（本模組被匯入）的時間點
+T0 = time.perf_counter()
+
+# LAZY_STARTUP=1 時重量級模組和資源在第一次使用時才載入
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', '0') == '1'
+
+_phases = []
+_phases_lock = threading.Lock()
+_first_webhook = None
+_last_checkpoint = (T0, len(sys.modules))
+
+
+@contextmanager
+def phase(name):
+    """記錄一個啟動階段的耗時和新匯入的模組數"""
+    modules_before = len(sys.modules)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _phases_lock:
+            _phases.append({
+                "name": name,
+                "start_ms": round((start - T0) * 1000, 1),
+                "elapsed_ms": round(elapsed * 1000, 1),
+                "modules": len(sys.modules) - modules_before,
+                "thread": threading.current_thread().name,
+            })
+
+
+def checkpoint(name):
+    """記錄從上一個檢查點（或行程啟動）到現在的階段"""
+    global _last_checkpoint
+    now = time.perf_counter()
+    with _phases_lock:
+        start, modules_before = _last_checkpoint
+        _phases.append({
+            "name": name,
+            "start_ms": round((start - T0) * 1000, 1),
+            "elapsed_ms": round((now - start) * 1000, 1),
+            "modules": len(sys.modules) - modules_before,
+            "thread": threading.current_thread().name,
+        })
+        _last_checkpoint = (now, len(sys.modules))
+
+
+def mark_first_webhook():
+    """記錄第一個 webhook 處理完成的時間（只記錄一次）"""
+    global _first_webhook
+    if _first_webhook is None:
+        _first_webhook = round((time.perf_counter() - T0) * 1000, 1)
+
+
+class LazyModule:
+    """第一次存取屬性時才匯入的模組"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    with phase(f"import {self._name}"):
+                        self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+class LazyObject:
+    """第一次存取屬性時才呼叫工廠函數建立的對象"""
+
+    def __init__(self, name, factory):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_wrapped", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _setup(self):
+        if self._wrapped is None:
+            with self._lock:
+                if self._wrapped is None:
+                    with phase(f"init {self._name}"):
+                        object.__setattr__(self, "_wrapped", self._factory())
+        return self._wrapped
+
+    def __getattr__(self, attr):
+        return getattr(self._setup(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._setup(), attr, value)
+
+
+def lazy_module(name):
+    """LAZY_STARTUP 時返回延遲模組，否則立即匯入"""
+    if LAZY_STARTUP:
+        return LazyModule(name)
+    return importlib.import_module(name)
+
+
+def lazy_object(name, factory):
+    """LAZY_STARTUP 時返回延遲對象，否則立即建立"""
+    if LAZY_STARTUP:
+        return LazyObject(name, factory)
+    with phase(f"init {name}"):
+        return factory()
+
+
+def report():
+    """格式化啟動分析結果"""
+    with _phases_lock:
+        phases = list(_phases)
+    lines = [f"啟動模式: {'延遲載入' if LAZY_STARTUP else '立即載入'}"]
+    for item in phases:
+        lines.append(f"{item['start_ms']:>8.1f}ms +{item['elapsed_ms']:>7.1f}ms  {item['name']} ({item['modules']} 個模組)")
+    if _first_webhook is not None:
+        lines.append(f"第一個webhook完成: {_first_webhook}ms")
+    lines.append(f"已載入模組: {len(sys.modules)}")
+    return "\n".join(lines)
+
+
+# ===== -X importtime 分析 =====
+
+IMPORTTIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def importtime_breakdown(target="app", env=None):
+    """在子行程中以 -X importtime 匯入目標模組並按頂層套件彙總
+    返回:
+        [(套件, 自身耗時us, 模組數)]，依耗時倒序
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        capture_output=True, text=True, env=env or os.environ.copy(),
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    totals = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if not match:
+            continue
+        self_us = int(match.group(1))
+        package = match.group(4).split(".")[0]
+        total, count = totals.get(package, (0, 0))
+        totals[package] = (total + self_us, count + 1)
+    return sorted(((pkg, us, count) for pkg, (us, count) in totals.items()), key=lambda item: -item[1])
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="啟動時間分析")
+    parser.add_argument("--target", default="app", help="要匯入的模組")
+    parser.add_argument("--top", type=int, default=15, help="顯示前幾個套件")
+    args = parser.parse_args()
+
+    for lazy in ("0", "1"):
+        env = os.environ.copy()
+        env["LAZY_STARTUP"] = lazy
+        breakdown = importtime_breakdown(args.target, env)
+        total_ms = sum(us for _, us, _ in breakdown) / 1000
+        print(f"LAZY_STARTUP={lazy}: 匯入 {args.target} 共 {total_ms:.1f}ms")
+        for package, us, count in breakdown[:args.top]:
+            print(f"  {us / 1000:>8.1f}ms  {package} ({count} 個模組)")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+有名額投票的不變量測試
+
+對 MONGODB_URI 上的暫存資料庫（capacity_test）執行，連線不到MongoDB時略過：
+- 同時搶位不會超額，候補順位連續、不重複且與候補名單的順序一致
+- 出席者取消時恰好遞補一位（候補第一位），沒有候補時不遞補
+- 隨機改票後票數、名額和候補名單仍然一致
+- 已結束的投票不接受投票
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import random
+import sys
+import threading
+import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+import poll_schema
+
+TEST_DB = 'capacity_test'
+POLL_ID = "01JCAPACITYTEST00000000000"
+GROUP_ID = "C" + "0" * 32
+THREADS = 16
+
+
+def user_id(i):
+    return f"U{i:032x}"
+
+
+def _mongo_available(uri):
+    try:
+        client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=2000)
+        try:
+            client.admin.command('ping')
+        finally:
+            client.close()
+        return True
+    except PyMongoError:
+        return False
+
+
+class CapacityVoteTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        uri = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
+        if not _mongo_available(uri):
+            raise unittest.SkipTest(f"無法連線到MongoDB: {uri}")
+        cls._environ = {name: os.environ.get(name) for name in ('MONGODB_DB', 'MONGODB_SHARDS')}
+        os.environ['MONGODB_DB'] = TEST_DB
+        os.environ.pop('MONGODB_SHARDS', None)
+        from db import Database
+        cls.db = Database()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.client.drop_database(TEST_DB)
+        cls.db.close()
+        for name, value in cls._environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def reset_poll(self, capacity, status="active"):
+        self.db.db[self.db.polls_collection].delete_many({})
+        self.db.save_poll({"poll_id": POLL_ID, "title": "capacity", "group_id": GROUP_ID, "created_at": datetime.now(),
+                           "status": status, "version": 0, "capacity": capacity, "waitlist": [],
+                           **poll_schema.new_poll_fields()})
+
+    def vote(self, i, option):
+        success, result = self.db.add_capacity_vote(POLL_ID, user_id(i), option)
+        self.assertTrue(success)
+        return result
+
+    def concurrently(self, taps):
+        """以多個執行緒同時送出 [(用戶編號, 選項)]"""
+        barrier = threading.Barrier(min(len(taps), THREADS))
+
+        def tap(args):
+            try:
+                barrier.wait(timeout=2)
+            except threading.BrokenBarrierError:
+                pass
+            return self.vote(*args)
+
+        with ThreadPoolExecutor(max_workers=THREADS) as pool:
+            return list(pool.map(tap, taps))
+
+    def assert_invariants(self, poll):
+        voters = poll_schema.voters(poll)
+        counts = poll_schema.counts(poll)
+        queue = poll_schema.waitlist(poll)
+        expected = Counter(voters.values())
+        self.assertEqual(counts, {option: expected.get(option, 0) for option in poll_schema.OPTIONS})
+        self.assertLessEqual(counts["attend"], poll["capacity"])
+        self.assertEqual(len(set(queue)), len(queue))
+        self.assertFalse(set(queue) & set(voters))
+        if queue:
+            self.assertEqual(counts["attend"], poll["capacity"])
+        return counts, queue
+
+    def test_rush_never_oversubscribes(self):
+        capacity, users = 5, 40
+        self.reset_poll(capacity)
+        results = self.concurrently([(i, 'attend') for i in range(users)])
+
+        statuses = Counter(result.status for result in results)
+        self.assertEqual(statuses['attend'], capacity)
+        waiting = sorted((result.position, user_id(i)) for i, result in enumerate(results) if result.status == 'waitlist')
+        self.assertEqual([position for position, _ in waiting], list(range(1, users - capacity + 1)))
+
+        counts, queue = self.assert_invariants(self.db.get_poll(POLL_ID))
+        self.assertEqual(counts["attend"], capacity)
+        # 回覆的候補順位就是候補名單中的位置
+        self.assertEqual(queue, [user for _, user in waiting])
+
+    def test_cancel_promotes_exactly_one(self):
+        capacity, users = 3, 6
+        self.reset_poll(capacity)
+        for i in range(users):
+            self.vote(i, 'attend')
+        queue = poll_schema.waitlist(self.db.get_poll(POLL_ID))
+        self.assertEqual(queue, [user_id(i) for i in range(capacity, users)])
+
+        results = self.concurrently([(i, 'absent') for i in range(capacity)])
+        promoted = [result.promoted for result in results]
+        self.assertNotIn(None, promoted)
+        self.assertEqual(sorted(promoted), sorted(queue))
+
+        poll = self.db.get_poll(POLL_ID)
+        counts, remaining = self.assert_invariants(poll)
+        self.assertEqual(remaining, [])
+        self.assertEqual(set(poll_schema.option_voters(poll, 'attend')), set(queue))
+
+        # 沒有候補時取消不遞補
+        self.assertIsNone(self.vote(capacity, 'absent').promoted)
+        self.assertEqual(self.assert_invariants(self.db.get_poll(POLL_ID))[0]["attend"], capacity - 1)
+
+    def test_random_taps_keep_invariants(self):
+        capacity, users, taps = 8, 30, 600
+        self.reset_poll(capacity)
+        rng = random.Random(0)
+        plan = [(rng.randrange(users), rng.choice(['attend', 'attend', 'absent'])) for _ in range(taps)]
+        with ThreadPoolExecutor(max_workers=THREADS) as pool:
+            list(pool.map(lambda tap: self.vote(*tap), plan))
+
+        poll = self.db.get_poll(POLL_ID)
+        self.assert_invariants(poll)
+        # 每一票都使版本號遞增一次，沒有遺失的更新
+        self.assertEqual(poll["version"], taps)
+
+    def test_closed_poll_rejects_votes(self):
+        self.reset_poll(2, status="closed")
+        from db import VOTE_CLOSED
+        self.assertEqual(self.db.add_capacity_vote(POLL_ID, user_id(0), 'attend'), (False, VOTE_CLOSED))
+        self.assertEqual(poll_schema.voters(self.db.get_poll(POLL_ID)), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
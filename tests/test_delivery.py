@@ -0,0 +1,94 @@
+"""
+訊息投遞的測試（不需要 LINE 和 MongoDB）
+
+以記錄請求的 HTTP 客戶端檢查：
+- 帶 retry_key 的推送只在該次請求帶 X-Line-Retry-Key，之後的推送和回覆不會沿用
+- 回覆令牌只使用一次，第二則訊息改為推送
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot import LineBotApi
+from linebot.http_client import HttpClient, HttpResponse
+from linebot.models import TextSendMessage
+
+import delivery
+
+USER_ID = "U" + "0" * 32
+
+
+class _Response(HttpResponse):
+    status_code = 200
+    headers = {}
+    text = "{}"
+    content = b"{}"
+    json = {}
+
+    def iter_content(self, chunk_size=1024, decode_unicode=False):
+        return iter(())
+
+
+class RecordingHttpClient(HttpClient):
+    """記錄每次請求的路徑和標頭，一律回應 200"""
+
+    def __init__(self, timeout=None):
+        super().__init__(timeout=timeout)
+        self.requests = []
+
+    def _record(self, url, headers, data=None):
+        self.requests.append((url, dict(headers or {}), json.loads(data) if data else None))
+        return _Response()
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._record(url, headers)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._record(url, headers, data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._record(url, headers, data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._record(url, headers, data)
+
+
+class DeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.line_bot_api = LineBotApi("token", http_client=RecordingHttpClient)
+        self.requests = self.line_bot_api.http_client.requests
+
+    def test_retry_key_does_not_leak_to_later_requests(self):
+        message = TextSendMessage(text="結果")
+        self.assertEqual(delivery.send(self.line_bot_api, USER_ID, message, kind='result', retry_key="key-A"), 'push')
+        delivery.send(self.line_bot_api, USER_ID, message, kind='result')
+        delivery.received("token-1")
+        delivery.send(self.line_bot_api, USER_ID, message, reply_token="token-1", kind='confirmation')
+
+        (first_url, first, body), (_, second, _), (reply_url, reply, _) = self.requests
+        self.assertTrue(first_url.endswith("/v2/bot/message/push"))
+        self.assertEqual(first["X-Line-Retry-Key"], "key-A")
+        self.assertEqual(first["Authorization"], "Bearer token")
+        self.assertEqual(body["to"], USER_ID)
+        self.assertEqual(body["messages"], [message.as_json_dict()])
+        self.assertNotIn("X-Line-Retry-Key", second)
+        self.assertTrue(reply_url.endswith("/v2/bot/message/reply"))
+        self.assertNotIn("X-Line-Retry-Key", reply)
+        self.assertNotIn("X-Line-Retry-Key", self.line_bot_api.headers)
+
+    def test_reply_token_is_used_once(self):
+        delivery.received("token-2")
+        message = TextSendMessage(text="確認")
+        self.assertEqual(delivery.send(self.line_bot_api, USER_ID, message, reply_token="token-2"), 'reply')
+        self.assertEqual(delivery.send(self.line_bot_api, USER_ID, message, reply_token="token-2"), 'push')
+        self.assertEqual([url.rsplit("/", 1)[1] for url, _, _ in self.requests], ["reply", "push"])
+
+
+if __name__ == "__main__":
+    unittest.main()
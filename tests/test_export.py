@@ -0,0 +1,137 @@
+"""
+出席歷史匯出的測試（不需要 MongoDB）
+
+以假的 Database 執行 export.main：
+- 完整匯出 CSV / JSON Lines 並移除檢查點
+- 在投票寫到一半（已寫出列但尚未記錄檢查點）時中斷，--resume 先截斷到檢查點的大小再繼續，
+  結果與一次完整匯出相同，沒有重複或缺少的列
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import export
+import poll_schema
+
+
+def make_poll(group_id, index, voters):
+    return {"poll_id": f"01JEXPORT{index:017d}", "group_id": group_id, "title": f"練球 {index}",
+            "created_at": datetime(2026, 1, index + 1, 20), "updated_at": datetime(2026, 1, index + 1, 22),
+            "schema": poll_schema.SCHEMA_VERSION,
+            "v": {f"U{group_id[-1]}{index}{i:02d}": i % 2 for i in range(voters)}}
+
+
+POLLS = [make_poll("C1", i, 3 + i) for i in range(3)] + [make_poll("C2", i, 2) for i in range(3, 5)]
+
+
+class FakeDatabase:
+    """依 (group_id, poll_id) 排序返回已結束的投票"""
+
+    def __init__(self):
+        self.closed = False
+
+    def iter_closed_polls(self, group_id=None, since=None, until=None, after=None):
+        for poll in sorted(POLLS, key=lambda p: (p["group_id"], p["poll_id"])):
+            if group_id and poll["group_id"] != group_id:
+                continue
+            if after and (poll["group_id"], poll["poll_id"]) <= tuple(after):
+                continue
+            yield dict(poll)
+
+    def load_votes(self, poll):
+        return poll
+
+    def get_member_names(self, group_id):
+        return {f"U{group_id[-1]}000": "隊長"}
+
+    def close(self):
+        self.closed = True
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(export, "Database", FakeDatabase)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def read(self, path):
+        with open(path, encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def full_export(self, fmt, name):
+        output = self.path(name)
+        export.main(["--format", fmt, "--output", output])
+        return self.read(output)
+
+    def interrupted_export(self, fmt, output, fail_at):
+        """在第 fail_at 個投票寫出後、記錄檢查點前中斷"""
+        original = export.save_checkpoint
+        calls = []
+
+        def checkpoint(output, group_id, poll_id):
+            calls.append(poll_id)
+            if len(calls) == fail_at:
+                raise Interrupted()
+            original(output, group_id, poll_id)
+
+        with mock.patch.object(export, "save_checkpoint", checkpoint):
+            with self.assertRaises(Interrupted):
+                export.main(["--format", fmt, "--output", output])
+
+    def test_full_export(self):
+        text = self.full_export("csv", "full.csv")
+        lines = text.splitlines()
+        self.assertEqual(lines[0], ",".join(export.FIELDS))
+        self.assertEqual(len(lines) - 1, sum(len(poll["v"]) for poll in POLLS))
+        self.assertIn("隊長", text)
+        self.assertIn("✅出席", text)
+        self.assertFalse(os.path.exists(export._checkpoint_path(self.path("full.csv"))))
+
+        rows = [json.loads(line) for line in self.full_export("jsonl", "full.jsonl").splitlines()]
+        self.assertEqual([row["option_label"] for row in rows[:2]], ["✅出席", "❌請假"])
+        self.assertEqual(rows[0]["closed_at"], "2026-01-01T22:00:00")
+
+    def test_resume_truncates_partial_poll(self):
+        for fmt in ("csv", "jsonl"):
+            with self.subTest(fmt=fmt):
+                expected = self.full_export(fmt, f"expected.{fmt}")
+                output = self.path(f"resumed.{fmt}")
+                self.interrupted_export(fmt, output, fail_at=3)
+
+                # 中斷時第 3 個投票的列已寫出，但檢查點停在第 2 個投票
+                (group_id, poll_id), offset = export.load_checkpoint(output)
+                self.assertEqual(poll_id, POLLS[1]["poll_id"])
+                self.assertGreater(os.path.getsize(output), offset)
+
+                export.main(["--format", fmt, "--output", output, "--resume"])
+                self.assertEqual(self.read(output), expected)
+                self.assertFalse(os.path.exists(export._checkpoint_path(output)))
+
+    def test_resume_without_checkpoint_starts_over(self):
+        output = self.path("fresh.csv")
+        with open(output, "w", encoding="utf-8") as f:
+            f.write("舊的內容\n")
+        export.main(["--output", output, "--resume"])
+        self.assertEqual(self.read(output), self.full_export("csv", "expected.csv"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+唯讀查詢API的測試（不需要 MongoDB）
+
+以假的 Database 呼叫 history_api.handle：
+- 未設定 API_TOKEN 時不開放，令牌錯誤時返回 401
+- ETag / If-None-Match 和 Last-Modified / If-Modified-Since 相符時返回 304，且不讀取文件
+- 投票變更後 ETag 隨之改變
+- 投票列表依 (created_at, poll_id) 由新到舊分頁，舊式數字ID和 ULID 混合時仍依時間排序
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import history_api
+import poll_schema
+
+TOKEN = "test-token"
+GROUP_ID = "C" + "0" * 32
+AUTH = {"authorization": f"Bearer {TOKEN}"}
+
+
+class FakeDatabase:
+    """只實作API使用的查詢，並記錄是否讀取了文件"""
+
+    def __init__(self, polls):
+        self.polls = {poll["poll_id"]: poll for poll in polls}
+        self.document_reads = 0
+
+    def poll_versions(self, group_id, status=None, before=None, limit=50):
+        polls = [poll for poll in self.polls.values()
+                 if poll["group_id"] == group_id and (status is None or poll["status"] == status)]
+        polls.sort(key=lambda poll: (poll["created_at"], poll["poll_id"]), reverse=True)
+        if before:
+            polls = [poll for poll in polls if (poll["created_at"], poll["poll_id"]) < before]
+        return [{key: poll[key] for key in ("poll_id", "created_at", "updated_at")} for poll in polls[:limit]]
+
+    def get_poll_summaries(self, group_id, poll_ids):
+        self.document_reads += 1
+        return {poll_id: {"poll_id": poll_id, "title": self.polls[poll_id]["title"]} for poll_id in poll_ids}
+
+    def poll_version(self, poll_id):
+        poll = self.polls.get(poll_id)
+        return (True, poll["updated_at"]) if poll else (False, None)
+
+    def get_poll(self, poll_id):
+        self.document_reads += 1
+        return self.polls.get(poll_id)
+
+    def load_votes(self, poll):
+        return poll
+
+    def get_member_names(self, group_id):
+        return {"U1": "隊長"}
+
+
+def make_poll(poll_id, created_at, status="closed"):
+    return {"poll_id": poll_id, "group_id": GROUP_ID, "title": f"練球 {poll_id}", "status": status,
+            "created_at": created_at, "updated_at": created_at + timedelta(hours=2),
+            "schema": poll_schema.SCHEMA_VERSION, "v": {"U1": 0, "U2": 1}, "counts": {"attend": 1, "absent": 1}}
+
+
+START = datetime(2026, 3, 1, 20)
+# 舊式的秒級數字ID排在字串順序的最後，但建立時間最早
+POLLS = [make_poll("1700000000", START), make_poll("1700086400", START + timedelta(days=1))] + [
+    make_poll(f"01JHISTORY{i:016d}", START + timedelta(days=2 + i)) for i in range(4)
+] + [make_poll("01JHISTORY9999999999999999", START + timedelta(days=5))]
+
+
+class HistoryApiTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(history_api, "API_TOKEN", TOKEN)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = FakeDatabase([dict(poll) for poll in POLLS])
+
+    def get(self, path, args=None, headers=None, method="GET"):
+        return history_api.handle(self.db, method, path, args or {}, {**AUTH, **(headers or {})})
+
+    def test_authorization(self):
+        with mock.patch.object(history_api, "API_TOKEN", None):
+            self.assertEqual(self.get(f"/api/polls/{POLLS[0]['poll_id']}")[0], 404)
+        status, _, _ = history_api.handle(self.db, "GET", f"/api/polls/{POLLS[0]['poll_id']}", {},
+                                          {"authorization": "Bearer wrong"})
+        self.assertEqual(status, 401)
+        self.assertEqual(self.get("/api/unknown")[0], 404)
+        self.assertEqual(self.get(f"/api/polls/{POLLS[0]['poll_id']}", method="POST")[0], 405)
+
+    def test_etag_returns_304_without_reading_documents(self):
+        path = f"/api/polls/{POLLS[0]['poll_id']}"
+        status, headers, body = self.get(path)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["voters"]["attend"], [{"user_id": "U1", "name": "隊長"}])
+        reads = self.db.document_reads
+
+        status, not_modified_headers, body = self.get(path, headers={"if-none-match": headers["ETag"]})
+        self.assertEqual((status, body), (304, b""))
+        self.assertEqual(not_modified_headers["ETag"], headers["ETag"])
+        self.assertEqual(self.db.document_reads, reads)
+        self.assertEqual(self.get(path, headers={"if-none-match": f'"other", W/{headers["ETag"]}'})[0], 304)
+
+        # 投票變更後 ETag 改變
+        self.db.polls[POLLS[0]["poll_id"]]["updated_at"] += timedelta(minutes=1)
+        status, changed_headers, _ = self.get(path, headers={"if-none-match": headers["ETag"]})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(changed_headers["ETag"], headers["ETag"])
+
+    def test_if_modified_since(self):
+        path = f"/api/groups/{GROUP_ID}/polls"
+        status, headers, _ = self.get(path)
+        self.assertEqual(status, 200)
+        last_modified = headers["Last-Modified"]
+        self.assertEqual(self.get(path, headers={"if-modified-since": last_modified})[0], 304)
+
+        earlier = format_datetime(POLLS[-1]["updated_at"].astimezone() - timedelta(seconds=1), usegmt=True)
+        self.assertEqual(self.get(path, headers={"if-modified-since": earlier})[0], 200)
+        self.assertEqual(self.get(path, headers={"if-modified-since": "not a date"})[0], 200)
+        # 有 If-None-Match 時只比對 ETag
+        self.assertEqual(self.get(path, headers={"if-none-match": '"other"', "if-modified-since": last_modified})[0], 200)
+
+    def test_head_has_no_body(self):
+        status, headers, body = self.get(f"/api/groups/{GROUP_ID}/polls", method="HEAD")
+        self.assertEqual((status, body), (200, b""))
+        self.assertIn("ETag", headers)
+
+    def test_poll_pages_follow_creation_time(self):
+        poll_ids, cursor = [], None
+        while True:
+            args = {"limit": "2", **({"cursor": cursor} if cursor else {})}
+            status, _, body = self.get(f"/api/groups/{GROUP_ID}/polls", args)
+            self.assertEqual(status, 200)
+            page = json.loads(body)
+            poll_ids += [poll["poll_id"] for poll in page["polls"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        expected = [poll["poll_id"] for poll in sorted(POLLS, key=lambda p: (p["created_at"], p["poll_id"]), reverse=True)]
+        self.assertEqual(poll_ids, expected)
+        self.assertEqual(poll_ids[-2:], ["1700086400", "1700000000"])
+
+    def test_pages_have_distinct_etags(self):
+        path = f"/api/groups/{GROUP_ID}/polls"
+        _, first, body = self.get(path, {"limit": "2"})
+        _, second, _ = self.get(path, {"limit": "2", "cursor": json.loads(body)["next_cursor"]})
+        self.assertNotEqual(first["ETag"], second["ETag"])
+
+    def test_invalid_arguments(self):
+        path = f"/api/groups/{GROUP_ID}/polls"
+        for args in ({"cursor": "@@@"}, {"cursor": history_api._encode_cursor("1700000000")},
+                     {"limit": "0"}, {"limit": "many"}, {"status": "deleted"}):
+            self.assertEqual(self.get(path, args)[0], 400, args)
+        self.assertEqual(self.get("/api/polls/missing")[0], 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
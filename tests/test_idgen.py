@@ -0,0 +1,71 @@
+"""
+投票ID產生器的測試（不需要 MongoDB）
+
+- 同一毫秒內產生的ID仍然遞增，時鐘回撥時不會倒退
+- 字典序即為時間序，可取回建立時間
+- 舊式的秒級數字ID同樣能取出時間
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import idgen
+
+NOW_MS = 1_700_000_000_000
+
+
+class IdGenTest(unittest.TestCase):
+
+    def setUp(self):
+        idgen._reset_state()
+
+    def test_format(self):
+        poll_id = idgen.new_id(NOW_MS)
+        self.assertEqual(len(poll_id), idgen.TIME_LEN + idgen.RANDOM_LEN)
+        self.assertTrue(set(poll_id) <= set(idgen.ENCODING))
+        self.assertNotIn("_", poll_id)
+
+    def test_monotonic_within_same_millisecond(self):
+        ids = [idgen.new_id(NOW_MS) for _ in range(1000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual({idgen.id_timestamp(poll_id) for poll_id in ids}, {NOW_MS})
+
+    def test_clock_going_backwards_does_not_reorder(self):
+        first = idgen.new_id(NOW_MS)
+        second = idgen.new_id(NOW_MS - 5000)
+        self.assertLess(first, second)
+        self.assertEqual(idgen.id_timestamp(second), NOW_MS)
+
+    def test_random_overflow_borrows_next_millisecond(self):
+        idgen.new_id(NOW_MS)
+        idgen._last_random = idgen.RANDOM_MAX
+        poll_id = idgen.new_id(NOW_MS)
+        self.assertEqual(idgen.id_timestamp(poll_id), NOW_MS + 1)
+
+    def test_lexical_order_is_time_order(self):
+        times = [NOW_MS + step for step in (0, 1, 999, 1000, 86_400_000, 31_536_000_000)]
+        ids = [idgen.new_id(ms) for ms in times]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([idgen.id_timestamp(poll_id) for poll_id in ids], times)
+
+    def test_unique_across_threads(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            ids = list(pool.map(lambda _: idgen.new_id(NOW_MS), range(2000)))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_timestamp_of_legacy_and_invalid_ids(self):
+        self.assertEqual(idgen.id_timestamp("1700000000"), NOW_MS)
+        self.assertEqual(idgen.id_timestamp(idgen.new_id(NOW_MS).lower()), NOW_MS)
+        self.assertIsNone(idgen.id_timestamp(""))
+        self.assertIsNone(idgen.id_timestamp(None))
+        self.assertIsNone(idgen.id_timestamp("not-an-id!"))
+
+
+if __name__ == "__main__":
+    unittest.main()
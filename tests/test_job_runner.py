@@ -0,0 +1,158 @@
+"""
+排程任務執行器的測試（不需要 LINE 和 MongoDB）
+
+- skip: 上一次仍在執行時略過並記錄 skipped
+- queue: 執行中多次到期只排入一次，結束後再執行
+- allow: 允許同時執行
+- 逾時後設定取消旗標；任務返回前執行位置不釋放，skip 的任務不會同時執行兩份
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+import job_runner
+from job_runner import JobRunner
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class GatedTask:
+    """每次執行時計數，並等待 gate 打開才返回"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            self.gate.wait(5)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+class JobRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = JobRunner(max_workers=4)
+
+    def tearDown(self):
+        self.runner.shutdown(wait=True)
+
+    def idle(self, name):
+        return wait_until(lambda: self.runner.jobs[name].running == 0)
+
+    def test_skip_policy(self):
+        task = GatedTask()
+        trigger = self.runner.add("test_skip", task, timeout=5, overlap='skip')
+        skipped = metrics.get("scheduler.test_skip.skipped")
+        trigger()
+        self.assertTrue(wait_until(lambda: task.calls == 1))
+        self.assertFalse(self.runner.submit(self.runner.jobs["test_skip"]))
+        self.assertEqual(metrics.get("scheduler.test_skip.skipped"), skipped + 1)
+
+        task.gate.set()
+        self.assertTrue(self.idle("test_skip"))
+        self.assertEqual(task.calls, 1)
+        self.assertEqual(self.runner.jobs["test_skip"].last_outcome, 'ok')
+
+    def test_queue_policy_runs_once_more(self):
+        task = GatedTask()
+        trigger = self.runner.add("test_queue", task, timeout=5, overlap='queue')
+        trigger()
+        self.assertTrue(wait_until(lambda: task.calls == 1))
+        for _ in range(3):
+            self.assertFalse(self.runner.submit(self.runner.jobs["test_queue"]))
+        self.assertTrue(self.runner.jobs["test_queue"].queued)
+
+        task.gate.set()
+        self.assertTrue(wait_until(lambda: task.calls == 2))
+        self.assertTrue(self.idle("test_queue"))
+        self.assertEqual(task.calls, 2)
+        self.assertEqual(task.max_active, 1)
+        self.assertFalse(self.runner.jobs["test_queue"].queued)
+
+    def test_allow_policy_runs_concurrently(self):
+        task = GatedTask()
+        trigger = self.runner.add("test_allow", task, timeout=5, overlap='allow')
+        trigger()
+        trigger()
+        self.assertTrue(wait_until(lambda: task.active == 2))
+        self.assertEqual(self.runner.jobs["test_allow"].running, 2)
+        task.gate.set()
+        self.assertTrue(self.idle("test_allow"))
+
+    def test_timeout_sets_cancel_flag(self):
+        seen = []
+
+        def cooperative():
+            while not job_runner.cancelled():
+                time.sleep(0.01)
+            seen.append(True)
+
+        trigger = self.runner.add("test_timeout", cooperative, timeout=0.1)
+        timeouts = metrics.get("scheduler.test_timeout.timeout")
+        trigger()
+        self.assertTrue(wait_until(lambda: seen))
+        self.assertTrue(self.idle("test_timeout"))
+        job = self.runner.jobs["test_timeout"]
+        self.assertEqual(job.last_outcome, 'timeout')
+        self.assertEqual(metrics.get("scheduler.test_timeout.timeout"), timeouts + 1)
+        self.assertFalse(job_runner.cancelled())
+
+    def test_timed_out_job_keeps_its_slot(self):
+        task = GatedTask()
+        trigger = self.runner.add("test_slot", task, timeout=0.05, overlap='skip')
+        trigger()
+        job = self.runner.jobs["test_slot"]
+        self.assertTrue(wait_until(lambda: job.last_outcome == 'timeout'))
+        # 逾時的那次還沒返回，不會開始第二份
+        self.assertFalse(self.runner.submit(job))
+        self.assertEqual(task.calls, 1)
+
+        self.assertEqual(job.last_outcome, 'skipped')
+
+        task.gate.set()
+        self.assertTrue(self.idle("test_slot"))
+        self.assertTrue(self.runner.submit(job))
+        self.assertTrue(self.idle("test_slot"))
+        self.assertEqual(task.calls, 2)
+
+    def test_errors_are_recorded(self):
+        def failing():
+            raise RuntimeError("失敗")
+
+        trigger = self.runner.add("test_error", failing, timeout=5)
+        with self.assertLogs("job_runner", level="ERROR"):
+            trigger()
+            self.assertTrue(wait_until(lambda: self.runner.jobs["test_error"].last_outcome == 'error'))
+        self.assertTrue(self.idle("test_error"))
+
+    def test_unknown_overlap_policy(self):
+        with self.assertRaises(ValueError):
+            self.runner.add("test_unknown", lambda: None, timeout=5, overlap='replace')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+發件匣批次規劃的測試（不需要 LINE 和 MongoDB）
+
+- 同一接收者的訊息合併為每次最多 5 則的推送，一筆訊息不會被拆開
+- 額度吃緊時文字通知先合併再計算則數
+- 新批次的每筆訊息寫入同一個重試令牌；重試時沿用原批次、令牌和合併方式
+- 回覆令牌只在第一次投遞且未過期時使用
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox
+
+
+class FakeCollection:
+    """記錄 update_many 的呼叫"""
+
+    def __init__(self):
+        self.updates = []
+
+    def update_many(self, query, update):
+        self.updates.append((query, update))
+
+
+def entry(_id, to="G1", kind="result", messages=1, **fields):
+    return {"_id": _id, "to": to, "kind": kind, "attempts": 1,
+            "messages": [{"type": "flex", "altText": f"{_id}-{i}", "contents": {}} for i in range(messages)], **fields}
+
+
+def note(_id, text, to="DEV"):
+    return {"_id": _id, "to": to, "kind": "note", "attempts": 1, "messages": [{"type": "text", "text": text}]}
+
+
+def batch_ids(batches):
+    return [(to, [item["_id"] for item in batch]) for to, batch in batches]
+
+
+class GroupBatchesTest(unittest.TestCase):
+
+    def test_push_limit_per_recipient(self):
+        entries = [entry(i) for i in range(7)] + [entry(10, to="G2"), entry(11, to="G2")]
+        self.assertEqual(batch_ids(outbox._group_batches(entries)),
+                         [("G1", [0, 1, 2, 3, 4]), ("G1", [5, 6]), ("G2", [10, 11])])
+
+    def test_entries_are_not_split(self):
+        entries = [entry(0, messages=3), entry(1, messages=3), entry(2, messages=2)]
+        self.assertEqual(batch_ids(outbox._group_batches(entries)), [("G1", [0]), ("G1", [1, 2])])
+
+    def test_merged_notes_count_after_merging(self):
+        notes = [note(i, f"通知 {i}") for i in range(8)]
+        self.assertEqual(batch_ids(outbox._group_batches(notes)), [("DEV", [0, 1, 2, 3, 4]), ("DEV", [5, 6, 7])])
+        batches = outbox._group_batches(notes, merge_notes=True)
+        self.assertEqual(batch_ids(batches), [("DEV", list(range(8)))])
+        messages = outbox._batch_messages(batches[0][1], merge_notes=True)
+        self.assertEqual(messages, [{"type": "text", "text": "\n\n".join(f"通知 {i}" for i in range(8))}])
+
+    def test_merged_notes_respect_text_length(self):
+        long_text = "x" * (outbox.TEXT_MAX_LENGTH // 2)
+        notes = [note(i, long_text) for i in range(12)]
+        for _, batch in outbox._group_batches(notes, merge_notes=True):
+            messages = outbox._batch_messages(batch, merge_notes=True)
+            self.assertLessEqual(len(messages), outbox.PUSH_MAX_MESSAGES)
+            self.assertTrue(all(len(message["text"]) <= outbox.TEXT_MAX_LENGTH for message in messages))
+
+
+class PlanBatchesTest(unittest.TestCase):
+
+    def test_fresh_batches_get_one_retry_key_each(self):
+        collection = FakeCollection()
+        entries = [entry(i) for i in range(7)]
+        batches = outbox._plan_batches(collection, entries, merge_notes=False)
+
+        self.assertEqual([[item["_id"] for item in batch] for _, batch, _ in batches], [[0, 1, 2, 3, 4], [5, 6]])
+        for _, batch, _ in batches:
+            self.assertEqual(len({item["retry_key"] for item in batch}), 1)
+        keys = [batch[0]["retry_key"] for _, batch, _ in batches]
+        self.assertNotEqual(keys[0], keys[1])
+        # 推送前寫入重試令牌和合併方式
+        self.assertEqual([(query["_id"]["$in"], update["$set"]) for query, update in collection.updates], [
+            ([0, 1, 2, 3, 4], {"retry_key": keys[0], "merged": False}),
+            ([5, 6], {"retry_key": keys[1], "merged": False}),
+        ])
+
+    def test_retried_batches_keep_key_and_merge_mode(self):
+        collection = FakeCollection()
+        entries = [note(0, "a"), note(1, "b"), entry(2, to="G1")]
+        for item in entries[:2]:
+            item.update(retry_key="key-A", merged=True, attempts=2)
+        batches = outbox._plan_batches(collection, entries, merge_notes=False)
+
+        to, batch, merged = batches[0]
+        self.assertEqual((to, [item["_id"] for item in batch], merged), ("DEV", [0, 1], True))
+        self.assertTrue(all(item["retry_key"] == "key-A" for item in batch))
+        # 只有新的批次需要寫入令牌
+        self.assertEqual([query["_id"]["$in"] for query, _ in collection.updates], [[2]])
+        self.assertNotEqual(batches[1][1][0]["retry_key"], "key-A")
+
+
+class ReplyTokenTest(unittest.TestCase):
+
+    def test_only_fresh_tokens_on_first_attempt(self):
+        now = datetime.now()
+        valid = now + timedelta(seconds=30)
+        self.assertEqual(outbox._reply_token([entry(0), entry(1, reply_token="t1", reply_by=valid)], now), "t1")
+        self.assertIsNone(outbox._reply_token([entry(0, reply_token="t1", reply_by=now - timedelta(seconds=1))], now))
+        self.assertIsNone(outbox._reply_token([entry(0, reply_token="t1", reply_by=valid, attempts=2)], now))
+
+
+if __name__ == "__main__":
+    unittest.main()
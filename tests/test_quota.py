@@ -0,0 +1,146 @@
+"""
+訊息額度預算模式的測試（不需要 LINE 和 MongoDB）
+
+- 依剩餘額度和推估的月底用量切換 normal / saving / critical
+- 各模式下允許推送和延後的訊息類型
+- 推送依接收者計費（群組按成員數），回覆不計費
+- QUOTA_STUB 時以本地的額度端點校正
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quota
+
+GROUP_ID = "C" + "0" * 32
+USER_ID = "U" + "0" * 32
+
+
+class FixedDatetime(datetime):
+    """4 月 16 日 0 時：本月已過一半，推估的月底用量為目前的兩倍"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 4, 16)
+
+
+class FakeLineBotApi:
+
+    def __init__(self, members=10, fail=False):
+        self.members = members
+        self.fail = fail
+        self.lookups = 0
+
+    def get_group_members_count(self, group_id):
+        self.lookups += 1
+        if self.fail:
+            raise RuntimeError("LINE 無法連線")
+        return self.members
+
+
+class QuotaTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(quota, "datetime", FixedDatetime)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.reset)
+        self.reset()
+
+    def reset(self):
+        quota._state.update(month=(2026, 4), limit=quota.LOCAL_LIMIT, reconciled_usage=0, local_usage=0,
+                            reconciled_at=None)
+        quota._by_kind.clear()
+        quota._by_recipient.clear()
+        quota._member_counts.clear()
+        quota._last_digest = None
+
+    def set_usage(self, usage, limit=1000):
+        quota._state.update(limit=limit, reconciled_usage=usage)
+
+    def test_mode_thresholds(self):
+        cases = [
+            (None, 5000, 'normal'),   # 不限量
+            (1000, 400, 'normal'),    # 推估 800
+            (1000, 500, 'normal'),    # 推估正好等於額度
+            (1000, 501, 'saving'),    # 推估 1002
+            (1000, 949, 'saving'),
+            (1000, 950, 'critical'),  # 剩餘 5%
+            (1000, 1200, 'critical'),
+        ]
+        for limit, usage, expected in cases:
+            self.set_usage(usage, limit)
+            self.assertEqual(quota.mode(), expected, (limit, usage))
+
+    def test_forecast_counts_at_least_one_day(self):
+        self.set_usage(10)
+        self.assertEqual(quota.forecast(FixedDatetime(2026, 4, 1, 1)), 300)
+        self.assertEqual(quota.forecast(FixedDatetime(2026, 4, 16)), 20)
+
+    def test_allowed_kinds_per_mode(self):
+        self.set_usage(100)
+        self.assertTrue(all(quota.allow_push(kind) for kind in ('confirmation', 'note', 'outbox.result')))
+        self.assertEqual(quota.deferred_kinds(), [])
+        self.assertFalse(quota.merging_notes())
+
+        self.set_usage(600)
+        self.assertFalse(quota.allow_push('confirmation'))
+        self.assertTrue(quota.allow_push('outbox.note'))
+        self.assertTrue(quota.merging_notes())
+
+        self.set_usage(990)
+        self.assertEqual([kind for kind in ('poll', 'outbox.result', 'promotion', 'outbox.note', 'confirmation')
+                          if quota.allow_push(kind)], ['poll', 'outbox.result', 'promotion'])
+        self.assertEqual(quota.deferred_kinds(), ['note'])
+
+    def test_saving_mode_defers_notes_until_digest(self):
+        self.set_usage(600)
+        # 尚未送過摘要：通知可以取出合併推送
+        self.assertEqual(quota.deferred_kinds(), [])
+        quota.digest_sent()
+        self.assertEqual(quota.deferred_kinds(), ['note'])
+        quota._last_digest = time.monotonic() - quota.DIGEST_MINUTES * 60 - 1
+        self.assertEqual(quota.deferred_kinds(), [])
+
+    def test_push_cost_per_recipient(self):
+        api = FakeLineBotApi(members=12)
+        quota.record(api, 'confirmation', USER_ID, 'reply')
+        quota.record(api, 'outbox.result', GROUP_ID, 'push')
+        quota.record(api, 'outbox.result', GROUP_ID, 'push')
+        quota.record(api, 'note', USER_ID, 'push')
+
+        self.assertEqual(quota.usage(), 25)
+        self.assertEqual(dict(quota._by_kind), {'result': 24, 'note': 1})
+        # 成員數有快取
+        self.assertEqual(api.lookups, 1)
+
+    def test_member_count_failure_counts_one(self):
+        with self.assertLogs("quota", level="WARNING"):
+            quota.record(FakeLineBotApi(fail=True), 'result', GROUP_ID, 'push')
+        self.assertEqual(quota.usage(), 1)
+
+    def test_new_month_resets_usage(self):
+        quota._state.update(month=(2026, 3), reconciled_usage=800)
+        quota._by_kind['result'] = 800
+        self.assertEqual(quota.usage(), 0)
+        self.assertEqual(dict(quota._by_kind), {})
+
+    def test_stub_reconcile(self):
+        with mock.patch.multiple(quota, STUB=True, LOCAL_LIMIT=1000, STUB_USAGE=300):
+            quota.record(FakeLineBotApi(members=5), 'result', GROUP_ID, 'push')
+            quota.reconcile(line_bot_api=None)
+            self.assertEqual(quota.limit(), 1000)
+            self.assertEqual(quota.usage(), 305)
+            self.assertEqual(quota._state["local_usage"], 0)
+            self.assertEqual(quota.mode(), 'normal')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+投票結果分頁的測試（不需要 LINE 和 MongoDB）
+
+- 名單少時只有一個 bubble
+- 每個 bubble 不超過 30KB，carousel 不超過 12 個 bubble 及 50KB
+- 分頁後名單完整、不重複且保持順序
+- 每次推送最多 5 則訊息
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import poll_schema
+import results_renderer
+from results_renderer import _size
+
+
+def make_poll(attend, absent):
+    v = {f"A{i}": 0 for i in range(attend)}
+    v.update({f"B{i}": 1 for i in range(absent)})
+    return {"poll_id": "01JRENDERTEST0000000000000", "title": "週六練球", "schema": poll_schema.SCHEMA_VERSION,
+            "v": v, "counts": {"attend": attend, "absent": absent}}
+
+
+def make_names(prefix, count):
+    # 每個名字約 60 位元組（中文字在 UTF-8 中佔 3 位元組）
+    return [f"{prefix}{i:04d}" + "排球隊員" * 4 for i in range(count)]
+
+
+def bubbles_of(messages):
+    for contents in messages:
+        if contents["type"] == "carousel":
+            yield from contents["contents"]
+        else:
+            yield contents
+
+
+def listed_names(messages):
+    """依序取出各頁參與者名單中的名字 {label: [names]}"""
+    names = {}
+    for bubble in bubbles_of(messages):
+        for box in bubble["body"]["contents"]:
+            contents = box.get("contents", [])
+            if len(contents) < 2 or contents[1].get("text") != "Participants:":
+                continue
+            for section in contents[2]["contents"]:
+                label, text = section["contents"][0]["text"], section["contents"][1]["text"]
+                names.setdefault(label, []).extend(text.split("\n"))
+    return names
+
+
+class ResultsRendererTest(unittest.TestCase):
+
+    def render(self, attend, absent):
+        names = {"attend": make_names("出", attend), "absent": make_names("假", absent)}
+        return names, results_renderer.render_results(make_poll(attend, absent), names)
+
+    def assert_within_limits(self, messages):
+        for contents in messages:
+            if contents["type"] == "carousel":
+                self.assertLessEqual(len(contents["contents"]), results_renderer.CAROUSEL_MAX_BUBBLES)
+                self.assertLessEqual(_size(contents), results_renderer.CAROUSEL_MAX_BYTES)
+        for bubble in bubbles_of(messages):
+            self.assertLessEqual(_size(bubble), results_renderer.BUBBLE_MAX_BYTES)
+
+    def test_small_poll_is_single_bubble(self):
+        names, messages = self.render(5, 3)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["type"], "bubble")
+        self.assertEqual(listed_names(messages), {"✅出席": names["attend"], "❌請假": names["absent"]})
+
+    def test_empty_poll_renders_summary(self):
+        messages = results_renderer.render_results(make_poll(0, 0), {})
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(listed_names(messages), {})
+
+    def test_large_poll_pages_by_bytes(self):
+        names, messages = self.render(1200, 800)
+        bubbles = list(bubbles_of(messages))
+        self.assertGreater(len(bubbles), 1)
+        self.assert_within_limits(messages)
+        self.assertEqual(listed_names(messages), {"✅出席": names["attend"], "❌請假": names["absent"]})
+
+    def test_carousel_bubble_limit(self):
+        # 縮小單頁預算，使 carousel 先達到 12 個 bubble 的上限
+        with mock.patch.object(results_renderer, "BUBBLE_MAX_BYTES", 3 * 1024):
+            names, messages = self.render(400, 200)
+            self.assert_within_limits(messages)
+        self.assertGreater(len(messages), 1)
+        self.assertEqual(len(messages[0]["contents"]), results_renderer.CAROUSEL_MAX_BUBBLES)
+        self.assertEqual(listed_names(messages), {"✅出席": names["attend"], "❌請假": names["absent"]})
+
+    def test_push_batches(self):
+        with mock.patch.object(results_renderer, "BUBBLE_MAX_BYTES", 3 * 1024):
+            _, messages = self.render(2000, 1000)
+        batches = results_renderer.serialize_messages(make_poll(0, 0), messages)
+        self.assertGreater(len(batches), 1)
+        self.assertTrue(all(len(batch) <= results_renderer.PUSH_MAX_MESSAGES for batch in batches))
+        self.assertEqual([message["contents"] for batch in batches for message in batch], messages)
+        self.assertTrue(all(message["type"] == "flex" for batch in batches for message in batch))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+投票點擊合併的測試（不需要 LINE 和 MongoDB）
+
+- 視窗內的連續點擊只寫入一次，使用最後的選項和回覆令牌
+- 不同用戶或不同投票各自計時
+- flush_all 立即寫入所有等待中的投票，計時器到期時不會重複寫入
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vote_debounce import VoteDebouncer
+
+POLL_ID = "01JDEBOUNCETEST00000000000"
+
+
+class RecordingFlush:
+    """記錄每次 flush 的參數，flush 次數達到 expected 時通知"""
+
+    def __init__(self, expected=1):
+        self.calls = []
+        self.expected = expected
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, poll_id, vote, user_id, reply_token, line_bot_api, db, private=False):
+        with self._lock:
+            self.calls.append((poll_id, vote, user_id, reply_token, private))
+            if len(self.calls) >= self.expected:
+                self.done.set()
+
+
+class VoteDebounceTest(unittest.TestCase):
+
+    def test_disabled_when_window_is_zero(self):
+        self.assertFalse(VoteDebouncer(0, RecordingFlush()).enabled)
+        self.assertTrue(VoteDebouncer(0.5, RecordingFlush()).enabled)
+
+    def test_taps_within_window_are_coalesced(self):
+        flush = RecordingFlush()
+        debouncer = VoteDebouncer(0.2, flush)
+        self.assertTrue(debouncer.submit(POLL_ID, "U1", "attend", "token-1", None, None))
+        self.assertFalse(debouncer.submit(POLL_ID, "U1", "absent", "token-2", None, None))
+        self.assertFalse(debouncer.submit(POLL_ID, "U1", "attend", "token-3", None, None, private=True))
+        self.assertEqual(debouncer.pending_count(), 1)
+
+        self.assertTrue(flush.done.wait(2))
+        self.assertEqual(flush.calls, [(POLL_ID, "attend", "U1", "token-3", True)])
+        self.assertEqual(debouncer.pending_count(), 0)
+
+    def test_keys_are_independent(self):
+        flush = RecordingFlush(expected=3)
+        debouncer = VoteDebouncer(0.1, flush)
+        self.assertTrue(debouncer.submit(POLL_ID, "U1", "attend", "t1", None, None))
+        self.assertTrue(debouncer.submit(POLL_ID, "U2", "absent", "t2", None, None))
+        self.assertTrue(debouncer.submit("01JOTHERPOLL00000000000000", "U1", "absent", "t3", None, None))
+
+        self.assertTrue(flush.done.wait(2))
+        self.assertEqual(sorted(call[:3] for call in flush.calls),
+                         sorted([(POLL_ID, "attend", "U1"), (POLL_ID, "absent", "U2"),
+                                 ("01JOTHERPOLL00000000000000", "absent", "U1")]))
+
+    def test_new_window_after_flush(self):
+        flush = RecordingFlush(expected=2)
+        debouncer = VoteDebouncer(60, flush)
+        debouncer.submit(POLL_ID, "U1", "attend", "t1", None, None)
+        debouncer.flush_all()
+        self.assertTrue(debouncer.submit(POLL_ID, "U1", "absent", "t2", None, None))
+        debouncer.flush_all()
+        self.assertEqual([call[1] for call in flush.calls], ["attend", "absent"])
+
+    def test_flush_all_writes_pending_votes_once(self):
+        flush = RecordingFlush()
+        debouncer = VoteDebouncer(0.2, flush)
+        debouncer.submit(POLL_ID, "U1", "attend", "t1", None, None)
+        debouncer.submit(POLL_ID, "U2", "attend", "t2", None, None)
+        debouncer.submit(POLL_ID, "U1", "absent", "t3", None, None)
+
+        debouncer.flush_all()
+        self.assertEqual(debouncer.pending_count(), 0)
+        self.assertEqual(sorted(call[1:4] for call in flush.calls),
+                         [("absent", "U1", "t3"), ("attend", "U2", "t2")])
+        # 計時器到期時已沒有等待中的投票
+        time.sleep(0.4)
+        self.assertEqual(len(flush.calls), 2)
+
+    def test_flush_errors_do_not_leave_pending(self):
+        def failing_flush(*args, **kwargs):
+            raise RuntimeError("寫入失敗")
+
+        debouncer = VoteDebouncer(60, failing_flush)
+        debouncer.submit(POLL_ID, "U1", "attend", "t1", None, None)
+        with self.assertLogs("vote_debounce", level="ERROR"):
+            debouncer.flush_all()
+        self.assertEqual(debouncer.pending_count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
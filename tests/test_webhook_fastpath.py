@@ -0,0 +1,92 @@
+"""
+webhook 快速路徑的測試（不需要 LINE 和 MongoDB）
+
+- 簽名驗證與 line-bot-sdk 的 SignatureValidator 結果一致
+- 只含投票 postback 的請求取出 VoteEvent
+- 含任何其他事件或無法解析的內容時返回None，交回 SDK 處理
+用法（在專案根目錄執行）:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import hmac
+import json
+import base64
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot.webhook import SignatureValidator
+
+import webhook_fastpath
+from poll import VoteEvent
+
+SECRET = "channel-secret"
+POLL_ID = "01JFASTPATHTEST00000000000"
+GROUP_ID = "C" + "0" * 32
+
+
+def sign(body, secret=SECRET):
+    return base64.b64encode(hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()).decode()
+
+
+def postback(data, user_id="U1", reply_token="token", source_type="group"):
+    source = {"type": source_type, "userId": user_id}
+    if source_type == "group":
+        source["groupId"] = GROUP_ID
+    return {"type": "postback", "replyToken": reply_token, "source": source, "postback": {"data": data},
+            "timestamp": 0, "mode": "active"}
+
+
+def body_of(*events):
+    return json.dumps({"destination": "U" + "f" * 32, "events": list(events)}, ensure_ascii=False)
+
+
+class SignatureTest(unittest.TestCase):
+
+    def test_matches_sdk_validator(self):
+        validator = SignatureValidator(SECRET)
+        body = body_of(postback(f"vote_{POLL_ID}_attend", user_id="U中文"))
+        for signature in (sign(body), sign(body, "other-secret"), sign(body + " "), "", "not base64"):
+            self.assertEqual(webhook_fastpath.verify_signature(body, signature, SECRET),
+                             bool(signature) and validator.validate(body, signature), signature)
+
+    def test_missing_signature_or_secret(self):
+        body = body_of()
+        self.assertFalse(webhook_fastpath.verify_signature(body, None, SECRET))
+        self.assertFalse(webhook_fastpath.verify_signature(body, sign(body), ""))
+
+
+class ParseVoteEventsTest(unittest.TestCase):
+
+    def test_vote_postbacks(self):
+        body = body_of(postback(f"vote_{POLL_ID}_attend", "U1", "t1"),
+                       postback(f"vote_{POLL_ID}_absent", "U2", "t2", source_type="user"))
+        self.assertEqual(webhook_fastpath.parse_vote_events(body), [
+            VoteEvent(POLL_ID, "attend", "U1", "t1", False),
+            VoteEvent(POLL_ID, "absent", "U2", "t2", True),
+        ])
+
+    def test_empty_events(self):
+        # LINE 平台驗證 webhook URL 時送出的空事件列表
+        self.assertEqual(webhook_fastpath.parse_vote_events(body_of()), [])
+
+    def test_falls_back_on_other_events(self):
+        message = {"type": "message", "replyToken": "t", "source": {"type": "user", "userId": "U1"},
+                   "message": {"type": "text", "id": "1", "text": "/poll 週六練球"}}
+        vote = postback(f"vote_{POLL_ID}_attend")
+        cases = {
+            "message": body_of(vote, message),
+            "other postback": body_of(vote, postback("end_poll")),
+            "incomplete vote data": body_of(postback("vote_only")),
+            "no user id": body_of(postback(f"vote_{POLL_ID}_attend", user_id=None)),
+            "invalid json": "{",
+            "not an object": "[]",
+        }
+        for name, body in cases.items():
+            self.assertIsNone(webhook_fastpath.parse_vote_events(body), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,347 @@
+"""
+輕量的請求追蹤
+
+一次 webhook 或排程任務是一條追蹤（trace），其中每個階段是一個區段（span）：
+    with tracing.span("poll.handle_vote", poll_id=poll_id):
+        ...
+或以 @tracing.traced("名稱") 標記函數。區段以 contextvars 記錄目前的父區段，
+同一執行緒內自動串起；交給其他執行緒執行的函數以 tracing.bind(func) 帶上目前的追蹤，
+經由資料庫傳遞的工作（如發件匣）以 current_context() 保存、span(..., parent=保存的值) 接續。
+
+結束的區段以 JSON Lines 寫入 TRACE_FILE（由背景執行緒寫入，不阻塞請求）。
+TRACE_SAMPLE_RATE 決定記錄的追蹤比例，在根區段決定後整條追蹤一致。
+未啟用（TRACING_ENABLED=0）時 span() 返回共用的空區段，幾乎沒有開銷。
+
+`python tracing.py summary` 列出最慢的追蹤及其關鍵路徑（critical path）。
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import argparse
+import functools
+import threading
+import contextvars
+from collections import defaultdict
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('TRACING_ENABLED', '0') == '1'
+SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1'))
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')
+
+_current = contextvars.ContextVar('trace_span', default=None)
+# 根區段未被抽中時放入的標記，使整條追蹤的子區段都不記錄
+_UNSAMPLED = object()
+
+
+class _NoopSpan:
+    """未啟用或未抽中時使用的空區段"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class _UnsampledSpan(_NoopSpan):
+    """未抽中的根區段：執行期間標記整條追蹤不記錄"""
+    __slots__ = ("_token",)
+
+    def __enter__(self):
+        self._token = _current.set(_UNSAMPLED)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        return False
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "start", "_t0", "_token")
+
+    def __init__(self, name, trace_id, parent_id, attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = os.urandom(8).hex()
+        self.attrs = attrs
+
+    def set(self, key, value):
+        """附加屬性（如結果筆數、狀態碼）"""
+        self.attrs[key] = value
+
+    def __enter__(self):
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._t0
+        _current.reset(self._token)
+        record = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(duration * 1000, 3),
+            "thread": threading.current_thread().name,
+        }
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        _exporter.export(record)
+        return False
+
+
+def span(name, parent=None, **attrs):
+    """開啟一個區段
+    參數:
+        name: 區段名稱，如 "db.add_vote"、"line_api.profile"
+        parent: 可選，current_context() 保存的 (trace_id, span_id)，用於接續其他執行緒或行程的追蹤
+        attrs: 附加屬性，需可序列化為 JSON
+    """
+    if not ENABLED:
+        return _NOOP
+    current = _current.get()
+    if current is _UNSAMPLED:
+        return _NOOP
+    if current is not None:
+        return Span(name, current.trace_id, current.span_id, attrs)
+    if parent is not None:
+        return Span(name, parent[0], parent[1], attrs)
+    if random.random() >= SAMPLE_RATE:
+        return _UnsampledSpan()
+    return Span(name, os.urandom(16).hex(), None, attrs)
+
+
+def traced(name):
+    """以區段包住整個函數"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_context():
+    """目前區段的 (trace_id, span_id)，沒有記錄中的追蹤時返回 None"""
+    current = _current.get()
+    if current is None or current is _UNSAMPLED:
+        return None
+    return current.trace_id, current.span_id
+
+
+def bind(func):
+    """讓函數在其他執行緒中以目前的追蹤為父區段執行（用於 Timer、執行緒池）"""
+    if not ENABLED:
+        return func
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+    return wrapper
+
+
+class _FileExporter:
+    """由背景執行緒將區段逐行寫入檔案"""
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # 寫入跟不上時丟棄，不拖慢請求
+            metrics.incr("tracing.dropped")
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _write(self, records):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def _drain(self, first=None):
+        records = [] if first is None else [first]
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            try:
+                self._write(records)
+            except Exception as e:
+                logger.error(f"寫入追蹤記錄時發生錯誤: {e}")
+
+    def _run(self):
+        while True:
+            self._drain(self._queue.get())
+            # 累積一小段時間再寫，減少檔案操作次數
+            time.sleep(0.5)
+
+    def flush(self):
+        self._drain()
+
+
+_exporter = _FileExporter(TRACE_FILE)
+
+
+# ===== 關鍵路徑分析 =====
+
+def load_traces(path):
+    """讀取追蹤檔案
+    返回:
+        {trace_id: [區段記錄, ...]}
+    """
+    traces = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                record["end"] = record["start"] + record["duration_ms"] / 1000
+                traces[record["trace_id"]].append(record)
+    return traces
+
+
+def critical_path(spans):
+    """計算一條追蹤的關鍵路徑
+    從根區段的結束時間往回，每次取在游標之前最晚結束的子區段並遞迴展開，
+    子區段之間沒有被覆蓋的時間算作父區段自身的時間。
+    在其他執行緒中晚於父區段結束的子區段（如合併視窗後的寫入、發件匣推送）也計入，
+    父區段結束到子區段開始之間的時間記為「等待」。
+    返回:
+        (追蹤總耗時秒, [(名稱, 秒), ...] 依時間順序)
+    """
+    by_id = {record["span_id"]: record for record in spans}
+    children = defaultdict(list)
+    roots = []
+    for record in spans:
+        if record["parent_id"] in by_id:
+            children[record["parent_id"]].append(record)
+        else:
+            roots.append(record)
+
+    effective_end = {}
+
+    def compute_end(record):
+        end = record["end"]
+        for child in children[record["span_id"]]:
+            end = max(end, compute_end(child))
+        effective_end[record["span_id"]] = end
+        return end
+
+    for root in roots:
+        compute_end(root)
+
+    segments = []
+
+    def walk(record, cursor):
+        # 由後往前累積，最後反轉為時間順序
+        remaining = sorted(children[record["span_id"]], key=lambda c: effective_end[c["span_id"]], reverse=True)
+        for child in remaining:
+            child_end = effective_end[child["span_id"]]
+            if child_end > cursor:
+                continue
+            _gap(record, child_end, cursor)
+            walk(child, child_end)
+            cursor = child["start"]
+        _gap(record, record["start"], cursor)
+
+    def _gap(record, start, end):
+        if end <= start:
+            return
+        own_end = min(end, record["end"])
+        if end > own_end:
+            segments.append((f"{record['name']} (等待)", end - max(start, own_end)))
+        if own_end > start:
+            segments.append((record["name"], own_end - start))
+
+    root = max(roots, key=lambda r: effective_end[r["span_id"]] - r["start"])
+    walk(root, effective_end[root["span_id"]])
+    segments.reverse()
+    return effective_end[root["span_id"]] - root["start"], segments
+
+
+def summarize(path, top=10):
+    """最慢的追蹤及其關鍵路徑，以及這些追蹤中關鍵路徑時間的彙總"""
+    traces = load_traces(path)
+    analyzed = []
+    for trace_id, spans in traces.items():
+        total, segments = critical_path(spans)
+        root = min(spans, key=lambda r: r["start"])
+        analyzed.append((total, trace_id, root["name"], segments))
+    analyzed.sort(key=lambda item: item[0], reverse=True)
+
+    lines = [f"共 {len(traces)} 條追蹤，最慢的 {min(top, len(analyzed))} 條："]
+    totals = defaultdict(float)
+    for total, trace_id, name, segments in analyzed[:top]:
+        lines.append(f"\n{name} {total * 1000:.1f}ms  trace={trace_id}")
+        merged = []
+        for segment_name, seconds in segments:
+            if merged and merged[-1][0] == segment_name:
+                merged[-1][1] += seconds
+            else:
+                merged.append([segment_name, seconds])
+        for segment_name, seconds in merged:
+            totals[segment_name] += seconds
+            if seconds < 0.00005:
+                continue
+            share = seconds / total if total else 0
+            lines.append(f"  {seconds * 1000:9.1f}ms {share:6.1%}  {segment_name}")
+
+    if totals:
+        grand_total = sum(totals.values())
+        lines.append("\n關鍵路徑時間彙總：")
+        for segment_name, seconds in sorted(totals.items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"  {seconds * 1000:9.1f}ms {seconds / grand_total:6.1%}  {segment_name}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="追蹤記錄工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="列出最慢的追蹤及其關鍵路徑")
+    summary_parser.add_argument("--file", default=TRACE_FILE, help="追蹤檔案")
+    summary_parser.add_argument("--top", type=int, default=10, help="列出的追蹤數")
+    args = parser.parse_args(argv)
+
+    if args.command == "summary":
+        print(summarize(args.file, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,22 @@
-import schedule
+import os
 import time
+import asyncio
 import threading
 import logging
 from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
 from db import Database
-from linebot import LineBotApi
+import startup
+import profiler
+import tracing
+import quota
+import async_bridge
+from job_runner import JobRunner, cancelled
+
+if TYPE_CHECKING:
+    from linebot import LineBotApi
+
+schedule = startup.lazy_module('schedule')
 
 # 設定日誌
 logging.basicConfig(
@@ -22,9 +34,26 @@ line_bot_api = None
 target_group_id = None
 create_poll_func = None
 end_poll_func = None
+publish_results_func = None
 db = None
+runner = None
+
+# 自動創建投票的出席名額，未設定則不限
+AUTO_POLL_CAPACITY = int(os.environ.get('AUTO_POLL_CAPACITY', '0')) or None
 
-def initialize(line_api : LineBotApi, group_id, create_func, end_func, db_instance : Database):
+# 各任務的 (逾時秒數, 重疊策略)，逾時可用環境變數 SCHEDULER_TIMEOUT_<任務名稱大寫> 調整
+JOB_SETTINGS = {
+    "create_auto_poll": (120, 'skip'),
+    # 結束投票需逐一查詢名稱和推送，較慢；重疊時結束後再執行一次，確保新到期的投票也被結束
+    "end_auto_polls": (600, 'queue'),
+    "reconcile_quota": (60, 'skip'),
+    "publish_pending_results": (300, 'skip'),
+}
+
+# 結束超過此秒數仍未寫入結果的投票才重新發送，不與進行中的結束投票重疊
+PENDING_RESULTS_GRACE_SECONDS = 300
+
+def initialize(line_api : 'LineBotApi', group_id, create_func, end_func, db_instance : Database, publish_func=None):
     """
     初始化排程器
     參數:
@@ -33,13 +62,15 @@ def initialize(line_api : LineBotApi, group_id, create_func, end_func, db_instan
         create_func: 創建投票的函數
         end_func: 結束投票的函數
         db: 數據庫實例
+        publish_func: 可選，發送已結束投票結果的函數（poll.publish_results）
     """
-    global line_bot_api, target_group_id, create_poll_func, end_poll_func, db
+    global line_bot_api, target_group_id, create_poll_func, end_poll_func, publish_results_func, db
     
     line_bot_api = line_api
     target_group_id = group_id
     create_poll_func = create_func
     end_poll_func = end_func
+    publish_results_func = publish_func
     db = db_instance
     
     logger.info("排程器已初始化")
@@ -61,33 +92,62 @@ def get_next_sunday():
     
     return next_sunday
 
+@profiler.profiled("scheduler.create_auto_poll", sample_rate=1)
+@tracing.traced("scheduler.create_auto_poll")
 def create_auto_poll():
-    """自動創建週日出席調查投票"""
-    try:
-        next_sunday = get_next_sunday()
-        poll_title = f"{next_sunday.strftime('%m/%d')} 人數統計"
-        
-        # 使用提供的創建投票函數
-        _ , poll_id = create_poll_func(db, poll_title, target_group_id, line_bot_api)
-        
-        logger.info(f"已自動為群組 {target_group_id} 創建週日出席調查投票")
-    except Exception as e:
-        logger.error(f"自動創建投票時發生錯誤: {e}")
+    """自動創建週日出席調查投票（失敗時拋出例外，由 runner 記錄為 error）"""
+    next_sunday = get_next_sunday()
+    poll_title = f"{next_sunday.strftime('%m/%d')} 人數統計"
+    
+    # 使用提供的創建投票函數
+    success, poll_id = create_poll_func(db, poll_title, target_group_id, line_bot_api, capacity=AUTO_POLL_CAPACITY)
+    if not success:
+        raise RuntimeError(f"自動創建投票失敗: {poll_title}")
+    
+    logger.info(f"已自動為群組 {target_group_id} 創建週日出席調查投票: {poll_id}")
 
+@profiler.profiled("scheduler.end_auto_polls", sample_rate=1)
+@tracing.traced("scheduler.end_auto_polls")
 def end_auto_polls():
-    """自動結束所有活動中的投票(限於特定群組)"""
-    try:
-        # 找出所有活動中的投票
-        for poll_id in db.get_active_polls(target_group_id):
-            try:
-                # 使用提供的結束投票函數
-                end_poll_func(None, poll_id, line_bot_api, db)
-                logger.info(f"已自動結束投票: {poll_id}")
-            except Exception as e:
-                logger.error(f"自動結束投票 {poll_id} 時發生錯誤: {e}")
-    except Exception as e:
-        logger.error(f"執行自動結束投票任務時發生錯誤: {e}")
+    """自動結束所有活動中的投票(限於特定群組)
+    個別投票失敗不影響其他投票，全部處理完後拋出例外，由 runner 記錄為 error
+    """
+    failed = []
+    # 找出所有活動中的投票
+    for poll in db.get_active_polls(target_group_id):
+        if cancelled():
+            logger.warning("自動結束投票任務已逾時，剩餘的投票留待下次執行")
+            break
+        poll_id = poll.get('poll_id')
+        try:
+            # 使用提供的結束投票函數
+            end_poll_func(None, poll_id, line_bot_api, db)
+            logger.info(f"已自動結束投票: {poll_id}")
+        except Exception as e:
+            logger.error(f"自動結束投票 {poll_id} 時發生錯誤: {e}")
+            failed.append(poll_id)
+    if failed:
+        raise RuntimeError(f"{len(failed)} 個投票自動結束失敗: {', '.join(failed)}")
 
+@profiler.profiled("scheduler.publish_pending_results", sample_rate=1)
+@tracing.traced("scheduler.publish_pending_results")
+def publish_pending_results():
+    """重新發送已結束但結果或出席統計未寫入的投票（結束投票在關閉後中途失敗）"""
+    failed = []
+    for poll_id in db.get_unpublished_polls(datetime.now() - timedelta(seconds=PENDING_RESULTS_GRACE_SECONDS)):
+        if cancelled():
+            break
+        try:
+            db.run_transaction(lambda session: publish_results_func(db, poll_id, line_bot_api, session=session))
+            logger.info(f"已重新發送投票結果: {poll_id}")
+        except Exception as e:
+            logger.error(f"重新發送投票結果 {poll_id} 時發生錯誤: {e}")
+            failed.append(poll_id)
+    if failed:
+        raise RuntimeError(f"{len(failed)} 個投票的結果發送失敗: {', '.join(failed)}")
+
+@profiler.profiled("scheduler.clear_poll_db", sample_rate=1)
+@tracing.traced("scheduler.clear_poll_db")
 def clear_poll_db():
     """
     清空投票數據庫，刪除過期投票(一個月前)
@@ -95,35 +155,78 @@ def clear_poll_db():
     try:
         one_month_ago = datetime.now() - timedelta(days=30)
         for poll in db.get_closed_polls(target_group_id):
-            if poll.get('timestamp') < one_month_ago:
+            if cancelled():
+                break
+            created_at = poll.get('created_at')
+            if created_at and created_at < one_month_ago:
                 db.delete_poll(poll.get('poll_id'))
                 logger.info(f"已刪除過期投票: {poll.get('poll_id')}")
     except Exception as e:
         logger.error(f"清空投票數據庫時發生錯誤: {e}")
     logger.info("已清空投票隊列")
 
+@profiler.profiled("scheduler.reconcile_quota", sample_rate=1)
+@tracing.traced("scheduler.reconcile_quota")
+def reconcile_quota():
+    """以 LINE 的額度端點校正訊息用量（失敗時拋出例外，由 runner 記錄為 error）"""
+    quota.reconcile(line_bot_api)
+
+def add_job(name, func):
+    """以 JOB_SETTINGS 的逾時和重疊策略註冊任務，返回交給 schedule 的觸發函數"""
+    timeout, overlap = JOB_SETTINGS[name]
+    timeout = float(os.environ.get(f"SCHEDULER_TIMEOUT_{name.upper()}", timeout))
+    return runner.add(name, func, timeout, overlap)
+
 def setup_scheduler():
     # """設定排程任務"""
+    global runner
+    runner = JobRunner()
+
     # # 設定每週日18:00自動開啟投票
-    schedule.every().sunday.at("18:00").do(create_auto_poll)
+    schedule.every().sunday.at("18:00").do(add_job("create_auto_poll", create_auto_poll))
     
     # # 設定每週六00:00自動結束投票   
-    schedule.every().saturday.at("00:00").do(end_auto_polls)
+    schedule.every().saturday.at("00:00").do(add_job("end_auto_polls", end_auto_polls))
+
+    # 結束投票中途失敗時補發結果
+    if publish_results_func:
+        schedule.every(5).minutes.do(add_job("publish_pending_results", publish_pending_results))
+
+    # 定期校正訊息用量，啟動時先校正一次
+    reconcile = add_job("reconcile_quota", reconcile_quota)
+    schedule.every(quota.RECONCILE_MINUTES).minutes.do(reconcile)
+    reconcile()
     
     logger.info("已設定排程任務: 週六18:00自動創建投票，週六00:00自動結束投票")
 
 def run_scheduler():
-    """運行排程器"""
+    """運行排程器（只判斷任務是否到期，任務在 runner 的執行緒池中執行）"""
     while True:
         schedule.run_pending()
         time.sleep(60)  # 每分鐘檢查一次
 
+async def run_scheduler_async():
+    """非同步模式的排程器：在事件迴圈上判斷任務是否到期"""
+    while True:
+        schedule.run_pending()
+        await asyncio.sleep(60)
+
 def start_scheduler():
-    """啟動排程器執行緒"""
+    """啟動排程器執行緒（非同步模式下改為事件迴圈上的任務）"""
     setup_scheduler()
+
+    if async_bridge.enabled():
+        asyncio.run_coroutine_threadsafe(run_scheduler_async(), async_bridge.loop())
+        logger.info("排程器已在事件迴圈上啟動")
+        return
     
     scheduler_thread = threading.Thread(target=run_scheduler)
     scheduler_thread.daemon = True  # 設為守護線程，主線程結束時會自動終止
     scheduler_thread.start()
     
     logger.info("排程器執行緒已啟動")
+
+def job_status():
+    """各排程任務最近一次的執行狀態"""
+    return runner.status() if runner else "排程器尚未啟動"
+
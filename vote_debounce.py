@@ -0,0 +1,99 @@
+import threading
+import logging
+import metrics
+import tracing
+import async_bridge
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingVote:
+    """合併視窗內等待寫入的投票"""
+    __slots__ = ("vote", "reply_token", "private", "line_bot_api", "db", "taps")
+
+    def __init__(self, vote, reply_token, private, line_bot_api, db):
+        self.vote = vote
+        self.reply_token = reply_token
+        self.private = private
+        self.line_bot_api = line_bot_api
+        self.db = db
+        self.taps = 1
+
+
+class VoteDebouncer:
+    """按 (poll_id, user_id) 合併短時間內的連續投票點擊
+
+    第一次點擊開啟固定長度的視窗，視窗內的後續點擊只更新最終選項和回覆令牌；
+    視窗結束時以最終選項呼叫一次 flush，因此只有一次資料庫寫入和一則確認訊息。
+    視窗從第一次點擊起算，持續點擊也不會無限延後寫入。
+    """
+
+    def __init__(self, window, flush):
+        """
+        參數:
+            window: 合併視窗長度（秒），0 表示關閉
+            flush: 視窗結束時的處理函數 flush(poll_id, vote, user_id, reply_token, line_bot_api, db, private=...)
+        """
+        self.window = window
+        self.flush = flush
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def submit(self, poll_id, user_id, vote, reply_token, line_bot_api, db, private=False):
+        """提交一次點擊（private: 點擊是否來自一對一聊天，與回覆令牌一起更新）
+        返回:
+            True 表示開啟了新的視窗，False 表示合併到既有視窗
+        """
+        key = (poll_id, user_id)
+        metrics.incr("vote_debounce.taps")
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                # 合併：只保留最後的選項，使用最新（最晚過期）的回覆令牌
+                pending.vote = vote
+                pending.reply_token = reply_token
+                pending.private = private
+                pending.taps += 1
+                metrics.incr("vote_debounce.coalesced")
+                return False
+            self._pending[key] = _PendingVote(vote, reply_token, private, line_bot_api, db)
+
+        # 寫入在計時器執行緒中進行（非同步模式下在事件迴圈上計時），接續第一次點擊的追蹤
+        if async_bridge.enabled():
+            async_bridge.call_later(self.window, tracing.bind(self._fire), key)
+            return True
+        timer = threading.Timer(self.window, tracing.bind(self._fire), args=(key,))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _fire(self, key):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+
+        poll_id, user_id = key
+        metrics.incr("vote_debounce.flushes")
+        if pending.taps > 1:
+            logger.info(f"合併了 {pending.taps} 次點擊: {poll_id}, 用戶: {user_id}, 最終選項: {pending.vote}")
+        try:
+            self.flush(poll_id, pending.vote, user_id, pending.reply_token, pending.line_bot_api, pending.db,
+                       private=pending.private)
+        except Exception as e:
+            logger.error(f"處理合併後的投票時發生錯誤: {e}")
+
+    def flush_all(self):
+        """立即處理所有等待中的投票（關閉服務前呼叫；計時器是 daemon 執行緒，行程結束時不會等待）"""
+        with self._lock:
+            keys = list(self._pending)
+        for key in keys:
+            self._fire(key)
+
+    def pending_count(self):
+        """等待寫入的投票數"""
+        return len(self._pending)
@@ -0,0 +1,50 @@
+import base64
+import hashlib
+import hmac
+import json
+from poll import VoteEvent, parse_vote_data
+
+# 投票按鈕的 postback 佔了絕大多數的 webhook 流量；
+# 這裡只驗證簽名並取出投票需要的欄位，不經過 line-bot-sdk 的完整模型轉換。
+# 只要有任何一個事件不是投票 postback，就整批交回 SDK 處理。
+
+
+def verify_signature(body, signature, channel_secret):
+    """驗證 X-Line-Signature（HMAC-SHA256，Base64 編碼）
+    參數:
+        body: 請求內容字串
+        signature: X-Line-Signature 標頭
+        channel_secret: 頻道密鑰
+    返回:
+        簽名是否正確
+    """
+    if not signature or not channel_secret:
+        return False
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(digest))
+
+
+def parse_vote_events(body):
+    """從 webhook 內容中取出投票事件
+    參數:
+        body: 已驗證簽名的請求內容字串
+    返回:
+        VoteEvent 列表；只要有非投票事件（或內容無法解析）就返回None，交由 SDK 處理
+    """
+    try:
+        events = json.loads(body).get('events', [])
+    except (ValueError, AttributeError):
+        return None
+
+    vote_events = []
+    for event in events:
+        if event.get('type') != 'postback':
+            return None
+        parsed = parse_vote_data(event.get('postback', {}).get('data'))
+        source = event.get('source', {})
+        user_id = source.get('userId')
+        if not parsed or not user_id:
+            return None
+        poll_id, vote = parsed
+        vote_events.append(VoteEvent(poll_id, vote, user_id, event.get('replyToken'), source.get('type') == 'user'))
+    return vote_events